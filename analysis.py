@@ -2,10 +2,163 @@ from csv import reader, writer
 from itertools import islice
 from collections import defaultdict
 from math import ceil
+from os.path import getsize, splitext
 
-from terminalHelpers import ProgressMeter
+import numpy as np
+
+from terminalHelpers import progress_meter
+from instrumentation import instruments
+
+### Binary score files
+# A '.npy' score file holds either
+#   - every word pair's score as a 1d unsigned int array in combinations order
+#     (the condensed upper triangle of the score matrix), or
+#   - an array of EDGE_DTYPE records, for files that only keep some of the pairs.
+# Either way the words are stored one per line in a '.vocab' file next to it, and
+# the pairs refer to words by their line number in it.
+# A condensed file can also have a '.totals.npz' file next to it, with the fixed point sums
+# behind its scores, so trees can be added to or removed from it (multiTree.py --update).
+
+EDGE_DTYPE = np.dtype([('i', '<u4'), ('j', '<u4'), ('score', '<u2')])
+
+def is_binary(path):
+    return path.endswith('.npy')
+
+def vocab_path(path):
+    """Returns the location of the vocabulary file for the binary score file at path"""
+    return splitext(path)[0] + '.vocab'
+
+def totals_path(path):
+    """Returns the location of the pair totals (see multiTree.py's PairTotals) kept for the
+    binary score file at path"""
+    return splitext(path)[0] + '.totals.npz'
+
+def write_vocab(path, words):
+    with open(vocab_path(path), 'w+', encoding='utf8') as f:
+        f.writelines(word + '\n' for word in words)
+
+def load_vocab(path):
+    """Returns the list of words for the binary score file at path"""
+    with open(vocab_path(path), encoding='utf8') as f:
+        return f.read().splitlines()
+
+def load_scores(path):
+    """Memory maps the binary score file at path (see is_condensed)"""
+    return np.load(path, mmap_mode='r')
+
+def is_condensed(scores):
+    """True if scores holds every pair in combinations order, False if it is EDGE_DTYPE records"""
+    return scores.dtype.names is None
+
+def condensed_pairs(word_count, start, stop):
+    """Returns the (rows, cols) word indices of the entries start:stop of a condensed score array"""
+    # flat index where each row of the upper triangle starts
+    row_lengths = np.arange(word_count - 1, 0, -1, dtype=np.int64)
+    row_starts = np.cumsum(row_lengths) - row_lengths
+    flat = np.arange(start, stop, dtype=np.int64)
+    rows = np.searchsorted(row_starts, flat, side='right') - 1
+    cols = flat - row_starts[rows] + rows + 1
+    return rows, cols
+
+def edge_blocks(path, block_size=1 << 20):
+    """Yields (rows, cols, scores) int arrays of at most block_size pairs from the
+    binary score file at path, without loading all of it into memory."""
+    scores = load_scores(path)
+    word_count = len(load_vocab(path)) if is_condensed(scores) else None
+    for start in range(0, len(scores), block_size):
+        block = scores[start:start + block_size]
+        if word_count is None:
+            yield block['i'].astype(np.int64), block['j'].astype(np.int64), block['score'].astype(np.int64)
+        else:
+            rows, cols = condensed_pairs(word_count, start, start + len(block))
+            yield rows, cols, block.astype(np.int64)
+
+def binary_iter(path):
+    """Yields (word0, word1, score) from the binary score file at path, like file_iter"""
+    words = load_vocab(path)
+    for rows, cols, scores in edge_blocks(path):
+        for a, b, score in zip(rows.tolist(), cols.tolist(), scores.tolist()):
+            yield words[a], words[b], score
+
+def export_csv(path, csv_path, delimiter='\t', invert_max=None):
+    """Writes the binary score file at path out as a csv. If invert_max is given, each
+    score s is written as invert_max - s + 1, so a low value is high correlation.
+    Returns the number of rows written."""
+    words = load_vocab(path)
+    written = 0
+    total = len(load_scores(path))
+    with open(csv_path, 'w+') as f, instruments.stage('export_csv') as stage, progress_meter(total) as meter:
+        w = writer(f, delimiter=delimiter)
+        w.writerow('source target weight'.split())
+        for rows, cols, scores in edge_blocks(path):
+            if invert_max is not None:
+                scores = invert_max - scores + 1
+            w.writerows((words[a], words[b], score)
+                        for a, b, score in zip(rows.tolist(), cols.tolist(), scores.tolist()))
+            written += len(scores)
+            meter.advance(len(scores))
+        stage.count('pairs', written)
+        stage.count('bytes_written', f.tell())
+    return written
+
+def inverted_path(path):
+    """Where the inverted csv of the score file at path goes"""
+    return splitext(path)[0] + '-inverted.csv'
+
+class ScoreCsvWriter:
+    """Writes (word0, word1, score) rows to a csv at path and/or an inverted csv at
+    inverted_path, where each score s is written as invert_max - s + 1 (so a low value is
+    high correlation). Both come from the same rows, so they only take one pass over the
+    scores. Either path can be None to skip that file. If append is true, the rows are
+    added to the end of the files, without a header."""
+
+    HEADER = 'source target weight'.split()
+
+    def __init__(self, path, inverted_path=None, invert_max=None, header=True, append=False, **csv_kwargs):
+        if inverted_path is not None and invert_max is None:
+            raise ValueError('an inverted csv needs the invert_max to invert the scores with')
+        self.invert_max = invert_max
+        self.files = [open(p, 'a' if append else 'w+') if p is not None else None for p in (path, inverted_path)]
+        self.raw, self.inverted = [writer(f, **csv_kwargs) if f is not None else None for f in self.files]
+        if header and not append:
+            for csv_writer in filter(None, (self.raw, self.inverted)):
+                csv_writer.writerow(ScoreCsvWriter.HEADER)
+
+    def writerows(self, rows):
+        """Writes (word0, word1, score) rows from any iterable"""
+        if self.raw is not None and self.inverted is not None:
+            rows = list(rows)
+        if self.raw is not None:
+            self.raw.writerows(rows)
+        if self.inverted is not None:
+            invert_max = self.invert_max
+            self.inverted.writerows((a, b, invert_max - s + 1) for a, b, s in rows)
+
+    def flush(self):
+        for f in filter(None, self.files):
+            f.flush()
+
+    def tell(self):
+        """The bytes written to the files so far"""
+        return sum(f.tell() for f in filter(None, self.files))
+
+    def close(self):
+        for f in filter(None, self.files):
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+### Score files (csv or binary)
 
 def file_iter(path):
+    if is_binary(path):
+        yield from binary_iter(path)
+        return
+
     with open(path) as f:
         r = reader(f, delimiter='\t')
         header = next(r)
@@ -21,23 +174,109 @@ def int_iter(path):
     for _, _, v in file_iter(path):
         yield v
 
-def make_buckets(path, bucket_size=5):
-    """Counts how many words are in buckets of size 5 and prints, the returns the buckets"""
-    nums = list(int_iter(path))
-    max_value = max(nums)
+class ScoreHistogram:
+    """Counts how many pairs have each (non-negative int) score, in a count array that
+    grows to fit the biggest score seen. Since scores are small ints this takes a few
+    hundred counts of memory however many pairs go in, and the quantiles are exact."""
+
+    def __init__(self):
+        self.counts = np.zeros(64, dtype=np.int64)
+        self.max_value = 0
+        self.total = 0
+
+    def _fit(self, max_value):
+        """Grows self.counts (by doubling) until max_value fits"""
+        if max_value >= len(self.counts):
+            size = len(self.counts)
+            while size <= max_value:
+                size *= 2
+            self.counts = np.concatenate((self.counts, np.zeros(size - len(self.counts), dtype=np.int64)))
+        self.max_value = max(self.max_value, max_value)
+
+    def add(self, score):
+        self._fit(score)
+        self.counts[score] += 1
+        self.total += 1
+
+    def add_many(self, scores):
+        """Adds an array of scores"""
+        if not len(scores):
+            return
+        block_counts = np.bincount(scores)
+        self._fit(len(block_counts) - 1)
+        self.counts[:len(block_counts)] += block_counts
+        self.total += len(scores)
+
+    def merge(self, other):
+        """Adds the counts of another ScoreHistogram to this one"""
+        self._fit(other.max_value)
+        self.counts[:len(other.counts)] += other.counts[:len(self.counts)]
+        self.total += other.total
+
+    def inverted(self, max_value=None):
+        """Returns the histogram of the scores inverted as max_value - s + 1"""
+        max_value = self.max_value if max_value is None else max_value
+        result = ScoreHistogram()
+        result._fit(max_value + 1)
+        # max_value can be past the end of self.counts (eg score_upper_bound)
+        counts = np.zeros(max_value + 1, dtype=np.int64)
+        counts[:min(len(self.counts), max_value + 1)] = self.counts[:max_value + 1]
+        result.counts[1:max_value + 2] = counts[::-1]
+        result.total = self.total
+        result.max_value = max_value + 1 - int(np.flatnonzero(self.counts)[0]) if self.total else 0
+        return result
+
+    def quantile(self, q):
+        """Returns the smallest score that at least a q fraction (0 to 1) of the pairs are at or under"""
+        cumulative = np.cumsum(self.counts[:self.max_value + 1])
+        return int(np.searchsorted(cumulative, max(1, ceil(q * self.total))))
+
+    def buckets(self, bucket_size=5):
+        """Returns the counts in buckets of bucket_size scores: (0, bucket_size], (bucket_size, 2 * bucket_size]..."""
+        counts = self.counts[1:self.max_value + 1]
+        padded = np.concatenate((counts, np.zeros(-len(counts) % bucket_size, dtype=np.int64)))
+        return padded.reshape(-1, bucket_size).sum(axis=1).tolist()
+
+    @staticmethod
+    def from_counts(counts):
+        """Rebuilds a ScoreHistogram from its counts (eg saved with counts.tolist())"""
+        histogram = ScoreHistogram()
+        nonzero = np.flatnonzero(counts)
+        histogram._fit(int(nonzero[-1]) if len(nonzero) else 0)
+        histogram.counts[:len(counts)] = counts
+        histogram.total = int(np.sum(counts))
+        return histogram
+
+    @staticmethod
+    def from_file(path, chunk_size=1 << 20):
+        """Streams the scores of the csv or binary score file at path into a new ScoreHistogram,
+        chunk_size scores at a time"""
+        histogram = ScoreHistogram()
+        with instruments.stage('read_scores') as stage:
+            if is_binary(path):
+                for _, _, scores in edge_blocks(path, chunk_size):
+                    histogram.add_many(scores)
+            else:
+                scores = int_iter(path)
+                while len(chunk := np.fromiter(islice(scores, chunk_size), dtype=np.int64)):
+                    histogram.add_many(chunk)
+            stage.count('pairs', histogram.total)
+            stage.count('bytes', getsize(path))
+        return histogram
+
+def make_buckets(path, bucket_size=5, quantiles=(.01, .05, .1, .25, .5, .75, .9, .95, .99)):
+    """Counts how many pairs are in buckets of size 5 and prints, the returns the buckets.
+    path can be a score file (read in one streaming pass) or a ScoreHistogram already
+    filled in. Also prints the score at each of quantiles."""
+    histogram = path if isinstance(path, ScoreHistogram) else ScoreHistogram.from_file(path)
+    if not histogram.total:
+        # eg a threshold that no pair reached
+        print('no scores to bucket')
+        return [], []
+    max_value = histogram.max_value
     print('max value:', max_value)
 
-    # add two just in case
-    num_buckets = ceil(max_value / bucket_size) + 2
-    buckets = [0] * num_buckets
-    for v in nums:
-        buckets[(v - 1) // bucket_size] += 1
-
-    # trim empty buckets
-    i = num_buckets - 1
-    while buckets[i] == 0:
-        del buckets[i]
-        i -= 1
+    buckets = histogram.buckets(bucket_size)
     
     ### print out buckets in an aligned table
     # the list of strings that have the value ranges for each bucket
@@ -50,44 +289,153 @@ def make_buckets(path, bucket_size=5):
     table_format_str = r'{:<' + str(max_range_size) + r'} : {:>' + str(max_count_size) + r'}'
     for size_text, count in zip(range_texts, buckets):
         print(table_format_str.format(size_text, count))
+
+    if quantiles:
+        print('quantiles:', ', '.join(f'{q:.0%}: {histogram.quantile(q)}' for q in quantiles))
     return range_texts, buckets
 
-def make_globs(path, threshold):
-    word_to_glob_key = dict()
-
-    def add_to(dest_word: str, add_word: str):
-        word_to_glob_key[add_word] = word_to_glob_key[dest_word]
-
-    def merge_into(dest_glob_key: int, move_glob_key: int):
-        for word, key in word_to_glob_key.items():
-            if key == move_glob_key:
-                word_to_glob_key[word] = dest_glob_key
-
-    last_key = -1
-    meter = ProgressMeter()
-    file_len = get_file_len()
-    for i, (w0, w1, score) in enumerate(file_iter()):
-        meter.update_meter(100 * i / file_len)
-        if score > threshold:
+class DisjointSet:
+    """Union-find over the ints 0 to size - 1, with path compression and union by rank"""
+
+    def __init__(self, size=0):
+        self.parent = list(range(size))
+        self.rank = [0] * size
+
+    def __len__(self):
+        return len(self.parent)
+
+    def grow(self, size):
+        """Adds singleton sets until there are size elements"""
+        self.parent.extend(range(len(self.parent), size))
+        self.rank.extend([0] * (size - len(self.rank)))
+
+    def find(self, x):
+        """Returns the representative of x's set, pointing everything on the way at it"""
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        """Merges the sets of a and b. Returns True if they were different sets"""
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return False
+        if self.rank[a] < self.rank[b]:
+            a, b = b, a
+        self.parent[b] = a
+        if self.rank[a] == self.rank[b]:
+            self.rank[a] += 1
+        return True
+
+    def groups(self, members):
+        """Returns the lists of members that are in the same set"""
+        groups = defaultdict(list)
+        for x in members:
+            groups[self.find(x)].append(x)
+        return list(groups.values())
+
+def csv_edge_blocks(path, max_score, word_ids, block_size=1 << 16):
+    """Yields (rows, cols, scores) int arrays of at most block_size of the pairs scoring at
+    most max_score in the csv score file at path, like edge_blocks. The words are numbered
+    in word_ids in the order they come."""
+    rows, cols, scores = [], [], []
+    for w0, w1, score in file_iter(path):
+        if score > max_score:
             continue
-        
-        w0_in, w1_in = w0 in word_to_glob_key, w1 in word_to_glob_key
-        if w0_in and w1_in:
-            merge_into(word_to_glob_key[w0], word_to_glob_key[w1])
-        elif w0_in:
-            add_to(w0, w1)
-        elif w1_in:
-            add_to(w1, w0)
-        else:
-            last_key += 1
-            word_to_glob_key[w0] = last_key
-            word_to_glob_key[w1] = last_key
+        rows.append(word_ids.setdefault(w0, len(word_ids)))
+        cols.append(word_ids.setdefault(w1, len(word_ids)))
+        scores.append(score)
+        if len(scores) == block_size:
+            yield tuple(np.asarray(part, dtype=np.int64) for part in (rows, cols, scores))
+            rows, cols, scores = [], [], []
+    yield tuple(np.asarray(part, dtype=np.int64) for part in (rows, cols, scores))
+
+def sorted_edges(path, max_score):
+    """Reads the csv or binary score file at path once, keeping the pairs that score at most
+    max_score. Returns (words, rows, cols, scores) where rows and cols index into words,
+    sorted by score (and in file order within a score).
+
+    Scores are small non-negative ints, so each block of pairs is counting sorted into a
+    bucket per score as it is read, and the buckets are joined in order at the end."""
+    if is_binary(path):
+        words = load_vocab(path)
+        blocks = edge_blocks(path)
+    else:
+        word_ids = dict()
+        blocks = csv_edge_blocks(path, max_score, word_ids)
+
+    # buckets[score] holds the (rows, cols) blocks of the pairs with that score, in file order
+    buckets = []
+    for rows, cols, scores in blocks:
+        under = scores <= max_score
+        rows, cols, scores = rows[under], cols[under], scores[under]
+        if not len(scores):
+            continue
+        counts = np.bincount(scores)
+        buckets.extend([] for _ in range(len(buckets), len(counts)))
+        # a stable sort of 16 bit keys is numpy's radix sort, a counting sort by another name
+        order = np.argsort(scores.astype(np.uint16) if len(counts) <= 1 << 16 else scores, kind='stable')
+        ends = np.cumsum(counts).tolist()
+        for score in np.flatnonzero(counts).tolist():
+            part = order[ends[score] - counts[score]:ends[score]]
+            buckets[score].append((rows[part], cols[part]))
+
+    if not is_binary(path):
+        words = list(word_ids)
+    sizes = [sum(len(part_rows) for part_rows, _ in bucket) for bucket in buckets]
+    scores = np.repeat(np.arange(len(buckets), dtype=np.int64), sizes)
+    parts = [part for bucket in buckets for part in bucket]
+    if not parts:
+        return words, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), scores
+    return words, np.concatenate([part_rows for part_rows, _ in parts]), np.concatenate([part_cols for _, part_cols in parts]), scores
+
+def glob_merges(path, max_score):
+    """Yields the single-linkage dendrogram of the words in the score file at path (where low
+    scores are related, eg an inverted file) as (score, word0, word1) for each pair that joins
+    two globs, in order of score, up to max_score."""
+    words, rows, cols, scores = sorted_edges(path, max_score)
+    globs = DisjointSet(len(words))
+    for a, b, score in zip(rows.tolist(), cols.tolist(), scores.tolist()):
+        if globs.union(a, b):
+            yield score, words[a], words[b]
+
+def make_glob_levels(path, thresholds):
+    """Groups the words of the score file at path (where low scores are related, eg an inverted
+    file) into globs that are linked by pairs scoring at most the threshold, for every threshold
+    in one read of the file. Only words in such a pair are in a glob.
 
-    print(len(word_to_glob_key))
-    globs = defaultdict(list)
-    for k, v in word_to_glob_key.items():
-        globs[v].append(k)
-    return globs.values()
+    Returns { threshold -> list of globs (lists of words) }"""
+    thresholds = sorted(thresholds)
+    with instruments.stage('read_edges') as stage:
+        words, rows, cols, scores = sorted_edges(path, thresholds[-1])
+        stage.count('pairs_kept', len(scores))
+    # where the pairs for each threshold end in the sorted pairs
+    ends = np.searchsorted(scores, thresholds, side='right').tolist()
+
+    with instruments.stage('merge_globs') as stage:
+        globs = DisjointSet(len(words))
+        in_glob = np.zeros(len(words), dtype=bool)
+        levels = dict()
+        start = 0
+        for threshold, end in zip(thresholds, ends):
+            for a, b in zip(rows[start:end].tolist(), cols[start:end].tolist()):
+                globs.union(a, b)
+            in_glob[rows[start:end]] = in_glob[cols[start:end]] = True
+            start = end
+            levels[threshold] = [[words[x] for x in glob] for glob in globs.groups(np.flatnonzero(in_glob).tolist())]
+        stage.count('pairs', len(scores))
+        stage.gauge('globs', sum(map(len, levels.values())))
+    return levels
+
+def make_globs(path, threshold):
+    """Groups the words of the score file at path into globs that are linked by pairs
+    scoring at most threshold (see make_glob_levels)"""
+    globs = make_glob_levels(path, [threshold])[threshold]
+    print(sum(map(len, globs)))
+    return globs
 
 
 if __name__ == "__main__":
@@ -96,7 +444,6 @@ if __name__ == "__main__":
     xlabel, buckets = make_buckets('multi-tree-output-inverted.csv')
 
     import matplotlib.pyplot as plt
-    import numpy as np
 
     x = np.asarray([5 * i for i in range(len(buckets))])
     w = 4.5
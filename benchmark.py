@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+from contextlib import redirect_stdout
+from io import StringIO
+from itertools import islice
+from json import dump, load
+from multiprocessing import get_context
+from os import makedirs
+from os.path import abspath, dirname, exists, getsize, join
+from platform import platform, python_version
+from random import Random
+from resource import getrusage, RUSAGE_SELF
+from sys import exit, platform as sys_platform
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import perf_counter, strftime
+
+from terminalHelpers import *
+
+### Synthetic data
+# Paths files are made up rather than read from wcluster output, so that the vocabulary size,
+# number of leaves and depth of each tree can be picked freely. Everything is seeded, so the
+# same arguments always make the same files.
+
+def make_leaves(leaf_count, depth, rng):
+    """Makes leaf_count bitstrings that are the leaves of a binary tree at most depth deep,
+    by splitting leaves until there are enough. Half the time the leaf split last is split
+    again, so the tree gets long branches like wcluster's do."""
+    leaves, last = [''], ''
+    while len(leaves) < leaf_count:
+        splittable = [i for i, leaf in enumerate(leaves) if len(leaf) < depth]
+        if not splittable:
+            raise ValueError(f'a tree {depth} deep can not have {leaf_count} leaves')
+        if len(last) < depth and rng.random() < .5 and last in leaves:
+            i = leaves.index(last)
+        else:
+            i = rng.choice(splittable)
+        leaf = leaves.pop(i)
+        leaves += [leaf + '0', leaf + '1']
+        last = leaf + rng.choice('01')
+    return leaves
+
+def make_paths_file(path, word_count, leaf_count, depth, seed):
+    """Writes a paths file (bitstring, word and count on each line, like wcluster's) with
+    word_count words spread over leaf_count leaves. Counts follow Zipf's law."""
+    rng = Random(seed)
+    leaves = make_leaves(min(leaf_count, word_count), depth, rng)
+    # every leaf gets a word, then the rest go anywhere
+    word_leaves = leaves + [rng.choice(leaves) for _ in range(word_count - len(leaves))]
+    rng.shuffle(word_leaves)
+    with open(path, 'w+') as f:
+        f.writelines(f'{leaf}\tw{i}\t{word_count // (i + 1) + 1}\n' for i, leaf in enumerate(word_leaves))
+
+def make_text_file(path, byte_count, word_count, seed):
+    """Writes about byte_count bytes of text made of the words w0 to w{word_count - 1} and
+    punctuation, for the input cleaner"""
+    rng = Random(seed)
+    words = [f'w{i}' for i in range(word_count)]
+    marks = [',', '.', '!', '?!', ' "', '" ', "'s", ' -- ', '...']
+    written = 0
+    with open(path, 'w+') as f:
+        while written < byte_count:
+            line = ' '.join(rng.choice(words) + (rng.choice(marks) if rng.random() < .2 else '')
+                            for _ in range(rng.randint(1, 30))) + '\n'
+            f.write(line)
+            written += len(line)
+
+
+class BenchmarkData:
+    """The synthetic files the benchmarks run on, made in directory"""
+
+    def __init__(self, directory, word_count, pair_word_count, leaf_count, depth, tree_count, text_bytes, seed):
+        self.directory = directory
+        self.word_count = word_count
+        self.pair_word_count = min(pair_word_count, word_count)
+        self.leaf_count = leaf_count
+        self.depth = depth
+        self.tree_count = tree_count
+        self.text_bytes = text_bytes
+        self.seed = seed
+
+        self.paths_files = [join(directory, f'w{word_count}-t{i}.paths') for i in range(tree_count)]
+        # the pairwise benchmarks are quadratic, so they get a smaller vocabulary
+        self.pair_paths_files = [join(directory, f'w{self.pair_word_count}-t{i}.pair-paths') for i in range(tree_count)]
+        self.text_file = join(directory, 'corpus.txt')
+        self.csv_file = join(directory, 'scores.csv')
+        self.inverted_csv_file = join(directory, 'scores-inverted.csv')
+
+    def make(self):
+        """Makes any of the files that don't exist yet"""
+        makedirs(self.directory, exist_ok=True)
+        for i, path in enumerate(self.paths_files):
+            if not exists(path):
+                make_paths_file(path, self.word_count, self.leaf_count, self.depth, self.seed + i)
+        for i, path in enumerate(self.pair_paths_files):
+            if not exists(path):
+                make_paths_file(path, self.pair_word_count, self.leaf_count, self.depth, self.seed + i)
+        if not exists(self.text_file):
+            make_text_file(self.text_file, self.text_bytes, self.word_count, self.seed)
+        if not exists(self.csv_file) or not exists(self.inverted_csv_file):
+            from analysis import ScoreCsvWriter
+            from multiTree import MultiTreeBuilder
+            multi_builder = MultiTreeBuilder(self.pair_paths_files)
+            multi_builder.build_all()
+            # inverted with score_upper_bound like multiTree.py --invert, which only depends
+            # on the trees' depths, not on which scores came out highest
+            with ScoreCsvWriter(self.csv_file, self.inverted_csv_file, multi_builder.score_upper_bound(), delimiter='\t') as csv_writer:
+                csv_writer.writerows(multi_builder.vectorized_pairwise_score())
+
+    def multi_builder(self, pairs=False):
+        from multiTree import MultiTreeBuilder
+        multi_builder = MultiTreeBuilder(self.pair_paths_files if pairs else self.paths_files)
+        multi_builder.build_all()
+        return multi_builder
+
+
+### Benchmarks
+# A benchmark takes a BenchmarkData, does any setup that shouldn't be timed, and returns
+# (run, work) where run() is the part to time and work is how many units it processes.
+
+BENCHMARKS = dict()
+
+def benchmark(name, unit, pairs=False):
+    """Registers the decorated function as a benchmark called name, whose work is counted in
+    unit. pairs benchmarks run on the smaller pair vocabulary, once for all sizes."""
+    def register(f):
+        BENCHMARKS[name] = (f, unit, pairs)
+        return f
+    return register
+
+@benchmark('clean_line', 'MB')
+def bench_clean_line(data):
+    from cleanInput import clean_line
+    with open(data.text_file) as f:
+        lines = f.readlines()
+    return lambda: list(map(clean_line, lines)), getsize(data.text_file) / (1 << 20)
+
+@benchmark('clean_corpus', 'MB')
+def bench_clean_corpus(data):
+    from cleanInput import clean_corpus, get_file_line_iter
+    target = join(data.directory, 'cleaned-corpus.txt')
+    return lambda: clean_corpus(get_file_line_iter(data.text_file), target), getsize(data.text_file) / (1 << 20)
+
+@benchmark('build_tree', 'words')
+def bench_build_tree(data):
+    from clusterTree import TreeBuilder
+    return lambda: TreeBuilder(data.paths_files[0]).build_tree(), data.word_count
+
+@benchmark('bulk_build_tree', 'words')
+def bench_bulk_build_tree(data):
+    from clusterTree import TreeBuilder
+    return lambda: TreeBuilder(data.paths_files[0]).bulk_build_tree(), data.word_count
+
+@benchmark('bitstring_pair_scores', 'leaf pairs')
+def bench_bitstring_pair_scores(data):
+    multi_builder = data.multi_builder()
+    leaf_pairs = sum(len(b.leaf_paths) * (len(b.leaf_paths) + 1) // 2 for b in multi_builder.tree_builders.values())
+    return multi_builder.bitstring_pair_scores, leaf_pairs
+
+@benchmark('leaf_score_matrices', 'leaf pairs')
+def bench_leaf_score_matrices(data):
+    multi_builder = data.multi_builder()
+    leaf_pairs = sum(len(b.leaf_paths) ** 2 for b in multi_builder.tree_builders.values())
+    return multi_builder.leaf_score_matrices, leaf_pairs
+
+def word_pairs(data):
+    return data.pair_word_count * (data.pair_word_count - 1) // 2
+
+@benchmark('pairwise_score', 'pairs', pairs=True)
+def bench_pairwise_score(data):
+    multi_builder = data.multi_builder(pairs=True)
+    bitstring_pair_scores = multi_builder.bitstring_pair_scores()
+    def run():
+        for _ in multi_builder.pairwise_score(bitstring_pair_scores):
+            pass
+    return run, word_pairs(data)
+
+@benchmark('vectorized_pairwise_score', 'pairs', pairs=True)
+def bench_vectorized_pairwise_score(data):
+    multi_builder = data.multi_builder(pairs=True)
+    score_matrices = multi_builder.leaf_score_matrices()
+    def run():
+        for _ in multi_builder.vectorized_pairwise_score(score_matrices):
+            pass
+    return run, word_pairs(data)
+
+@benchmark('write_csv', 'pairs', pairs=True)
+def bench_write_csv(data):
+    import numpy as np
+    from analysis import ScoreCsvWriter, ScoreHistogram
+    multi_builder = data.multi_builder(pairs=True)
+    target = join(data.directory, 'written.csv')
+    def run():
+        # the same as multiTree.py's serial csv output: batches of analyse_results through a
+        # ScoreCsvWriter, counting them into a histogram for the buckets
+        histogram = ScoreHistogram()
+        with ScoreCsvWriter(target, delimiter='\t') as csv_writer, redirect_stdout(StringIO()):
+            results = multi_builder.analyse_results()
+            while batch := list(islice(results, 1 << 14)):
+                csv_writer.writerows(batch)
+                histogram.add_many(np.fromiter((score for _, _, score in batch), dtype=np.int64, count=len(batch)))
+    return run, word_pairs(data)
+
+@benchmark('make_buckets', 'pairs', pairs=True)
+def bench_make_buckets(data):
+    from analysis import make_buckets
+    def run():
+        with redirect_stdout(StringIO()):
+            make_buckets(data.inverted_csv_file)
+    return run, word_pairs(data)
+
+@benchmark('make_globs', 'pairs', pairs=True)
+def bench_make_globs(data):
+    from analysis import make_globs, ScoreHistogram
+    # glob the closest 5% of pairs
+    threshold = ScoreHistogram.from_file(data.inverted_csv_file).quantile(.05)
+    def run():
+        with redirect_stdout(StringIO()):
+            make_globs(data.inverted_csv_file, threshold)
+    return run, word_pairs(data)
+
+
+### Running
+
+# the results the suite is compared to by default. rerun with -o pointed at it to update it
+BASELINE_PATH = join(dirname(abspath(__file__)), 'benchmark-baseline.json')
+
+def peak_rss_mb():
+    """The peak resident set size of this process so far, in MB"""
+    peak = getrusage(RUSAGE_SELF).ru_maxrss
+    # linux reports KB, macOS bytes
+    return peak / (1 << 20) if sys_platform == 'darwin' else peak / (1 << 10)
+
+def run_benchmark(name, data, repeat):
+    """Runs the benchmark called name on data repeat times, in this process. Returns a dict of
+    the best wall time, the peak RSS and the throughput."""
+    f, unit, _ = BENCHMARKS[name]
+    # mostly the interpreter and imports, to tell apart from what the benchmark uses
+    start_rss = peak_rss_mb()
+    run, work = f(data)
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        run()
+        times.append(perf_counter() - start)
+    best = min(times)
+    return {
+        'seconds': best,
+        'mean_seconds': sum(times) / len(times),
+        'peak_rss_mb': peak_rss_mb(),
+        'start_rss_mb': start_rss,
+        'work': work,
+        'unit': unit,
+        'throughput': work / best if best else None,
+    }
+
+def run_isolated(name, data, repeat):
+    """Runs the benchmark in a fresh process, so its peak RSS is its own"""
+    with get_context('spawn').Pool(1) as pool:
+        return pool.apply(run_benchmark, (name, data, repeat))
+
+def run_suite(names, sizes, pair_word_count, leaf_count, depth, tree_count, text_mb, repeat, seed, directory):
+    """Runs the benchmarks in names on data for each vocabulary size in sizes (the pairs
+    benchmarks only run for the first size). Returns the results, keyed by
+    'name[words]'."""
+    results = dict()
+    for n, size in enumerate(sizes):
+        data = BenchmarkData(join(directory, f'w{size}'), size, pair_word_count, leaf_count, depth,
+                             tree_count, int(text_mb * (1 << 20)), seed)
+        print(f'Making data for {size:,} words...')
+        data.make()
+        for name in names:
+            pairs = BENCHMARKS[name][2]
+            if pairs and n > 0:
+                continue
+            key = f'{name}[{data.pair_word_count if pairs else size}]'
+            result = run_isolated(name, data, repeat)
+            results[key] = result
+            print(f'{key:<36} {result["seconds"]:>9.4f}s {result["peak_rss_mb"]:>8.1f}MB '
+                  f'{result["throughput"] or 0:>14,.1f} {result["unit"]}/s')
+    return results
+
+def compare(results, baseline, tolerance):
+    """Prints the change in time and peak RSS of each result from the baseline results.
+    Returns the keys that got slower or used more memory than the baseline by more than
+    tolerance (a fraction)."""
+    regressions = []
+    print(f'{"benchmark":<36} {"time":>9} {"change":>8} {"rss":>9} {"change":>8}')
+    for key, result in results.items():
+        if key not in baseline:
+            print(f'{key:<36} {result["seconds"]:>8.4f}s {"new":>8}')
+            continue
+        time_ratio = result['seconds'] / baseline[key]['seconds'] if baseline[key]['seconds'] else 1
+        rss_ratio = result['peak_rss_mb'] / baseline[key]['peak_rss_mb'] if baseline[key]['peak_rss_mb'] else 1
+        regressed = time_ratio > 1 + tolerance or rss_ratio > 1 + tolerance
+        if regressed:
+            regressions.append(key)
+        print(f'{key:<36} {result["seconds"]:>8.4f}s {time_ratio - 1:>+8.1%} {result["peak_rss_mb"]:>7.1f}MB {rss_ratio - 1:>+8.1%}'
+              f'{"  REGRESSED" if regressed else ""}')
+    return regressions
+
+
+if __name__ == "__main__":
+    sizes_flag = LiteralFlag('s', 'sizes', 'Vocabulary sizes to run at', default_value=[1000, 10000, 100000])
+    pairs_flag = LiteralFlag('p', 'pair-words', 'Vocabulary size for the\npairwise benchmarks', default_value=1000)
+    leaves_flag = LiteralFlag('l', 'leaves', 'Leaves in each tree', default_value=200)
+    depth_flag = LiteralFlag('d', 'depth', 'Max depth of each tree', default_value=24)
+    trees_flag = LiteralFlag('t', 'trees', 'Trees to compare', default_value=3)
+    text_flag = LiteralFlag('m', 'text-mb', 'Size of the corpus for\nthe cleaner benchmarks', default_value=4)
+    repeat_flag = LiteralFlag('r', 'repeat', 'Runs of each benchmark\n(the best is kept)', default_value=3)
+    names_flag = LiteralFlag('n', 'names', 'List of benchmarks to run\n(default: all)', default_value=list(BENCHMARKS))
+    output_flag = LiteralFlag('o', 'output', 'Where to write the results', default_value='./benchmark-results.json')
+    baseline_flag = LiteralFlag('b', 'baseline', 'Results file to compare to', default_value=BASELINE_PATH)
+    tolerance_flag = LiteralFlag('x', 'tolerance', 'Slowdown (fraction) that\ncounts as a regression', default_value=.2)
+    keep_flag = LiteralFlag('k', 'keep', 'Directory to make the data in\nand keep it (default: a temp\ndirectory)')
+    help_flag = Flag('h', 'help', 'Shows this prompt')
+    flags = [sizes_flag, pairs_flag, leaves_flag, depth_flag, trees_flag, text_flag, repeat_flag,
+             names_flag, output_flag, baseline_flag, tolerance_flag, keep_flag, help_flag]
+
+    def print_help():
+        print('--- Help ---------------------------------------------')
+        print('\tTimes the cleaning and tree scoring code on\n\tsynthetic data, writes the results as json\n\tand compares them to the stored baseline\n\t(benchmark-baseline.json) or another results file')
+        print('\tBenchmarks: ' + ', '.join(BENCHMARKS))
+        for flag in flags:
+            print(flag.format_description(4, 20))
+        print('------------------------------------------------------')
+
+    args = Flag.get_terminal_args()
+
+    if help_flag.remove_from_args(args):
+        print_help()
+        exit()
+
+    for flag in flags:
+        flag.remove_from_args(args)
+
+    if args:
+        print_help()
+        raise ValueError('Unknown args: ', *args)
+
+    unknown = [name for name in names_flag.value if name not in BENCHMARKS]
+    if unknown:
+        print_help()
+        raise ValueError('Unknown benchmarks: ', *unknown)
+
+    # read first, so writing the output over the baseline (to update it) still compares to the old one
+    baseline = None
+    if exists(baseline_flag.value):
+        with open(baseline_flag.value) as f:
+            baseline = load(f)
+    else:
+        print(f'No baseline at {baseline_flag.value}, so nothing to compare to')
+
+    directory = keep_flag.value or mkdtemp(prefix='benchmark-')
+    try:
+        results = run_suite(names_flag.value, sizes_flag.value, pairs_flag.value, leaves_flag.value,
+                            depth_flag.value, trees_flag.value, text_flag.value, repeat_flag.value,
+                            0, directory)
+    finally:
+        if keep_flag.value is None:
+            rmtree(directory, ignore_errors=True)
+
+    config = { 'sizes': sizes_flag.value, 'pair_words': pairs_flag.value, 'leaves': leaves_flag.value,
+               'depth': depth_flag.value, 'trees': trees_flag.value, 'text_mb': text_flag.value,
+               'repeat': repeat_flag.value }
+    with open(output_flag.value, 'w+') as f:
+        dump({
+            'time': strftime('%Y-%m-%d %H:%M:%S'),
+            'python': python_version(),
+            'platform': platform(),
+            'config': config,
+            'results': results,
+        }, f, indent=2)
+    print(f'wrote results to {output_flag.value}')
+
+    if baseline is not None:
+        print(f'Compared to {baseline_flag.value} ({baseline["time"]}, python {baseline["python"]}):')
+        if baseline['config'] != config:
+            print(f'\tit was run with {baseline["config"]}, so only the benchmarks at the same sizes compare')
+        if regressions := compare(results, baseline['results'], tolerance_flag.value):
+            print(f'{len(regressions)} regressions against {baseline_flag.value}')
+            exit(1)
@@ -1,8 +1,22 @@
-from os.path import abspath, exists, split, join
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from hashlib import sha1
+from heapq import merge
+from io import BytesIO, TextIOWrapper
+from itertools import chain, groupby
+from json import dump, load
+from locale import getpreferredencoding
+from os import cpu_count, remove
+from os.path import abspath, exists, getsize, split, splitext, join
 from sys import exit, stderr
-from re import compile, sub
+from re import compile
+from tempfile import mkstemp
+from time import time
+from zlib import crc32
 
-from terminalHelpers import Flag
+from fileHelpers import atomic_write
+from terminalHelpers import Flag, LiteralFlag
 
 class CleanerPrinter:
     """A class for grouping together the console output behavior of the cleaning program"""
@@ -40,10 +54,14 @@ f"""---  input cleaner help --------------------------------------
             exit(1)
     
     @staticmethod
-    def print_success():
+    def print_success(byte_count=None, seconds=None):
+        throughput = ''
+        if byte_count is not None and seconds:
+            mb = byte_count / (1 << 20)
+            throughput = f"\n\tCleaned {mb:,.1f} MB in {seconds:.2f}s ({mb / seconds:,.1f} MB/s)"
         print(
             "---  input cleaner success -----------------------------------\n\t" + 
-            "File Written!" +
+            "File Written!" + throughput +
             "\n--------------------------------------------------------------")
 
 
@@ -65,20 +83,35 @@ def first(_iter: iter, pred=lambda item: True):
     return next(filter(pred, _iter), None)
 
 def parse_commandline_args():
-    """Gets the command line args when called, and parses them. Returns an iterable of the 
-    lines for the file to read, and the path of the file to write cleaned lines to.
+    """Gets the command line args when called, and parses them. Returns the path of the
+    file to read, the path of the file to write cleaned lines to, how many
+    processes to clean with, the min count to keep a word, the path to write
+    the vocabulary to (or None), and whether to only clean what changed.
     
     Will call sys.exit if there is a formatting error."""
     
     # flags for this program
+    jobs_flag = LiteralFlag('j', 'jobs', 'How many processes to clean with \n(default: 1, or all cores if no \nnumber is given)', default_value=1)
+    min_count_flag = LiteralFlag('m', 'min-count', f'Replaces words seen fewer times \nthan this with {UNKNOWN_WORD} \n(implies --vocab)', default_value=1)
     flags = [
         Flag('h', 'help', 'Displays this help prompt'),
         Flag('w', 'write', 'If set, overwrites the input file \ninstead of making a new one'),
-        Flag('f', 'force', 'Runs without further input, \nusing defaults where necessary')
+        Flag('f', 'force', 'Runs without further input, \nusing defaults where necessary'),
+        Flag('v', 'vocab', 'Also writes the words of the cleaned \nfile, most common first, to a .vocab \nfile for wcluster --restrict'),
+        Flag('i', 'incremental', 'Only cleans the parts of the input \nthat changed since the last \nincremental run'),
+        jobs_flag,
+        min_count_flag
     ]
 
     args = Flag.get_terminal_args()
-    
+
+    # a bare --jobs means all the cores
+    for jobs_arg in [jobs_flag.proper_flag, jobs_flag.proper_long_flag]:
+        if jobs_arg in args:
+            i = args.index(jobs_arg) + 1
+            if i == len(args) or args[i].startswith('-') or not args[i].isdigit():
+                args.insert(i, str(cpu_count()))
+
     # read the flag data as { longForm: T/F }, removing identified flags from args
     # as it constructs set_flags
     set_flags = { flag.longForm: flag.remove_from_args(args) for flag in flags }
@@ -105,12 +138,16 @@ def parse_commandline_args():
     # use os.abspath to resolve
     potential_path = abspath(potential_path)
 
-    # if it exists, get the file line iterator, otherwise raise exception    
-    if exists(potential_path):
-        file_lines = get_file_line_iter(potential_path)
-    else:
+    # if it doesn't exist, raise exception
+    if not exists(potential_path):
         CleanerPrinter.raise_error(f'Unkown file! \n\t{potential_path}')
 
+    if not isinstance(jobs_flag.value, int) or jobs_flag.value < 1:
+        CleanerPrinter.raise_error('The jobs flag must be followed by a positive int.')
+
+    if not isinstance(min_count_flag.value, int) or min_count_flag.value < 1:
+        CleanerPrinter.raise_error('The min-count flag must be followed by a positive int.')
+
     # raises error on unknown flags/options (which would be all remaining args)
     if args:
         plural = 's' if len(args) > 1 else ''
@@ -126,12 +163,24 @@ def parse_commandline_args():
     
     destination_file_path = potential_path if do_overwrite_old else get_cleaned_file_name(potential_path)
 
-    return file_lines, destination_file_path
+    vocab_path = None
+    if set_flags['vocab'] or min_count_flag.value > 1:
+        vocab_path = splitext(destination_file_path)[0] + '.vocab'
+
+    if set_flags['incremental'] and destination_file_path == potential_path:
+        CleanerPrinter.raise_error('An incremental run can not overwrite the input file.')
+
+    if set_flags['incremental'] and min_count_flag.value > 1:
+        CleanerPrinter.raise_error('An incremental run can not use --min-count, since the\ncleaned file is patched and must keep every word.\nPrune it with a separate run instead.')
+
+    return potential_path, destination_file_path, jobs_flag.value, min_count_flag.value, vocab_path, set_flags['incremental']
 
 def write_file(path, line_iter: iter):
     """Writes the lines in line_iter to the file at path, or creates a new
-    one if it is not present. Closes the file on completion."""
-    with open(path, 'w+') as target_file:
+    one if it is not present. Closes the file on completion.
+
+    Writes with atomic_write, so line_iter may still be reading the old file at path."""
+    with atomic_write(path) as target_file:
         target_file.writelines(line_iter)
 
 # the regex for identifying bunches of punctuation.
@@ -143,15 +192,412 @@ punctuation_cleaning_regex = compile(r'([^\w\s]+)\s*')
 punctuation_sub_regex = r' \g<1> '
 def clean_line(line):
     """Spaces out each bunch of symbols, and terminates with a single newline."""
-    cleaned = sub(punctuation_cleaning_regex, punctuation_sub_regex, line).strip()
+    cleaned = punctuation_cleaning_regex.sub(punctuation_sub_regex, line).strip()
     return cleaned.replace(r'"', r"'") + '\n'
 
-def clean_corpus(file_lines: iter, target_path):
+def clean_corpus(file_lines: iter, target_path, counter=None):
     """Cleans each line in file_lines, and writes to the target_path. Creates
-    a new file if no such file at target_path exists."""
-    write_file(target_path, map(clean_line, file_lines))
+    a new file if no such file at target_path exists.
+
+    Counts the words of the cleaned lines in counter, if given."""
+    cleaned_lines = map(clean_line, file_lines)
+    if counter is not None:
+        cleaned_lines = counter.count_lines(cleaned_lines)
+    write_file(target_path, cleaned_lines)
+
+def get_chunk_ranges(path, chunk_size):
+    """Splits the file at path into (start, stop) byte ranges of about chunk_size,
+    each ending just after a newline (or at the end of the file)."""
+    size = getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size) - 1)
+            # finish the line the seek landed in
+            f.readline()
+            stop = min(f.tell(), size)
+            ranges.append((start, stop))
+            start = stop
+    return ranges
+
+def get_content_chunk_ranges(path, chunk_size, block_size=1 << 24):
+    """Splits the file at path into (start, stop) byte ranges like get_chunk_ranges, but
+    cuts after lines picked by a hash of them and the line before, instead of at fixed
+    offsets. So an edit only moves the cuts next to it, and the chunks after it keep their
+    bytes. A line is picked with a chance of its length in chunk_size, so chunks are about
+    chunk_size long, and they are kept between chunk_size // 4 and 4 * chunk_size."""
+    min_size, max_size = chunk_size // 4, 4 * chunk_size
+    ranges = []
+    # where the current chunk and the next line start, and the crc32 of the last line
+    start = position = previous = 0
+    rest = b''
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            line_crcs = list(map(crc32, lines))
+            # crc32(line, crc32(previous line)) is the crc32 of the two lines together
+            for length, line_hash in zip(map(len, lines), map(crc32, lines, [previous] + line_crcs[:-1])):
+                position += length + 1
+                size = position - start
+                if size >= max_size or size >= min_size and line_hash % chunk_size <= length:
+                    ranges.append((start, position))
+                    start = position
+            if line_crcs:
+                previous = line_crcs[-1]
+    position += len(rest)
+    if start < position:
+        ranges.append((start, position))
+    return ranges
+
+def clean_chunk(path, start, stop, count=False):
+    """Cleans the lines in bytes start to stop of the file at path, returning them
+    as one string. Lines are decoded the same way get_file_line_iter reads them.
+
+    If count is true, returns the string and a Counter of its words."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        raw = f.read(stop - start)
+    lines = TextIOWrapper(BytesIO(raw), encoding=getpreferredencoding(False))
+    cleaned = ''.join(map(clean_line, lines))
+    return (cleaned, Counter(cleaned.split())) if count else cleaned
+
+def clean_chunks(path, ranges, jobs, count=False):
+    """Yields clean_chunk(path, start, stop, count) for each (start, stop) in ranges, in
+    order, using jobs processes."""
+    if jobs == 1:
+        for start, stop in ranges:
+            yield clean_chunk(path, start, stop, count)
+        return
+    with ProcessPoolExecutor(jobs) as pool:
+        # keep a few chunks per process in flight, so memory stays bounded when the
+        # file is much bigger than jobs * chunk_size
+        in_flight = []
+        for start, stop in ranges:
+            in_flight.append(pool.submit(clean_chunk, path, start, stop, count))
+            if len(in_flight) > 2 * jobs:
+                yield in_flight.pop(0).result()
+        while in_flight:
+            yield in_flight.pop(0).result()
+
+def clean_corpus_parallel(source_path, target_path, jobs, counter=None, chunk_size=1 << 22):
+    """Cleans the file at source_path like clean_corpus, with jobs processes each cleaning
+    a chunk of about chunk_size bytes at a time. Chunks are written in order.
+
+    Counts the words of the cleaned lines in counter, if given (each process
+    counts its own chunks)."""
+    chunks = clean_chunks(source_path, get_chunk_ranges(source_path, chunk_size), jobs, counter is not None)
+    if counter is not None:
+        chunks = counter.count_chunks(chunks)
+    write_file(target_path, chunks)
+
+
+# the word rare words are replaced with
+UNKNOWN_WORD = '<unk>'
+# a word, any run of non-whitespace
+word_regex = compile(r'\S+')
+
+class WordCounter:
+    """Counts words, keeping at most max_words distinct ones in memory. Once it has more,
+    the counts so far are spilled to a sorted file on disk and counting starts over;
+    items() merges the spilled files back together."""
+
+    def __init__(self, max_words=1 << 22, spill_dir=None):
+        self.max_words = max_words
+        self.spill_dir = spill_dir
+        self.counts = Counter()
+        self.spill_paths = []
+
+    def add(self, words):
+        """Counts each word in words"""
+        self.counts.update(words)
+        if len(self.counts) > self.max_words:
+            self.spill()
+
+    def add_counts(self, counts):
+        """Adds a mapping of { word: count } to the counts"""
+        self.counts.update(counts)
+        if len(self.counts) > self.max_words:
+            self.spill()
+
+    def count_lines(self, lines):
+        """Counts the words of each line in lines, yielding the lines"""
+        for line in lines:
+            self.add(line.split())
+            yield line
+
+    def count_chunks(self, chunks):
+        """Takes (text, Counter) pairs like clean_chunk makes, adding the counts
+        and yielding the text"""
+        for text, counts in chunks:
+            self.add_counts(counts)
+            yield text
+
+    def spill(self):
+        """Writes the counts in memory to a sorted file, then clears them"""
+        handle, path = mkstemp(suffix='.counts', dir=self.spill_dir)
+        with open(handle, 'w', encoding='utf8') as f:
+            # words come from str.split, so they never hold a tab or newline
+            f.writelines(f'{word}\t{count}\n' for word, count in sorted(self.counts.items()))
+        self.spill_paths.append(path)
+        self.counts = Counter()
+
+    @staticmethod
+    def read_spill(path):
+        with open(path, encoding='utf8') as f:
+            for line in f:
+                word, count = line.rstrip('\n').split('\t')
+                yield word, int(count)
+
+    def items(self):
+        """Yields (word, count) for every word counted. Words come in sorted order
+        if any counts were spilled, otherwise in the order they were first seen."""
+        if not self.spill_paths:
+            yield from self.counts.items()
+            return
+        runs = [WordCounter.read_spill(path) for path in self.spill_paths]
+        runs.append(iter(sorted(self.counts.items())))
+        for word, group in groupby(merge(*runs), key=lambda item: item[0]):
+            yield word, sum(count for _, count in group)
+
+    def close(self):
+        """Deletes the spilled files"""
+        for path in self.spill_paths:
+            remove(path)
+        self.spill_paths = []
+
+def replace_rare_words(lines, kept_words: set):
+    """Yields each line in lines with the words not in the set kept_words replaced by
+    UNKNOWN_WORD. The spacing of each line is kept."""
+    keep_or_replace = lambda match: match.group() if match.group() in kept_words else UNKNOWN_WORD
+    for line in lines:
+        # most lines have no rare words, and checking is much cheaper than substituting
+        if kept_words.issuperset(line.split()):
+            yield line
+        else:
+            yield word_regex.sub(keep_or_replace, line)
+
+def read_vocab_run(path):
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            word, count, order = line.rstrip('\n').split('\t')
+            yield word, int(count), int(order)
+
+def sort_by_count(word_counts, max_words=1 << 22, spill_dir=None):
+    """Yields the words of the (word, count, order) triples in word_counts, most common
+    first and by order among equal counts. At most max_words triples are kept in memory:
+    each max_words of them are sorted into a run on disk, and the runs merged."""
+    key = lambda item: (-item[1], item[2])
+    run_paths, batch = [], []
+    try:
+        for item in word_counts:
+            batch.append(item)
+            if len(batch) >= max_words:
+                batch.sort(key=key)
+                handle, path = mkstemp(suffix='.vocab', dir=spill_dir)
+                run_paths.append(path)
+                with open(handle, 'w', encoding='utf8') as f:
+                    f.writelines(f'{word}\t{count}\t{order}\n' for word, count, order in batch)
+                batch = []
+        batch.sort(key=key)
+        runs = [read_vocab_run(path) for path in run_paths]
+        runs.append(iter(batch))
+        for word, _, _ in merge(*runs, key=key):
+            yield word
+    finally:
+        for path in run_paths:
+            remove(path)
+
+def write_vocab(path, word_counts, max_words=1 << 22, spill_dir=None):
+    """Writes the words of the (word, count, order) triples in word_counts one per line,
+    most common first (see sort_by_count), in a form wcluster --restrict can read"""
+    with open(path, 'w+') as f:
+        f.writelines(word + '\n' for word in sort_by_count(word_counts, max_words, spill_dir))
+
+def prune_corpus(target_path, counter, min_count, vocab_path):
+    """Replaces the words in the cleaned file at target_path that counter saw fewer than
+    min_count times with UNKNOWN_WORD, and writes the vocabulary of the result to
+    vocab_path. Returns (words in the vocabulary, tokens replaced).
+
+    The counts are merged once, and that one pass both writes the vocabulary and
+    collects the words to keep (which only min_count > 1 needs)."""
+    kept = set()
+    word_count, replaced, unknown = 0, 0, None
+
+    def kept_counts():
+        nonlocal word_count, replaced, unknown
+        order = -1
+        for order, (word, count) in enumerate(counter.items()):
+            if count < min_count:
+                replaced += count
+            elif word == UNKNOWN_WORD:
+                # it gains the replaced tokens, which are only all known at the end
+                unknown = count, order
+            else:
+                word_count += 1
+                if min_count > 1:
+                    kept.add(word)
+                yield word, count, order
+        if unknown or replaced:
+            count, order = unknown or (0, order + 1)
+            word_count += 1
+            yield UNKNOWN_WORD, count + replaced, order
+
+    write_vocab(vocab_path, kept_counts(), counter.max_words, counter.spill_dir)
+    if replaced:
+        write_file(target_path, replace_rare_words(get_file_line_iter(target_path), kept))
+    return word_count, replaced
+
+# bump when the manifest layout changes, so old manifests are ignored
+MANIFEST_VERSION = 2
+
+def get_manifest_path(target_path):
+    """Where an incremental run keeps what it knows about the cleaned file at target_path"""
+    return target_path + '.manifest.json'
+
+def get_counts_path(target_path):
+    """Where an incremental run keeps the word counts of the cleaned file at target_path"""
+    return splitext(target_path)[0] + '.counts'
+
+def hash_range(f, start, stop):
+    """sha1 hex digest of bytes start to stop of the binary file f"""
+    f.seek(start)
+    return sha1(f.read(stop - start)).hexdigest()
+
+def load_manifest(target_path, chunk_size):
+    """Returns the chunks in the manifest of the cleaned file at target_path, each as
+    [start, stop, sha1, cleaned_start, cleaned_stop], or None if there is no manifest
+    or it doesn't match the cleaned file as it is now."""
+    manifest_path = get_manifest_path(target_path)
+    if not exists(manifest_path) or not exists(target_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = load(f)
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('chunk_size') != chunk_size:
+        return None
+    # something else has written the cleaned file since
+    if manifest.get('cleaned_size') != getsize(target_path):
+        return None
+    return manifest['chunks']
+
+def write_manifest(target_path, chunk_size, chunks):
+    with open(get_manifest_path(target_path), 'w+') as f:
+        dump({ 'version': MANIFEST_VERSION, 'chunk_size': chunk_size,
+               'cleaned_size': getsize(target_path), 'chunks': chunks }, f)
+
+def read_counts(path):
+    """Reads the { word: count } Counter written by write_counts"""
+    return Counter(dict(WordCounter.read_spill(path)))
+
+def write_counts(path, counts):
+    with open(path, 'w+', encoding='utf8') as f:
+        f.writelines(f'{word}\t{count}\n' for word, count in sorted(counts.items()))
+
+def clean_corpus_incremental(source_path, target_path, jobs, counts_path=None, chunk_size=1 << 22):
+    """Cleans the file at source_path like clean_corpus_parallel, but only the chunks that
+    are new or changed since the last incremental run; the rest are copied from the old
+    cleaned file at target_path. A manifest of each chunk's byte range, checksum and
+    place in the cleaned file is kept next to target_path. The chunks are cut where the
+    text says (see get_content_chunk_ranges) and matched by checksum, so an edit anywhere
+    only cleans the chunks around it again, not every chunk after it.
+
+    If counts_path is given, the word counts of the cleaned file are kept there, adding
+    the counts of the chunks cleaned and taking out those of the chunks they replace.
+    Returns (chunks cleaned, chunk count, the counts or None)."""
+    ranges = get_content_chunk_ranges(source_path, chunk_size)
+    with open(source_path, 'rb') as f:
+        hashes = [hash_range(f, start, stop) for start, stop in ranges]
+
+    old_chunks = load_manifest(target_path, chunk_size)
+    counts = None
+    if counts_path is not None:
+        if old_chunks is not None and exists(counts_path):
+            counts = read_counts(counts_path)
+        else:
+            # the counts can't be patched, so clean everything again
+            counts, old_chunks = Counter(), None
+    # the chunks move when text is added or taken out before them, so they are matched by
+    # checksum alone. a chunk that is there more than once is matched in order
+    old_places = defaultdict(list)
+    for _, _, digest, cleaned_start, cleaned_stop in reversed(old_chunks or []):
+        old_places[digest].append((cleaned_start, cleaned_stop))
+
+    # where each chunk is in the old cleaned file, or None if it has to be cleaned
+    reused = [old_places[digest].pop() if old_places.get(digest) else None for digest in hashes]
+    changed = [r for r, old in zip(ranges, reused) if old is None]
+    encoding = getpreferredencoding(False)
+
+    # the chunks that are still at the start of the old cleaned file
+    prefix, prefix_stop = 0, 0
+    while prefix < len(reused) and reused[prefix] is not None and reused[prefix][0] == prefix_stop:
+        prefix_stop = reused[prefix][1]
+        prefix += 1
+    # when text is only appended to the input, the cleaned file just needs its
+    # tail cut off and the new chunks appended, instead of being copied
+    in_place = all(old is None for old in reused[prefix:])
+
+    with open(target_path, 'ab+') as old_file:
+        if counts is not None:
+            # take out the counts of the old chunks that are gone
+            for cleaned_start, cleaned_stop in chain.from_iterable(old_places.values()):
+                old_file.seek(cleaned_start)
+                counts.subtract(old_file.read(cleaned_stop - cleaned_start).decode(encoding).split())
+
+        with nullcontext(old_file) if in_place else atomic_write(target_path, 'wb+') as new_file:
+            if in_place:
+                # the manifest is wrong from here on, so don't leave it behind if cleaning fails
+                if exists(get_manifest_path(target_path)):
+                    remove(get_manifest_path(target_path))
+                old_file.truncate(prefix_stop)
+
+            new_chunks = clean_chunks(source_path, changed, jobs, counts is not None)
+            chunks = []
+            for i, ((start, stop), digest, old) in enumerate(zip(ranges, hashes, reused)):
+                if in_place and i < prefix:
+                    cleaned_start, cleaned_stop = old
+                else:
+                    new_file.seek(0, 2)
+                    cleaned_start = new_file.tell()
+                    if old is not None:
+                        old_file.seek(old[0])
+                        new_file.write(old_file.read(old[1] - old[0]))
+                    else:
+                        cleaned = next(new_chunks)
+                        if counts is not None:
+                            cleaned, chunk_counts = cleaned
+                            counts.update(chunk_counts)
+                        new_file.write(cleaned.encode(encoding))
+                    cleaned_stop = new_file.tell()
+                chunks.append([start, stop, digest, cleaned_start, cleaned_stop])
+
+    write_manifest(target_path, chunk_size, chunks)
+    if counts is not None:
+        # drop the words whose counts were all taken out
+        counts = +counts
+        write_counts(counts_path, counts)
+    return len(changed), len(ranges), counts
 
 if __name__ == "__main__":
     if parse_result := parse_commandline_args():
-        clean_corpus(*parse_result)
-        CleanerPrinter.print_success()
+        source_path, destination_file_path, jobs, min_count, vocab_path, incremental = parse_result
+        byte_count, start = getsize(source_path), time()
+        counter = WordCounter() if vocab_path and not incremental else None
+        if incremental:
+            counts_path = get_counts_path(destination_file_path) if vocab_path else None
+            cleaned, chunk_count, counts = clean_corpus_incremental(source_path, destination_file_path, jobs, counts_path)
+            print(f'{cleaned:,} of {chunk_count:,} chunks cleaned')
+            if counts is not None:
+                write_vocab(vocab_path, ((word, count, order) for order, (word, count) in enumerate(counts.items())))
+                print(f'{len(counts):,} words written to {vocab_path}')
+        elif jobs > 1:
+            clean_corpus_parallel(source_path, destination_file_path, jobs, counter)
+        else:
+            clean_corpus(get_file_line_iter(source_path), destination_file_path, counter)
+        if counter is not None:
+            try:
+                kept, replaced = prune_corpus(destination_file_path, counter, min_count, vocab_path)
+            finally:
+                counter.close()
+            print(f'{kept:,} words written to {vocab_path}, {replaced:,} rare tokens replaced with {UNKNOWN_WORD}')
+        CleanerPrinter.print_success(byte_count, time() - start)
@@ -1,4 +1,10 @@
 #!/usr/bin/env python3
+from collections import defaultdict
+from itertools import filterfalse
+from os.path import commonprefix
+
+import numpy as np
+
 class TreeNode:
     def __init__(self, label):
         self.label = label
@@ -48,13 +54,10 @@ class TreeNode:
         >>>     right = TreeNode.str_to_right(c)
         >>>     current = current[right]
         >>> return current"""
-        if not path:
-            return self
-
-        first, rest = path[0], path[1:]
-        right = TreeNode.str_to_right(first)
-
-        return self.force_child(right).walk_with_bitstring(rest)
+        current = self
+        for c in path:
+            current = current.force_child(TreeNode.str_to_right(c))
+        return current
 
     def add_word(self, word, count):
         """Adds (word, count) to self.words"""
@@ -62,14 +65,20 @@ class TreeNode:
 
     def compute_weight(self):
         """ Counts how many leaf nodes have this as an ancestor, and saves that
-        as self.value. (Runs recursively, so all descendants will also have self.value set.)"""
-        value = sum(c for _, c in self.words)
-        if self.right_child:
-            value += self.right_child.compute_weight()
-        if self.left_child:
-            value += self.left_child.compute_weight()
-        self.value = value
-        return value
+        as self.value. (All descendants will also have self.value set.)"""
+        # collect the nodes in pre-order, then sum them up in reverse so that
+        # every child is done before its parent
+        nodes = [self]
+        for node in nodes:
+            nodes.extend(child for child in (node.right_child, node.left_child) if child)
+        for node in reversed(nodes):
+            value = sum(c for _, c in node.words)
+            if node.right_child:
+                value += node.right_child.value
+            if node.left_child:
+                value += node.left_child.value
+            node.value = value
+        return self.value
 
     def __str__(self):
         s = "TreeNode " + self.label
@@ -94,31 +103,48 @@ class TreeNode:
         raise ValueError('s must be a 0 or 1 (bitstring char)')
 
     def pretty_format(self, digitsLen=None, joinLines=True):
-        """ Recursively computes the pretty formatting for this node and all descendants.
+        """ Computes the pretty formatting for this node and all descendants.
 
         digitsLen is the number digits to show in the value slot.
 
         When joinLines is true, this returns a string, otherwise it returns a list of lines."""
-        if digitsLen is None:
-            digitsLen = len(str(self.value))
-        padding = (digitsLen - len(str(self.value))) * ' '
-        lines = ["Node " + self.label + padding + self.value + "--"]
+        lines = self.pretty_lines(digitsLen)
+        return '\n'.join(lines) if joinLines else list(lines)
 
-        if not self.left_child and not self.right_child:
-            return '\n'.join(lines) if joinLines else lines
+    def pretty_lines(self, digitsLen=None):
+        """ Yields the lines of pretty_format one at a time, walking the tree with an
+        explicit stack. Each node is drawn to the left of its children:
 
-        indent_width = max(map(len, lines)) + 1
-        child_lines = self.left_child.pretty_format(digitsLen, False) if self.left_child else []
-        if self.right_child:
-            child_lines.extend(self.right_child.pretty_format(digitsLen, False))
+            Node  6-- | Node 0 1--
+                      | Node 1 5-- | Node 10 2--
+                      |            | Node 11 3--
 
-        for i, line in enumerate(child_lines):
-            if len(lines) == i:
-                lines.append(' ' * indent_width + '| ' + line)
-            else:
-                lines[i] += ' ' * (indent_width - len(lines[i])) + '| ' + line
+        so every line ends with a node that has no children, and starts with
+        either the node or the blank space of each of that node's ancestors."""
+        if digitsLen is None:
+            digitsLen = len(str(self.value))
 
-        return '\n'.join(lines) if joinLines else lines
+        # for the ancestors of the next node: the blank segment each puts on a line
+        blanks = []
+        # the ancestors that haven't been put on a line yet (always the last few)
+        headers = []
+        stack = [(self, 0)]
+        while stack:
+            node, depth = stack.pop()
+            del blanks[depth:]
+
+            value = str(node.value)
+            line = "Node " + node.label + " " + (digitsLen - len(value)) * ' ' + value + "--"
+            children = [child for child in (node.left_child, node.right_child) if child]
+            if not children:
+                yield ''.join(blanks[:depth - len(headers)]) + ''.join(headers) + line
+                headers = []
+                continue
+
+            blanks.append(' ' * (len(line) + 1) + '| ')
+            headers.append(line + ' | ')
+            # left child is popped (and drawn) first
+            stack.extend((child, depth + 1) for child in reversed(children))
 
 
 class TreeBuilder:
@@ -144,16 +170,11 @@ class TreeBuilder:
         None otherwise.
 
         Tokenized form is: [path: str, word: str, count: int]"""
-        line_tuple = next(self.file_line_iter, None)
-        if line_tuple is None:
-            return None
-        line_no, line = line_tuple
-
-        # if empty line, then skip it.
-        if not line:
-            return self.tokenize_next_line()
-
-        return TreeBuilder.tokenize_line(line_no, line)
+        # skip empty lines
+        for line_no, line in self.file_line_iter:
+            if line.strip():
+                return TreeBuilder.tokenize_line(line_no, line)
+        return None
 
     @staticmethod
     def tokenize_line(line_number, line):
@@ -193,9 +214,93 @@ class TreeBuilder:
 
         return self.tree
 
+    @staticmethod
+    def read_entries(path, chunk_size=1 << 24):
+        """Reads the whole paths file at path in chunks of chunk_size bytes, and splits
+        each chunk in one go. Returns (paths, words, counts) lists in file order.
+
+        Falls back to tokenize_line on each line (to report where) if the file doesn't
+        split into [path-bitstring, word, count] triples."""
+        paths, words, counts = [], [], []
+        with open(path, 'rb') as f:
+            rest = b''
+            while chunk := f.read(chunk_size):
+                # only split up to the last full line, the rest goes with the next chunk
+                end = chunk.rfind(b'\n') + 1
+                tokens = (rest + chunk[:end]).decode('utf8').split() if end else []
+                rest = chunk[end:] if end else rest + chunk
+                if len(tokens) % 3:
+                    return TreeBuilder.read_entries_by_line(path)
+                paths.extend(tokens[0::3])
+                words.extend(tokens[1::3])
+                counts.extend(tokens[2::3])
+            tokens = rest.decode('utf8').split()
+            if len(tokens) % 3:
+                return TreeBuilder.read_entries_by_line(path)
+            paths.extend(tokens[0::3])
+            words.extend(tokens[1::3])
+            counts.extend(tokens[2::3])
+
+        try:
+            counts = list(map(int, counts))
+        except ValueError:
+            return TreeBuilder.read_entries_by_line(path)
+        if not set(''.join(set(paths))) <= {'0', '1'}:
+            return TreeBuilder.read_entries_by_line(path)
+        return paths, words, counts
+
+    @staticmethod
+    def read_entries_by_line(path):
+        """read_entries, but tokenizing one line at a time"""
+        paths, words, counts = [], [], []
+        for line_no, line in TreeBuilder.file_line_iter(path):
+            if not line.strip():
+                continue
+            bitstring, word, count = TreeBuilder.tokenize_line(line_no, line)
+            TreeBuilder.encode_path(bitstring)  # raises if it isn't a bitstring
+            paths.append(bitstring)
+            words.append(word)
+            counts.append(count)
+        return paths, words, counts
+
+    def bulk_build_tree(self, entries=None):
+        """build_tree, but reads the file with read_entries (or uses the (paths, words, counts)
+        entries given) and builds the tree in one pass over the sorted unique paths,
+        instead of walking from the root for every line."""
+        paths, words, counts = TreeBuilder.read_entries(self.path) if entries is None else entries
+
+        path_words = defaultdict(list)
+        for path, word, count in zip(paths, words, counts):
+            path_words[path].append((word, count))
+        self.leaf_paths.update(path_words)
+
+        # stack[d] is the node at depth d on the previous path
+        stack = [self.tree]
+        previous = ''
+        for path in sorted(path_words):
+            common = len(commonprefix((previous, path)))
+            del stack[common + 1:]
+            node = stack[-1]
+            for c in path[common:]:
+                node = node.force_child(c == '1')
+                stack.append(node)
+            node.words.extend(path_words[path])
+            previous = path
+
+        # compute the weights
+        self.tree.compute_weight()
+
+        return self.tree
+
     def max_depth(self):
         return max(map(len, self.leaf_paths))
 
+    def leaf_path_codes(self):
+        """Returns the leaf paths of this tree in sorted order, along with their
+        (bits, lengths) arrays as made by TreeBuilder.encode_paths"""
+        leaves = sorted(self.leaf_paths)
+        return leaves, TreeBuilder.encode_paths(leaves)
+
     @staticmethod
     def distance(label0: str, label1: str):
         """ Returns the smallest number of nodes required to travel from node0 to node1
@@ -211,47 +316,626 @@ class TreeBuilder:
             the lowest common ancestor. Therefore the distance
             between them is the sum of the lengths of the unique
             suffixes '0101' and '10', ie 6 nodes apart."""
-        # Sum of lengths of unique suffixes can be computed as the sum of 
-        # lengths of each label minus twice the size of the shared prefix.
-        return len(label0) + len(label1) - 2 * TreeBuilder.lca_depth(label0, label1)
+        return TreeBuilder.distance_bits(TreeBuilder.encode_path(label0), TreeBuilder.encode_path(label1))
 
     @staticmethod
     def min_dist_to_lca(label0: str, label1: str):
         """ Out of the two distances: label0 to lca, and label1 to lca, returns
             the minimum of those two values """
-        min_label_length = min(len(label0), len(label1))
-        return min_label_length - TreeBuilder.lca_depth(label0, label1)
+        return TreeBuilder.min_dist_to_lca_bits(TreeBuilder.encode_path(label0), TreeBuilder.encode_path(label1))
 
     @staticmethod
     def max_dist_to_lca(label0: str, label1: str):
         """ Out of the two distances: label0 to lca, and label1 to lca, returns
             the maximum of those two values """
-        max_label_length = max(len(label0), len(label1))
-        return max_label_length - TreeBuilder.lca_depth(label0, label1)
+        return TreeBuilder.max_dist_to_lca_bits(TreeBuilder.encode_path(label0), TreeBuilder.encode_path(label1))
 
     @staticmethod
     def lca_depth(label0: str, label1: str):
         """Returns the level that the lowest common ancestor of label0 and label1 are on.
+        Labels that diverge are counted up to and including the level they diverge on
+        (see lca_depth_bits).
 
         >>> lca_depth('110111', '1101000')
-            4  # (lca is '1101')
+            5  # (lca is '1101', they diverge on level 5)
         >>> lca_depth('1101', '0110')
-            0  # (lca is root node)
+            1  # (lca is root node, they diverge on level 1)
+        >>> lca_depth('110', '1101')
+            3  # (lca is '110')
         """
-        for i, (l0, l1) in enumerate(zip(label0, label1)):
-            if l0 != l1:
-                return i + 1
-        return min(len(label0), len(label1))
+        return TreeBuilder.lca_depth_bits(TreeBuilder.encode_path(label0), TreeBuilder.encode_path(label1))
 
     @staticmethod
     def lca_label(label0: str, label1: str):
-        """Returns the label (eg '110111') of the lowest common ancestor of
-        label0 and label1 (biggest common prefix of the labels)."""
+        """Returns the first lca_depth(label0, label1) bits of label0. When one label is a
+        prefix of the other that is the label of their lowest common ancestor; labels that
+        diverge keep label0's bit on the level they diverge on, as lca_depth counts it.
+
+        >>> lca_label('110111', '1101000')
+            '11011'
+        >>> lca_label('110', '1101')
+            '110'
+        """
         return label0[:TreeBuilder.lca_depth(label0, label1)]
 
+    ### Integer coded paths
+    # A path is stored as a (bits: int, length: int) pair, where bits is the bitstring
+    # read as a binary number. length keeps track of leading zeros, so '' is (0, 0)
+    # and '0010' is (2, 4).
+
+    @staticmethod
+    def encode_path(label: str):
+        """Returns the (bits, length) pair for a bitstring label"""
+        return (int(label, 2) if label else 0), len(label)
+
+    @staticmethod
+    def decode_path(path):
+        """Returns the bitstring label for a (bits, length) pair"""
+        bits, length = path
+        return format(bits, f'0{length}b') if length else ''
+
+    @staticmethod
+    def common_prefix_bits(path0, path1):
+        """Returns the length of the biggest common prefix of two (bits, length) paths.
+        Both are cut down to the shorter length, then the highest set bit of their xor
+        is the first level where they differ."""
+        bits0, len0 = path0
+        bits1, len1 = path1
+        shared = min(len0, len1)
+        diff = (bits0 >> (len0 - shared)) ^ (bits1 >> (len1 - shared))
+        return shared - diff.bit_length()
+
+    @staticmethod
+    def lca_depth_bits(path0, path1):
+        """lca_depth for (bits, length) paths. When neither path is a prefix of the
+        other this is one more than the common prefix (the level they diverge on),
+        otherwise it is the length of the shorter path."""
+        bits0, len0 = path0
+        bits1, len1 = path1
+        shared = min(len0, len1)
+        diff = (bits0 >> (len0 - shared)) ^ (bits1 >> (len1 - shared))
+        return shared - diff.bit_length() + 1 if diff else shared
+
+    @staticmethod
+    def distance_bits(path0, path1):
+        """distance for (bits, length) paths"""
+        # Sum of lengths of unique suffixes can be computed as the sum of
+        # lengths of each label minus twice the size of the shared prefix.
+        return path0[1] + path1[1] - 2 * TreeBuilder.lca_depth_bits(path0, path1)
+
+    @staticmethod
+    def min_dist_to_lca_bits(path0, path1):
+        """min_dist_to_lca for (bits, length) paths"""
+        return min(path0[1], path1[1]) - TreeBuilder.lca_depth_bits(path0, path1)
+
+    @staticmethod
+    def max_dist_to_lca_bits(path0, path1):
+        """max_dist_to_lca for (bits, length) paths"""
+        return max(path0[1], path1[1]) - TreeBuilder.lca_depth_bits(path0, path1)
+
+    ### Batched integer coded paths
+    # The batch_* methods take whole arrays of paths as a bits array and a lengths array,
+    # and broadcast like numpy operators do. Paths longer than 62 levels don't fit in an
+    # int64, so those are stored as object arrays of python ints instead.
+
+    MAX_INT64_PATH_LENGTH = 62
+
+    @staticmethod
+    def encode_paths(labels):
+        """Returns the (bits, lengths) arrays for a list of bitstring labels"""
+        lengths = np.fromiter(map(len, labels), dtype=np.int64, count=len(labels))
+        fits = not len(labels) or lengths.max() <= TreeBuilder.MAX_INT64_PATH_LENGTH
+        bits = np.array([int(label, 2) if label else 0 for label in labels],
+                        dtype=np.int64 if fits else object)
+        return bits, lengths
+
+    @staticmethod
+    def bit_lengths(values):
+        """Vectorized int.bit_length for an array of non-negative ints"""
+        if values.dtype == object:
+            return np.frompyfunc(int.bit_length, 1, 1)(values).astype(np.int64)
+        values = values.copy()
+        result = np.zeros(values.shape, dtype=np.int64)
+        # binary search for the highest set bit, halving the window each step
+        for shift in (32, 16, 8, 4, 2, 1):
+            high = values >= (1 << shift)
+            result += np.where(high, shift, 0)
+            values = np.where(high, values >> shift, values)
+        return result + (values > 0)
+
+    @staticmethod
+    def batch_common_prefix(bits0, lens0, bits1, lens1):
+        """common_prefix_bits over arrays of paths"""
+        shared = np.minimum(lens0, lens1)
+        diff = (bits0 >> (lens0 - shared)) ^ (bits1 >> (lens1 - shared))
+        return shared - TreeBuilder.bit_lengths(np.asarray(diff))
+
+    @staticmethod
+    def batch_lca_depth(bits0, lens0, bits1, lens1):
+        """lca_depth_bits over arrays of paths"""
+        shared = np.minimum(lens0, lens1)
+        diff_len = TreeBuilder.bit_lengths(np.asarray((bits0 >> (lens0 - shared)) ^ (bits1 >> (lens1 - shared))))
+        return np.where(diff_len > 0, shared - diff_len + 1, shared)
+
+    @staticmethod
+    def batch_distance(bits0, lens0, bits1, lens1):
+        """distance_bits over arrays of paths"""
+        return lens0 + lens1 - 2 * TreeBuilder.batch_lca_depth(bits0, lens0, bits1, lens1)
+
+    @staticmethod
+    def batch_min_dist_to_lca(bits0, lens0, bits1, lens1):
+        """min_dist_to_lca_bits over arrays of paths"""
+        return np.minimum(lens0, lens1) - TreeBuilder.batch_lca_depth(bits0, lens0, bits1, lens1)
+
+    @staticmethod
+    def batch_max_dist_to_lca(bits0, lens0, bits1, lens1):
+        """max_dist_to_lca_bits over arrays of paths"""
+        return np.maximum(lens0, lens1) - TreeBuilder.batch_lca_depth(bits0, lens0, bits1, lens1)
+
+
+class Vocabulary:
+    """Gives every word a small int id, so that several trees can share one copy of each word.
+
+    Words packed into bytes by another process can also be interned by their packed_hashes
+    (see intern_packed), so that only the words that are new get decoded."""
+
+    # the multiplier of packed_hashes' polynomial hash, and its inverse mod 2 ** 64
+    HASH_BASE = 0x100000001b3
+    HASH_BASE_INVERSE = pow(HASH_BASE, -1, 1 << 64)
+
+    def __init__(self):
+        self.id_table = dict()
+        self.words = []
+        # the packed_hashes of words[:hashed_count], sorted, and the id of each
+        self.hash_keys = np.zeros(0, dtype=np.uint64)
+        self.hash_ids = np.zeros(0, dtype=np.int32)
+        self.hashed_count = 0
+
+    @staticmethod
+    def from_words(words):
+        """Makes a Vocabulary where words (which must be unique) have the ids 0, 1, 2..."""
+        vocabulary = Vocabulary()
+        vocabulary.words = list(words)
+        return vocabulary
+
+    @property
+    def ids(self):
+        """A dict of the id of each word. Words are only added to it once it is asked for, so
+        runs that intern packed words and never look one up don't build it"""
+        if len(self.id_table) < len(self.words):
+            self.id_table.update(zip(self.words[len(self.id_table):], range(len(self.id_table), len(self.words))))
+        return self.id_table
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, word_id):
+        return self.words[word_id]
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    def intern(self, word):
+        """Returns the id of word, adding it if it is new"""
+        word_id = self.ids.get(word)
+        if word_id is None:
+            word_id = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def intern_all(self, words):
+        """Returns an int32 array of the ids of words, adding the new ones in the order they come"""
+        if not self.words:
+            # the first file of a run: its words are usually all different, so they can be
+            # numbered in one go
+            ids = dict(zip(words, range(len(words))))
+            if len(ids) == len(words):
+                self.id_table, self.words = ids, list(words)
+                return np.arange(len(words), dtype=np.int32)
+        new_words = list(dict.fromkeys(filterfalse(self.ids.__contains__, words)))
+        self.ids.update(zip(new_words, range(len(self.words), len(self.words) + len(new_words))))
+        self.words.extend(new_words)
+        return np.fromiter(map(self.ids.__getitem__, words), dtype=np.int32, count=len(words))
+
+    @staticmethod
+    def word_bounds(packed):
+        """The (starts, stops) byte offsets of each word of packed (see treeCache.pack_strings)"""
+        if not packed.size:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        newlines = np.flatnonzero(packed == ord('\n'))
+        return np.concatenate(([0], newlines + 1)), np.append(newlines, packed.size)
+
+    @staticmethod
+    def packed_hashes(packed):
+        """A uint64 hash of each word of packed (see treeCache.pack_strings), worked out for
+        all of them at once: a polynomial hash of the word's bytes, mixed with its length.
+        Equal words always get equal hashes, wherever they are packed."""
+        starts, stops = Vocabulary.word_bounds(packed)
+        if not len(starts):
+            return np.zeros(0, dtype=np.uint64)
+        # byte i is weighted by HASH_BASE_INVERSE ** i, so a word's sum times HASH_BASE ** start
+        # weighs its own bytes from 1 up, wherever it starts. uint64 arithmetic wraps mod 2 ** 64
+        inverse_powers = np.full(packed.size, Vocabulary.HASH_BASE_INVERSE, dtype=np.uint64)
+        inverse_powers[0] = 1
+        np.multiply.accumulate(inverse_powers, out=inverse_powers)
+        sums = np.zeros(packed.size + 1, dtype=np.uint64)
+        np.cumsum(packed * inverse_powers, out=sums[1:])
+        powers = np.full(packed.size + 1, Vocabulary.HASH_BASE, dtype=np.uint64)
+        powers[0] = 1
+        np.multiply.accumulate(powers, out=powers)
+
+        hashes = (sums[stops] - sums[starts]) * powers[starts]
+        # splitmix64's finalizer, with the length mixed in
+        hashes ^= (stops - starts).astype(np.uint64) * np.uint64(0x9e3779b97f4a7c15)
+        hashes ^= hashes >> np.uint64(30)
+        hashes *= np.uint64(0xbf58476d1ce4e5b9)
+        hashes ^= hashes >> np.uint64(27)
+        hashes *= np.uint64(0x94d049bb133111eb)
+        hashes ^= hashes >> np.uint64(31)
+        return hashes
+
+    @staticmethod
+    def gather_words(packed, starts, stops):
+        """The bytes of the words of packed from starts to stops, each followed by a newline"""
+        # packed doesn't end in a newline, so lend it one for its last word
+        packed = np.append(packed, np.uint8(ord('\n')))
+        lengths = stops - starts + 1
+        offsets = np.arange(lengths.sum(), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return packed[np.repeat(starts, lengths) + offsets].tobytes()
+
+    def add_hashes(self, hashes, ids):
+        """Adds words with the sorted hashes and ids to hash_keys"""
+        places = np.searchsorted(self.hash_keys, hashes)
+        self.hash_keys = np.insert(self.hash_keys, places, hashes)
+        self.hash_ids = np.insert(self.hash_ids, places, ids)
+
+    def intern_packed(self, packed, hashes, hash_order=None):
+        """Like intern_all for the words packed with treeCache.pack_strings, given their
+        packed_hashes (and np.argsort of them, if it was worked out elsewhere). The words
+        already in the vocabulary are found by hash, checked against their bytes, and only
+        the new ones are decoded. Falls back on intern_all if two words share a hash."""
+        if self.hashed_count < len(self.words):
+            # the words interned from strings since the last intern_packed
+            rest = self.words[self.hashed_count:]
+            rest_hashes = Vocabulary.packed_hashes(np.frombuffer('\n'.join(rest).encode('utf8'), dtype=np.uint8))
+            rest_order = np.argsort(rest_hashes)
+            self.add_hashes(rest_hashes[rest_order], (rest_order + self.hashed_count).astype(np.int32))
+            self.hashed_count = len(self.words)
+
+        # the hashes are looked up in sorted order, which keeps hash_keys in the cache
+        if hash_order is None:
+            hash_order = np.argsort(hashes)
+        sorted_hashes = hashes[hash_order]
+        places = np.minimum(np.searchsorted(self.hash_keys, sorted_hashes), max(len(self.hash_keys) - 1, 0))
+        sorted_found = self.hash_keys[places] == sorted_hashes if len(self.hash_keys) else np.zeros(len(hashes), dtype=bool)
+        found = np.empty(len(hashes), dtype=bool)
+        found[hash_order] = sorted_found
+        ids = np.empty(len(hashes), dtype=np.int32)
+        ids[hash_order[sorted_found]] = self.hash_ids[places[sorted_found]]
+        new = np.flatnonzero(~found)
+        new_hashes = sorted_hashes[~sorted_found]
+
+        # the words with known hashes must be those words, and the new ones all different.
+        # neither check fails outside of a hash collision or a paths file with a word twice
+        starts, stops = Vocabulary.word_bounds(packed)
+        found_words = list(map(self.words.__getitem__, ids[found].tolist()))
+        if (found_words and Vocabulary.gather_words(packed, starts[found], stops[found]) != ('\n'.join(found_words) + '\n').encode('utf8')) \
+                or (new_hashes[1:] == new_hashes[:-1]).any():
+            words = packed.tobytes().decode('utf8').split('\n') if packed.size else []
+            return self.intern_all(words)
+
+        if len(new) == len(hashes):
+            new_words = packed.tobytes().decode('utf8').split('\n') if packed.size else []
+        else:
+            new_words = Vocabulary.gather_words(packed, starts[new], stops[new]).decode('utf8').split('\n')[:-1]
+        ids[new] = np.arange(len(self.words), len(self.words) + len(new), dtype=np.int32)
+        self.words.extend(new_words)
+        self.add_hashes(new_hashes, ids[hash_order[~sorted_found]])
+        self.hashed_count = len(self.words)
+        return ids
+
+
+class CompactTree:
+    """A tree stored as parallel arrays instead of TreeNode objects. Node 0 is the root and
+    the nodes are numbered in pre-order ('0' child before '1' child), so each node's subtree
+    is a contiguous range of nodes, and of words.
+
+    For node n:
+        left[n], right[n]  its '0' and '1' children (-1 if missing)
+        parent[n]          its parent (-1 for the root)
+        depth[n]           its depth, the length of its label
+        weight[n]          the summed word counts of its subtree (TreeNode.value)
+        word_start[n]      where its own words start in word_ids and counts, ending
+                           at word_stop[n], and its subtree's at subtree_stop[n]
+
+    word_ids are ids in vocabulary, which can be shared between trees. Use tree[...] or
+    tree.root for a TreeNode-like view of the nodes."""
+
+    ARRAY_NAMES = ('left', 'right', 'parent', 'depth', 'weight', 'word_start', 'word_stop',
+                   'subtree_stop', 'word_ids', 'counts')
+
+    def __init__(self, vocabulary=None):
+        self.vocabulary = Vocabulary() if vocabulary is None else vocabulary
+
+    def arrays(self):
+        """Returns { name -> array } of the arrays that make up this tree"""
+        return { name: getattr(self, name) for name in CompactTree.ARRAY_NAMES }
+
+    @staticmethod
+    def from_arrays(arrays, vocabulary):
+        """Rebuilds a CompactTree from the arrays of CompactTree.arrays, with word ids in vocabulary"""
+        tree = CompactTree(vocabulary)
+        for name in CompactTree.ARRAY_NAMES:
+            setattr(tree, name, arrays[name])
+        return tree
+
+    @staticmethod
+    def from_entries(entries, vocabulary=None):
+        """Builds a CompactTree from the (paths, words, counts) lists of TreeBuilder.read_entries"""
+        paths, words, counts = entries
+        tree = CompactTree(vocabulary)
+
+        # there are far fewer paths than words, so sort the paths and look each word's up
+        unique_paths = sorted(set(paths))
+        path_numbers = dict(zip(unique_paths, range(len(unique_paths))))
+        path_of_word = np.fromiter(map(path_numbers.__getitem__, paths), dtype=np.int64, count=len(paths))
+
+        # create the nodes in pre-order, keeping the stack of nodes on the previous path
+        left, right, parent, depth = [-1], [-1], [-1], [0]
+        path_nodes = np.empty(len(unique_paths), dtype=np.int64)
+        stack = [0]
+        previous = ''
+        for p, path in enumerate(unique_paths):
+            common = len(commonprefix((previous, path)))
+            del stack[common + 1:]
+            node = stack[-1]
+            for c in path[common:]:
+                children = right if c == '1' else left
+                child = children[node] = len(left)
+                left.append(-1)
+                right.append(-1)
+                parent.append(node)
+                depth.append(depth[node] + 1)
+                stack.append(child)
+                node = child
+            path_nodes[p] = node
+            previous = path
+
+        tree.left, tree.right = np.array(left, dtype=np.int32), np.array(right, dtype=np.int32)
+        tree.parent, tree.depth = np.array(parent, dtype=np.int32), np.array(depth, dtype=np.int32)
+        node_count = len(left)
+
+        # words grouped by node, in file order within a node
+        word_order = np.argsort(path_of_word, kind='stable')
+        tree.word_ids = tree.vocabulary.intern_all(words)[word_order]
+        tree.counts = np.asarray(counts, dtype=np.int64)[word_order]
+
+        own_words = np.zeros(node_count, dtype=np.int64)
+        own_words[path_nodes] = np.bincount(path_of_word, minlength=len(unique_paths))
+        own_weight = np.zeros(node_count, dtype=np.int64)
+        own_weight[path_nodes] = np.bincount(path_of_word, weights=counts, minlength=len(unique_paths)).astype(np.int64)
+        # word positions fit in int32 for any vocabulary that fits in memory
+        position_type = np.int32 if len(words) < np.iinfo(np.int32).max else np.int64
+        tree.word_start = (np.cumsum(own_words) - own_words).astype(position_type)
+        tree.word_stop = tree.word_start + own_words.astype(position_type)
+
+        # add each level of the tree into its parents, deepest first
+        subtree_words, tree.weight = own_words.copy(), own_weight
+        by_depth = np.argsort(tree.depth, kind='stable')
+        level_starts = np.searchsorted(tree.depth[by_depth], np.arange(tree.depth.max() + 2))
+        for d in range(tree.depth.max(), 0, -1):
+            level = by_depth[level_starts[d]:level_starts[d + 1]]
+            np.add.at(subtree_words, tree.parent[level], subtree_words[level])
+            np.add.at(tree.weight, tree.parent[level], tree.weight[level])
+        tree.subtree_stop = tree.word_start + subtree_words.astype(position_type)
+        return tree
+
+    @staticmethod
+    def from_file(path, vocabulary=None):
+        return CompactTree.from_entries(TreeBuilder.read_entries(path), vocabulary)
+
+    @staticmethod
+    def load_many(paths):
+        """Loads the trees at each of paths, sharing one vocabulary. Returns (vocabulary, trees)"""
+        vocabulary = Vocabulary()
+        return vocabulary, [CompactTree.from_file(path, vocabulary) for path in paths]
+
+    def __len__(self):
+        return len(self.left)
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays of this tree (not counting the vocabulary)"""
+        return sum(a.nbytes for a in self.arrays().values())
+
+    def find(self, path: str):
+        """Returns the index of the node at the end of path, or -1 if there is none"""
+        node = 0
+        for c in path:
+            node = (self.right if TreeNode.str_to_right(c) else self.left)[node]
+            if node < 0:
+                return -1
+        return int(node)
+
+    def label(self, node):
+        """Rebuilds the bitstring label of node from its ancestors"""
+        bits = []
+        while self.parent[node] >= 0:
+            up = self.parent[node]
+            bits.append('1' if self.right[up] == node else '0')
+            node = up
+        return ''.join(reversed(bits))
+
+    def node_words(self, node, subtree=False):
+        """Returns the (word, count) pairs of node, or of all its subtree if subtree is true"""
+        stop = self.subtree_stop[node] if subtree else self.word_stop[node]
+        words = self.vocabulary.words
+        return [(words[w], c) for w, c in zip(self.word_ids[self.word_start[node]:stop].tolist(),
+                                              self.counts[self.word_start[node]:stop].tolist())]
+
+    @property
+    def root(self):
+        return CompactTreeNode(self, 0, '')
+
+    def __getitem__(self, right):
+        return self.root[right]
+
+
+class CompactTreeNode(TreeNode):
+    """A read-only TreeNode view of one node of a CompactTree, made on demand. A child's view
+    gets its label from its parent's plus one bit, so walking down never rebuilds labels."""
+
+    def __init__(self, tree: CompactTree, index: int, label=None):
+        self.tree = tree
+        self.index = index
+        # made on first use (from the ancestors) if it isn't known
+        self._label = label
+
+    def _view(self, index, bit):
+        if index < 0:
+            return None
+        return CompactTreeNode(self.tree, int(index), self._label + bit if self._label is not None else None)
+
+    @property
+    def label(self):
+        if self._label is None:
+            self._label = self.tree.label(self.index)
+        return self._label
+
+    @property
+    def right_child(self):
+        return self._view(self.tree.right[self.index], '1')
+
+    @property
+    def left_child(self):
+        return self._view(self.tree.left[self.index], '0')
+
+    @property
+    def words(self):
+        return self.tree.node_words(self.index)
+
+    @property
+    def value(self):
+        return int(self.tree.weight[self.index])
+
+    def force_child(self, right: bool):
+        """Gets a child, raising a KeyError if it doesn't exist (compact trees are read-only)"""
+        child = self.get_child(right)
+        if child is None:
+            raise KeyError(f"node '{self.label}' has no {'1' if right else '0'} child")
+        return child
+
+    def add_word(self, word, count):
+        raise TypeError('CompactTree nodes are read-only')
+
+    def compute_weight(self):
+        """The weights are computed when the CompactTree is built, so this just returns self.value"""
+        return self.value
+
+
+class PathIndex:
+    """Finds the words of several trees by path, and by path prefix. Each tree's paths are
+    kept sorted, with its words grouped by path in the same order, so the words under any
+    prefix are one contiguous range found with two binary searches.
+
+    For tree t (its number, in the order the trees were added):
+        paths[t]              its unique paths, sorted
+        path_starts[t]        where each path's words start in word_ids[t] (with one extra
+                              entry at the end, the word count)
+        word_ids[t]           ids in vocabulary of its words, grouped by path
+        cumulative_counts[t]  running totals of the counts of word_ids[t], from 0
+        word_path_ids[t]      for each word id, the index in paths[t] of the word's path,
+                              or MISSING if the word isn't in the tree"""
+
+    MISSING = -1
+
+    def __init__(self, vocabulary=None):
+        self.vocabulary = Vocabulary() if vocabulary is None else vocabulary
+        self.tree_names = []
+        self.paths, self.path_starts, self.word_ids, self.cumulative_counts, self.word_path_ids = [], [], [], [], []
+
+    def add_tree(self, name, entries):
+        """Adds the tree called name from its (paths, words, counts) lists (see TreeBuilder.read_entries).
+        Returns the ids of words."""
+        paths, words, counts = entries
+        ids = self.vocabulary.intern_all(words)
+        # there are far fewer paths than words, so sort the paths and look each word's up
+        unique_paths = sorted(set(paths))
+        path_numbers = dict(zip(unique_paths, range(len(unique_paths))))
+        path_of_word = np.fromiter(map(path_numbers.__getitem__, paths), dtype=np.int32, count=len(paths))
+        self.add_tree_arrays(name, ids, np.asarray(unique_paths, dtype=str), path_of_word,
+                             **PathIndex.tree_arrays(path_of_word, np.asarray(counts, dtype=np.int64), len(unique_paths)))
+        return ids
+
+    @staticmethod
+    def tree_arrays(path_of_word, counts, path_count):
+        """The arrays add_tree_arrays needs that don't depend on the vocabulary, from each word's
+        path (as its number in sorted path order) and count. Returns { name -> array }."""
+        order = np.argsort(path_of_word, kind='stable')
+        cumulative_counts = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts[order], out=cumulative_counts[1:])
+        return { 'order': order, 'path_starts': np.searchsorted(path_of_word[order], np.arange(path_count + 1)),
+                 'cumulative_counts': cumulative_counts }
+
+    def add_tree_arrays(self, name, ids, paths, path_of_word, order, path_starts, cumulative_counts):
+        """Adds the tree called name whose words have the ids in vocabulary, given its sorted
+        paths (a str array), each word's path number and the tree_arrays of those"""
+        self.tree_names.append(name)
+        self.paths.append(paths)
+        self.path_starts.append(path_starts)
+        self.word_ids.append(ids[order])
+        self.cumulative_counts.append(cumulative_counts)
+
+        word_path_ids = np.full(len(self.vocabulary), PathIndex.MISSING, dtype=np.int32)
+        word_path_ids[ids] = path_of_word
+        self.word_path_ids.append(word_path_ids)
+        # the vocabulary may have grown, so the earlier trees need room for the new words
+        for t, tree_path_ids in enumerate(self.word_path_ids):
+            if len(tree_path_ids) < len(self.vocabulary):
+                self.word_path_ids[t] = np.concatenate([tree_path_ids, np.full(len(self.vocabulary) - len(tree_path_ids),
+                                                                               PathIndex.MISSING, dtype=np.int32)])
+
+    def remove_tree(self, tree):
+        """Removes tree (a name or number). Its words keep their ids, even the ones no tree has now."""
+        t = self.tree_number(tree)
+        for tree_arrays in (self.tree_names, self.paths, self.path_starts, self.word_ids, self.cumulative_counts, self.word_path_ids):
+            del tree_arrays[t]
+
+    def tree_number(self, tree):
+        """The number of tree, given as its number or its name"""
+        return tree if isinstance(tree, int) else self.tree_names.index(tree)
+
+    def word_paths(self, word):
+        """The path of word in each tree, None where it isn't in the tree"""
+        word_id = self.vocabulary.ids[word]
+        return [str(paths[path_ids[word_id]]) if path_ids[word_id] != PathIndex.MISSING else None
+                for paths, path_ids in zip(self.paths, self.word_path_ids)]
+
+    def prefix_range(self, tree, prefix: str):
+        """Returns the (start, stop) range of word_ids[tree] whose paths start with prefix"""
+        if prefix.strip('01'):
+            raise ValueError(f"'{prefix}' is not a bitstring")
+        t = self.tree_number(tree)
+        # every path starting with prefix sorts between it and prefix + '2'
+        first, last = np.searchsorted(self.paths[t], [prefix, prefix + '2'])
+        return int(self.path_starts[t][first]), int(self.path_starts[t][last])
+
+    def words_under(self, tree, prefix: str):
+        """The words whose paths in tree start with prefix, grouped by path in path order"""
+        start, stop = self.prefix_range(tree, prefix)
+        words = self.vocabulary.words
+        return [words[w] for w in self.word_ids[self.tree_number(tree)][start:stop].tolist()]
+
+    def subtree_weight(self, tree, prefix: str):
+        """The summed counts of the words under prefix in tree, the value of its node there"""
+        start, stop = self.prefix_range(tree, prefix)
+        cumulative_counts = self.cumulative_counts[self.tree_number(tree)]
+        return int(cumulative_counts[stop] - cumulative_counts[start])
+
 
 if __name__ == "__main__":
     builder = TreeBuilder('./lolcat-c50-p1.out/paths')
     tree = builder.build_tree()
-    print(tree.pretty_format())
+    for line in tree.pretty_lines():
+        print(line)
     print('leaf pathes:', len(builder.leaf_paths))
@@ -0,0 +1,19 @@
+from contextlib import contextmanager
+from os import getpid, remove, replace
+from os.path import exists
+
+@contextmanager
+def atomic_write(path, mode='w+', **open_kwargs):
+    """Opens a new file for what belongs at path, and moves it over path once the with block
+    is done. The move is a single rename, so a run that is killed or fails part way leaves
+    either the old file at path or the new one, never half of one, and the old file can
+    still be read while the new one is written. The new file is named after this process,
+    so several processes can write the same path at once (the last one done wins)."""
+    temp_path = f'{path}.{getpid()}.tmp'
+    try:
+        with open(temp_path, mode, **open_kwargs) as f:
+            yield f
+        replace(temp_path, path)
+    finally:
+        if exists(temp_path):
+            remove(temp_path)
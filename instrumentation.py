@@ -0,0 +1,205 @@
+from collections import Counter
+from contextlib import contextmanager
+from cProfile import Profile
+from json import dump
+from os import getpid
+from signal import setitimer, signal, ITIMER_PROF, SIGPROF
+from time import perf_counter
+
+class Stage:
+    """One timed stage of a run: how long it took, how often it ran and what it counted"""
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.calls = 0
+        # totals, eg pairs scored or bytes written
+        self.counters = Counter()
+        # latest values, eg the size of a dict
+        self.gauges = dict()
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def gauge(self, gauge, value):
+        self.gauges[gauge] = value
+
+    def as_dict(self):
+        rates = { f'{counter}_per_second': n / self.seconds for counter, n in self.counters.items() if self.seconds }
+        return { 'seconds': self.seconds, 'calls': self.calls, **self.counters, **rates, **self.gauges }
+
+
+class NullStage(Stage):
+    """What a disabled Instruments hands out, so instrumented code doesn't need to check"""
+
+    def count(self, counter, n=1):
+        pass
+
+    def gauge(self, gauge, value):
+        pass
+
+
+class Instruments:
+    """Timers and counters for the stages of a run (parsing, memoizing leaf pairs, scoring,
+    writing...). Off by default, in which case every stage is the same NullStage and the
+    cost is one attribute check per stage.
+
+        with instruments.stage('parse') as stage:
+            ...
+            stage.count('words', len(words))
+
+    Stages with the same name add up. Each run of a stage is also kept as a trace event,
+    so dump() writes a file that chrome://tracing or Perfetto can open."""
+
+    NULL_STAGE = NullStage('null')
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = dict()
+        self.events = []
+        self.origin = perf_counter()
+
+    def get_stage(self, name):
+        if not self.enabled:
+            return Instruments.NULL_STAGE
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        """Times the with block as a run of the stage called name, yielding the Stage"""
+        if not self.enabled:
+            yield Instruments.NULL_STAGE
+            return
+        stage = self.get_stage(name)
+        start = perf_counter()
+        try:
+            yield stage
+        finally:
+            end = perf_counter()
+            stage.seconds += end - start
+            stage.calls += 1
+            self.events.append((name, start, end))
+
+    def timed(self, name, iterable, counter=None, size=None):
+        """Yields from iterable, adding the time spent getting each item to the stage called
+        name, and counting the items (or size(item) for each item) as counter if given. This
+        separates the time a generator takes from the time its consumer takes. Returns
+        iterable itself if disabled, so it costs nothing then."""
+        if not self.enabled:
+            return iterable
+        return self._timed(self.get_stage(name), iter(iterable), counter, size)
+
+    def _timed(self, stage, iterator, counter, size):
+        start = first = perf_counter()
+        items = 0
+        try:
+            while True:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    stage.seconds += perf_counter() - start
+                items += 1 if size is None else size(item)
+                yield item
+                start = perf_counter()
+        finally:
+            stage.calls += 1
+            if counter:
+                stage.count(counter, items)
+            self.events.append((stage.name, first, perf_counter()))
+
+    def add_time(self, name, seconds):
+        """Adds seconds measured some other way to the stage called name"""
+        if not self.enabled:
+            return
+        stage = self.get_stage(name)
+        stage.seconds += seconds
+        stage.calls += 1
+
+    def as_dict(self):
+        return { name: stage.as_dict() for name, stage in self.stages.items() }
+
+    def report(self):
+        """Prints a table of the stages"""
+        if not self.stages:
+            return
+        width = max(map(len, self.stages))
+        print('--- Stages -------------------------------------------')
+        for name, stage in self.stages.items():
+            details = ', '.join(f'{counter} {n:,} ({n / stage.seconds:,.0f}/s)' if stage.seconds else f'{counter} {n:,}'
+                                for counter, n in stage.counters.items())
+            details = ', '.join(filter(None, [details, ', '.join(f'{gauge} {value:,}' for gauge, value in stage.gauges.items())]))
+            print(f'{name:<{width}} {stage.seconds:>10.3f}s {stage.calls:>6}x  {details}')
+        print('------------------------------------------------------')
+
+    def dump(self, path):
+        """Writes the stages, and each run of a stage as a trace event, to the json file at path"""
+        pid = getpid()
+        events = [{ 'name': name, 'ph': 'X', 'pid': pid, 'tid': 0,
+                    'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6 }
+                  for name, start, end in self.events]
+        with open(path, 'w+') as f:
+            dump({ 'stages': self.as_dict(), 'traceEvents': events }, f, indent=1)
+
+
+# the instruments the rest of the code reports to, turned on by multiTree.py --instrument
+instruments = Instruments()
+
+
+class StackSampler:
+    """Samples the main thread's stack every interval seconds of CPU time (with SIGPROF, so
+    unix only), counting each stack. write() saves them in the folded format flamegraph.pl
+    and speedscope read: 'outer;inner;innermost count' per line."""
+
+    def __init__(self, interval=.005):
+        self.interval = interval
+        self.stacks = Counter()
+
+    def sample(self, _, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.previous = signal(SIGPROF, self.sample)
+        setitimer(ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        setitimer(ITIMER_PROF, 0, 0)
+        signal(SIGPROF, self.previous)
+
+    def write(self, path):
+        with open(path, 'w+') as f:
+            f.writelines(f'{stack} {n}\n' for stack, n in self.stacks.most_common())
+
+
+@contextmanager
+def profiled(path):
+    """Profiles the with block into the file at path: with cProfile if it ends in '.prof' (read
+    it with pstats or snakeviz), otherwise by sampling stacks (see StackSampler). Does nothing
+    if path is None."""
+    if path is None:
+        yield
+        return
+    if path.endswith('.prof'):
+        profiler = Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+    else:
+        sampler = StackSampler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.write(path)
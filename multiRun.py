@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import sha1
+from json import dump, load
+from os import cpu_count, stat, utime
+from os.path import abspath, basename, exists, join, splitext
+from shutil import rmtree
+from subprocess import run, DEVNULL
+from sys import exit
+from tempfile import mkdtemp
+from time import sleep, time
+
+from terminalHelpers import *
+from multiTree import MultiTreeBuilder, main as multi_tree_main
+from treeCache import TreeCache
+
+class ClusterRun:
+    """One run of wcluster on a corpus with a cluster size (the --c argument)"""
+
+    def __init__(self, text_path, size):
+        self.text_path = text_path
+        self.size = size
+        # the output location wcluster picks for a run without --output_dir
+        self.output_dir = f'{splitext(basename(text_path))[0]}-c{size}-p1.out'
+        self.paths_file = join(self.output_dir, 'paths')
+        self.stamp_file = join(self.output_dir, 'multirun.json')
+
+    def stamp(self, text_hash):
+        """What the run's outputs were made from"""
+        return {'text': abspath(self.text_path), 'sha1': text_hash, 'c': self.size}
+
+    def is_current(self, text_hash):
+        """True if the paths file exists and was made by this driver from the same corpus"""
+        if not exists(self.paths_file) or not exists(self.stamp_file):
+            return False
+        with open(self.stamp_file) as f:
+            return load(f) == self.stamp(text_hash)
+
+    def write_stamp(self, text_hash):
+        with open(self.stamp_file, 'w+') as f:
+            dump(self.stamp(text_hash), f)
+
+    def command(self, wcluster, threads):
+        return [wcluster, '--text', self.text_path, '--c', str(self.size),
+                '--threads', str(threads), '--output_dir', self.output_dir]
+
+    def execute(self, wcluster, threads):
+        """Runs wcluster, raising a RuntimeError if it fails. Returns this run."""
+        result = run(self.command(wcluster, threads), stdout=DEVNULL, stderr=DEVNULL)
+        if result.returncode != 0:
+            raise RuntimeError(f'wcluster --c {self.size} failed (exit code {result.returncode}), see {self.output_dir}/log')
+        return self
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """sha1 hex digest of the file at path"""
+    digest = sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def split_cores(run_count, cores):
+    """Splits a budget of cores into (parallel wcluster processes, --threads for each)"""
+    processes = max(1, min(run_count, cores))
+    return processes, max(1, cores // processes)
+
+def index_is_fresh(text_path):
+    """wcluster only reuses its indexed copy of the corpus (.strdb and .int next to it) if both are
+    newer than the corpus, comparing whole seconds"""
+    text_time = int(stat(text_path).st_mtime)
+    return all(exists(text_path + ext) and int(stat(text_path + ext).st_mtime) > text_time
+               for ext in ['.strdb', '.int'])
+
+def index_corpus(wcluster, text_path):
+    """Has wcluster index the corpus once (with --stats, which stops after reading it), so that the
+    parallel runs all read the index instead of each rewriting it at the same time."""
+    if index_is_fresh(text_path):
+        return
+    scratch = mkdtemp()
+    try:
+        run([wcluster, '--text', text_path, '--stats', '--output_dir', scratch], stdout=DEVNULL, stderr=DEVNULL, check=True)
+    finally:
+        rmtree(scratch, ignore_errors=True)
+    if not index_is_fresh(text_path):
+        # made within the same second as the corpus, so push it to the next second
+        sleep(1)
+        for ext in ['.strdb', '.int']:
+            utime(text_path + ext)
+
+def run_all(text_path, sizes, wcluster='./wcluster', cores=None, force=False, cache=None, jobs=1):
+    """Runs wcluster for each cluster size, up to the cores budget at once, skipping runs that are
+    already current (unless force is true). Each tree is loaded into the MultiTreeBuilder as soon
+    as its run is done. Returns (multi_builder, input_name) with the builder built.
+
+    cache (a TreeCache) and jobs are used to load the trees, like multiTree.py's --cache and --jobs."""
+    cores = cpu_count() if cores is None else cores
+    runs = [ClusterRun(text_path, size) for size in sizes]
+    multi_builder = MultiTreeBuilder([r.paths_file for r in runs], cache)
+
+    print('Hashing corpus...')
+    text_hash = hash_file(text_path)
+
+    todo = []
+    for r in runs:
+        if not force and r.is_current(text_hash):
+            print(f'c{r.size}: up to date, loading {r.paths_file}')
+            # with jobs, build_all loads the up to date trees in parallel instead
+            if jobs == 1:
+                multi_builder.load_tree(r.paths_file)
+        else:
+            todo.append(r)
+
+    if todo:
+        index_corpus(wcluster, text_path)
+        processes, threads = split_cores(len(todo), cores)
+        print(f'Running wcluster for {len(todo)} cluster sizes, {processes} at a time with {threads} threads each')
+        start = time()
+        with ThreadPoolExecutor(processes) as pool:
+            # biggest cluster sizes take longest, so start them first
+            futures = [pool.submit(r.execute, wcluster, threads) for r in sorted(todo, key=lambda r: -r.size)]
+            for future in as_completed(futures):
+                r = future.result()
+                r.write_stamp(text_hash)
+                print(f'c{r.size}: done after {time() - start:.1f}s, loading {r.paths_file}')
+                multi_builder.load_tree(r.paths_file)
+
+    multi_builder.build_all(jobs=jobs)
+    return multi_builder, splitext(basename(text_path))[0]
+
+
+if __name__ == "__main__":
+    cluster_flag = LiteralFlag('c', 'clusters', 'List of cluster sizes to run')
+    cores_flag = LiteralFlag('n', 'cores', 'How many cores to use in total\n(default: all of them)', default_value=cpu_count())
+    wcluster_flag = LiteralFlag('w', 'wcluster', 'Location of the wcluster binary', default_value='./wcluster')
+    force_flag = Flag('f', 'force', 'Rerun even the cluster sizes\nthat are up to date')
+    help_flag = Flag('h', 'help', 'Shows this prompt')
+
+    def print_help():
+        print('--- Help ---------------------------------------------')
+        print('\tThis tool must be provided with cluster sizes \n\tand the corpus file to run wcluster on.\n\tAny other args are passed on to multiTree.py\n\t(its --cache and --jobs also load the trees)')
+        for flag in [cluster_flag, cores_flag, wcluster_flag, force_flag, help_flag]:
+            print(flag.format_description(4, 18))
+        print('------------------------------------------------------')
+
+    args = Flag.get_terminal_args()
+
+    if help_flag.remove_from_args(args):
+        print_help()
+        exit()
+
+    if not cluster_flag.remove_from_args(args) or not isinstance(cluster_flag.value, list):
+        print_help()
+        raise ValueError('MultiRun requires a list of cluster sizes (w/o spaces)')
+
+    cores_flag.remove_from_args(args)
+    if not isinstance(cores_flag.value, int) or cores_flag.value < 1:
+        print_help()
+        raise ValueError('MultiRun cores flag must be followed by a positive int literal')
+
+    wcluster_flag.remove_from_args(args)
+    force = force_flag.remove_from_args(args)
+
+    # the corpus comes first, everything after it goes to multiTree.py
+    if not args or not exists(args[0]):
+        print_help()
+        raise ValueError('MultiRun requires the path of an existing corpus file before any multiTree.py args')
+    text_path = args.pop(0)
+
+    # multiTree.py's cache and jobs flags are for loading the trees here too, and stay in args
+    # so that it still sees them
+    tree_cache_flag = Flag('C', 'cache')
+    tree_jobs_flag = LiteralFlag('j', 'jobs', default_value=1)
+    cache = TreeCache() if tree_cache_flag.remove_from_args(list(args)) else None
+    tree_jobs_flag.remove_from_args(list(args))
+    if not isinstance(tree_jobs_flag.value, int) or tree_jobs_flag.value < 1:
+        print_help()
+        raise ValueError('MultiRun jobs flag (for multiTree.py) must be followed by a positive int literal')
+
+    multi_builder, input_name = run_all(text_path, cluster_flag.value, wcluster_flag.value, cores_flag.value, force,
+                                        cache, tree_jobs_flag.value)
+    multi_tree_main(['--clusters', repr(cluster_flag.value), input_name, *args], multi_builder)
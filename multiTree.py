@@ -1,16 +1,32 @@
 #!/usr/bin/env python3
 from collections import defaultdict
-from os.path import exists
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from hashlib import sha1
+from json import dump, load
+from os import fsync, remove
+from os.path import exists, getsize, splitext
+from shutil import copyfileobj
 from sys import exit
-from itertools import combinations
-from csv import writer, reader
+from itertools import chain, combinations, islice
 from math import ceil
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from time import monotonic
 
-from clusterTree import TreeBuilder
+import numpy as np
+
+from clusterTree import TreeBuilder, CompactTree, PathIndex, Vocabulary
 from terminalHelpers import *
-from analysis import make_buckets
+from fileHelpers import atomic_write
+from analysis import make_buckets, write_vocab, export_csv, inverted_path, totals_path, condensed_pairs, EDGE_DTYPE, ScoreHistogram, ScoreCsvWriter
+from treeCache import TreeCache, DEFAULT_CACHE_DIR, pack_strings, unpack_strings
+from instrumentation import instruments, profiled
 
 class MultiTreeBuilder:
+    # the path pairwise_score gives a word in a tree it isn't in. its pairs all score 0
+    MISSING_PATH = ''
+
     @staticmethod
     def create_file_locs(input_file_name, cluster_sizes):
         """ input_file_name is the name of the file (without the extension) that contains the corpus given to Brown's algorithm
@@ -23,15 +39,32 @@ class MultiTreeBuilder:
         
         return file_names
 
-    def __init__(self, file_names: list):
-        """file_names are the tree output path locations ie 'input-c40-p1.out/paths'"""
+    def __init__(self, file_names: list, cache: TreeCache = None):
+        """file_names are the tree output path locations ie 'input-c40-p1.out/paths'
+        If a TreeCache is given, trees are loaded from it when their file was seen before."""
         # file locations of the paths files
         self.file_names = file_names
         # TreeBuilder's buildTree method takes in a file location and creates a tree.
         self.tree_builders = { path: self.make_new_tree(path) for path in self.file_names }
 
-        self.word_paths = defaultdict(list) # stores the bitstring paths for each word
+        # gives every word one id across all the trees. words are numbered in the order they
+        # first appear in the files (in file_names order), so the same files always give the
+        # same word order, and the same pair order (which --resume relies on)
+        self.vocabulary = Vocabulary()
+        # each tree's words by path and path prefix, filled in by build_all. its word_path_ids
+        # are the leaf of each word id in each tree (see leaf_ids)
+        self.path_index = PathIndex(self.vocabulary)
+        # (paths, words, counts) read by multi_file_line_iter, for the path index
+        self.line_entries = defaultdict(lambda: ([], [], []))
         self.trees = list() # list of trees
+        # (paths, words, counts) of the trees built early by load_tree, for build_all
+        self.loaded_entries = dict()
+        self.cache = cache
+        # (leaf_index, score_matrix) of the trees that came from or went into the cache
+        self.score_tables = dict()
+        # the PairTotals of the trees if they are kept (see make_pair_totals), which add_tree
+        # and remove_tree keep up to date
+        self.pair_totals = None
 
     def make_new_tree(self, path):
         """Returns a new tree builder that uses this line_iter"""
@@ -39,35 +72,242 @@ class MultiTreeBuilder:
 
     def multi_file_line_iter(self, file_path):
         """Creates a line_iter usable for a TreeBuilder (takes a file_path and returns an iter that
-        generates (line-number, line-text)), but also saves each path for each word that
-        this generator yields."""
+        generates (line-number, line-text)), but also saves the path, word and count of each
+        line that this generator yields, for the path index."""
+        entries = self.line_entries[file_path]
         for i, line in TreeBuilder.file_line_iter(file_path):
-            path, word, _ = TreeBuilder.tokenize_line(i, line)
-            self.word_paths[word].append(path)
+            path, word, count = TreeBuilder.tokenize_line(i, line)
+            for entry_list, value in zip(entries, (path, word, count)):
+                entry_list.append(value)
             yield i, line
 
-    def build_all(self):
+    def build_all(self, bulk=True, jobs=1):
         """Calls build_tree on each builder in self.tree_builder, then stores a list of results
-        in self.trees"""
-        self.trees = [builder.build_tree() for builder in self.tree_builders.values()]
+        in self.trees. When bulk is true, each file is read with TreeBuilder.read_entries and
+        built with bulk_build_tree instead (the trees and words come out the same).
+
+        With jobs > 1 (and bulk), the files that weren't loaded early are parsed in that many
+        worker processes instead (see load_shared_tree), and their trees are CompactTree views."""
+        if not bulk:
+            with instruments.stage('parse') as stage:
+                self.trees = [builder.build_tree() for builder in self.tree_builders.values()]
+                stage.count('words', sum(len(words) for _, words, _ in self.line_entries.values()))
+            with instruments.stage('index_paths'):
+                for path in self.file_names:
+                    self.path_index.add_tree(path, self.line_entries.pop(path))
+            return
+
+        self.trees = []
+        remaining = [path for path in self.file_names if path not in self.loaded_entries]
+        jobs = min(jobs, len(remaining))
+        if jobs > 1:
+            # the workers inherit this process's resource tracker, so their shared memory blocks
+            # are this process's to unlink, and are unlinked when it exits if something fails
+            resource_tracker.ensure_running()
+        with ProcessPoolExecutor(jobs) if jobs > 1 else nullcontext() as pool:
+            futures = { path: pool.submit(load_shared_tree, path, self.cache) for path in remaining } if jobs > 1 else {}
+            try:
+                # the trees are added in file_names order, so the word ids don't depend on jobs
+                for path, builder in self.tree_builders.items():
+                    if path in futures:
+                        self.add_shared_tree(path, futures.pop(path))
+                    else:
+                        entries = self.loaded_entries.pop(path, None)
+                        if entries is None:
+                            entries = self.read_tree(path)
+                        with instruments.stage('index_paths'):
+                            self.path_index.add_tree(path, entries)
+                    self.trees.append(builder.tree)
+            finally:
+                # only left over if a tree failed to load, and then their blocks aren't needed
+                for future in futures.values():
+                    free_shared_tree(future)
+        if remaining and jobs > 1 and self.cache:
+            # the workers leave evicting to here, so they don't race each other
+            self.cache.evict()
+
+    def add_shared_tree(self, path, future):
+        """Adds the tree that a load_shared_tree worker is loading for path, once it is done"""
+        with instruments.stage('wait_for_trees') as stage:
+            shared, cached = future.result()
+            stage.count('hits' if cached else 'misses')
+        with instruments.stage('attach_trees') as stage:
+            arrays = attach_arrays(*shared)
+            stage.count('bytes', sum(array.nbytes for array in arrays.values()))
+        with instruments.stage('index_paths'):
+            leaves = unpack_strings(arrays['leaves'])
+            ids = self.vocabulary.intern_packed(arrays['words'], arrays['word_hashes'], arrays['word_hash_order'])
+            self.path_index.add_tree_arrays(path, ids, np.asarray(leaves, dtype=str), arrays['word_leaves'],
+                                            arrays['order'], arrays['path_starts'], arrays['cumulative_counts'])
+
+        # the tree's word ids are in file order, and are swapped for ids in the shared vocabulary
+        tree_arrays = { name: arrays['tree_' + name] for name in CompactTree.ARRAY_NAMES }
+        tree_arrays['word_ids'] = ids[tree_arrays['word_ids']]
+        builder = self.tree_builders[path]
+        builder.tree = CompactTree.from_arrays(tree_arrays, self.vocabulary).root
+        builder.leaf_paths = set(leaves)
+        self.score_tables[path] = dict(zip(leaves, range(len(leaves)))), arrays['score_matrix']
+
+    def load_tree(self, path):
+        """Reads and builds the tree at path ahead of build_all, eg while the other paths files
+        are still being written. build_all still adds the words of every tree in file_names
+        order, so the results don't depend on which tree was loaded first."""
+        self.loaded_entries[path] = self.read_tree(path)
+
+    def read_tree(self, path):
+        """Builds the tree of the builder for path and returns its (paths, words, counts) entries.
+        With a cache, a cached tree skips parsing (its builder's tree is then a CompactTree
+        view), and a new one is added to the cache along with its leaf score table."""
+        builder = self.tree_builders[path]
+        with instruments.stage('cache_load') as stage:
+            cached = self.cache.load(path) if self.cache else None
+            stage.count('hits' if cached else 'misses')
+        if cached:
+            entries, self.score_tables[path], compact_tree = cached
+            builder.leaf_paths = set(self.score_tables[path][0])
+            builder.tree = compact_tree.root
+            return entries
+
+        with instruments.stage('parse') as stage:
+            entries = TreeBuilder.read_entries(path)
+            builder.bulk_build_tree(entries)
+            stage.count('words', len(entries[1]))
+            stage.count('bytes', getsize(path))
+        if self.cache:
+            with instruments.stage('cache_store'):
+                self.score_tables[path] = MultiTreeBuilder.leaf_score_table(builder)
+                self.cache.store(path, entries, self.score_tables[path], CompactTree.from_entries(entries))
+        return entries
+
+    def add_tree(self, path):
+        """ Adds the paths file at path as the last tree (after build_all), and adds it to the
+            pair_totals if they are kept, in one pass over the pairs for this tree alone.
+            Its new words get the next ids, so the words come out in the same order as
+            building with path at the end of file_names in the first place."""
+        if path in self.tree_builders:
+            raise ValueError(f'{path} is already one of the trees')
+        self.file_names.append(path)
+        builder = self.tree_builders[path] = self.make_new_tree(path)
+        entries = self.read_tree(path)
+        with instruments.stage('index_paths'):
+            self.path_index.add_tree(path, entries)
+        self.trees.append(builder.tree)
+
+        if self.pair_totals is not None:
+            leaf_index, matrix = self.score_tables.get(path) or MultiTreeBuilder.leaf_score_table(builder)
+            leaves = MultiTreeBuilder.matrix_rows(leaf_index, self.path_index.paths[-1], self.path_index.word_path_ids[-1])
+            self.pair_totals.add_tree(path, self.words, leaves, matrix, TreeCache.key(path))
+
+    def remove_tree(self, path):
+        """ Removes the tree of the paths file at path, and takes it out of the pair_totals if
+            they are kept, in one pass over the pairs for this tree alone. Its words keep their
+            ids, even the ones no tree has now. path can also be a tree that only the
+            pair_totals have (when they were loaded with PairTotals.load)."""
+        in_totals = self.pair_totals is not None and path in self.pair_totals.tree_names
+        if path not in self.tree_builders and not in_totals:
+            raise ValueError(f'{path} is not one of the trees')
+
+        if path in self.tree_builders:
+            t = self.file_names.index(path)
+            del self.file_names[t]
+            if self.trees:
+                del self.trees[t]
+            del self.tree_builders[path]
+            self.score_tables.pop(path, None)
+            self.loaded_entries.pop(path, None)
+            self.path_index.remove_tree(path)
+        if in_totals:
+            self.pair_totals.remove_tree(path)
+
+    def make_pair_totals(self):
+        """ Sets pair_totals to the PairTotals of the trees, so that add_tree and remove_tree
+            keep them up to date. Their scores are the same as score_blocks gives."""
+        score_matrices = self.leaf_score_matrices()
+        leaf_indices = self.word_leaf_indices(score_matrices)
+        self.pair_totals = PairTotals()
+        for path, (_, matrix), leaves in zip(self.file_names, score_matrices, leaf_indices):
+            self.pair_totals.add_tree(path, self.words, leaves, matrix, TreeCache.key(path))
+        return self.pair_totals
+
+    def update_trees(self, file_names):
+        """ Removes and adds trees until the pair_totals are of the trees of file_names, so
+            that only the trees that changed are scored. A file that changed since it was
+            added is removed and added again. The trees end up in file_names order, like a
+            fresh run, so the sums near a whole number are added up in the same order."""
+        totals = self.pair_totals
+        kept = [name for name, key in zip(totals.tree_names, totals.tree_keys)
+                if name in file_names and key == TreeCache.key(name)]
+        removed = [name for name in totals.tree_names if name not in kept]
+        added = [path for path in file_names if path not in kept]
+        for name in removed:
+            self.remove_tree(name)
+        for path in added:
+            self.add_tree(path)
+        totals.order_trees(file_names)
+        return removed, added
 
     def get_tree(self, path: str):
         return self.tree_builders[path].tree
 
-    def analyse(self):
+    @property
+    def words(self):
+        """Every word of the trees, in word id order"""
+        return self.vocabulary.words
+
+    @property
+    def leaf_ids(self):
+        """ A (tree count, word count) int32 array of the leaf of each word id in each tree, or
+            PathIndex.MISSING where the word isn't in the tree. Each tree's leaves are
+            numbered in sorted path order, like the rows of leaf_score_table."""
+        return np.stack(self.path_index.word_path_ids) if self.path_index.word_path_ids else np.empty((0, 0), dtype=np.int32)
+
+    @property
+    def word_paths(self):
+        """ { word -> its paths in tree order }, skipping the trees it isn't in. This is made
+            on demand from the path index, so use words and leaf_ids where it matters."""
+        leaf_paths = [paths.tolist() for paths in self.path_index.paths]
+        return { word: [paths[leaf] for paths, leaf in zip(leaf_paths, leaves) if leaf != PathIndex.MISSING]
+                 for word, leaves in zip(self.words, self.leaf_ids.T.tolist()) }
+
+    def input_hash(self):
+        """A hash of the contents of the paths files, in order. Runs with the same input_hash
+        have the same words in the same order."""
+        digest = sha1()
+        for path in self.file_names:
+            digest.update(TreeCache.key(path).encode())
+        return digest.hexdigest()
+
+    def analyse(self, vectorized=False):
         """ Yields (percent_completion, pairwise_score_value), or
-            (pct_complete: float, (word0: str, word1: str, score: int))"""
+            (pct_complete: float, (word0: str, word1: str, score: int))
+
+            When vectorized is true, the scores come from the numpy engine
+            (vectorized_pairwise_score) instead of the dict based one. The yielded
+            values are identical either way."""
         # this is the of number of yielded values for pairwise_score
-        # == len(combinations(self.word_paths, 2))
-        bitstring_pair_scores = self.bitstring_pair_scores()
+        # == len(combinations(self.words, 2))
+        value_count = self.pair_count()
+        for i, result in enumerate(self.analyse_results(vectorized)):
+            yield i / value_count * 100, result
 
-        print(f'Memoized bitstring pairs in each tree! ({len(bitstring_pair_scores)} pairs)')
+    def pair_count(self):
+        """The number of unique pairs of words"""
+        return len(self.words) * (len(self.words) - 1) // 2
 
-        value_count = len(self.word_paths)
-        value_count *= value_count - 1
-        value_count /= 2
-        for i, result in enumerate(self.pairwise_score(bitstring_pair_scores)):
-            yield i / value_count * 100, result
+    def analyse_results(self, vectorized=False, start=0):
+        """ Yields what analyse does without the percentages, for callers that keep
+            count themselves (which is cheaper than working out a percent per pair).
+            Starts from the start-th pair (in combinations order)."""
+        if vectorized:
+            score_matrices = self.leaf_score_matrices()
+            print(f'Memoized leaf score matrices in each tree! ({sum(m.size for _, m in score_matrices)} pairs)')
+            results = self.vectorized_pairwise_score(score_matrices, start=start)
+        else:
+            bitstring_pair_scores = self.bitstring_pair_scores()
+            print(f'Memoized bitstring pairs in each tree! ({len(bitstring_pair_scores)} pairs)')
+            results = self.pairwise_score(bitstring_pair_scores, start)
+        # the time spent making results, as opposed to the caller writing them out
+        return instruments.timed('score', results, 'pairs')
 
     @staticmethod
     def make_bitstring_key(tree_num, str0, str1):
@@ -80,17 +320,30 @@ class MultiTreeBuilder:
         """ Returns a dict of all tree's cluster combination's scores:
             { make_bitstring_key(tree, leaf0, leaf1) -> score: float
         """
+        with instruments.stage('memoize_leaf_pairs') as stage:
+            bitstring_pair_scores = self.make_bitstring_pair_scores()
+            stage.gauge('bitstring_pair_scores', len(bitstring_pair_scores))
+        return bitstring_pair_scores
+
+    def make_bitstring_pair_scores(self):
+        """bitstring_pair_scores, without timing it"""
         # fill this dict with (tree: int, leaf0: str, leaf1: str) -> score: float
         bitstring_pair_scores = dict()
         # for each tree
         for i, builder in enumerate(self.tree_builders.values()):
             max_depth = builder.max_depth()
+            # encode each leaf once so the distances don't reparse the strings
+            leaf_codes = { bitstr: TreeBuilder.encode_path(bitstr) for bitstr in builder.leaf_paths }
             # for each unique pair of leaf bitstrings (where a_bitstr != b_bitstr)
             for a_bitstr, b_bitstr in combinations(builder.leaf_paths, 2):
                 # get the distance between the leaves
-                ab_path = TreeBuilder.distance(a_bitstr, b_bitstr)
+                ab_path = TreeBuilder.distance_bits(leaf_codes[a_bitstr], leaf_codes[b_bitstr])
                 key = MultiTreeBuilder.make_bitstring_key(i, a_bitstr, b_bitstr)
                 bitstring_pair_scores[key] = 2 * max_depth / (ab_path + 1)
+            # a word that isn't in the tree adds nothing (see MISSING_PATH)
+            for bitstr in chain(builder.leaf_paths, [MultiTreeBuilder.MISSING_PATH]):
+                key = MultiTreeBuilder.make_bitstring_key(i, bitstr, MultiTreeBuilder.MISSING_PATH)
+                bitstring_pair_scores[key] = 0
             # for each leaf to itself, set the value to 2 * max_depth
             for bitstr in builder.leaf_paths:
                 key = MultiTreeBuilder.make_bitstring_key(i, bitstr, bitstr)
@@ -98,35 +351,848 @@ class MultiTreeBuilder:
                 bitstring_pair_scores[key] = 2 * max_depth
         return bitstring_pair_scores
 
-    def pairwise_score(self, bitstring_pair_scores=None):
+    def pairwise_score(self, bitstring_pair_scores=None, start=0):
         """Yields 3-tuples containing unique pairs of words and their pairwise relation, higher is stronger.
-           Can use prebuilt dict bitstring_pair_scores if don't want to recreate dict"""
+           Can use prebuilt dict bitstring_pair_scores if don't want to recreate dict.
+           Skips the first start pairs."""
         if not bitstring_pair_scores:
             bitstring_pair_scores = self.bitstring_pair_scores()
 
-        for (a, a_bitstrs), (b, b_bitstrs) in combinations(self.word_paths.items(), 2):
+        # each word with its path in every tree, lined up by tree (so a word missing
+        # from a tree gets MISSING_PATH there instead of shifting its later paths)
+        tree_paths = []
+        for paths, leaves in zip(self.path_index.paths, self.path_index.word_path_ids):
+            # leaf MISSING (-1) picks the last entry
+            lookup = paths.tolist() + [MultiTreeBuilder.MISSING_PATH]
+            tree_paths.append([lookup[leaf] for leaf in leaves.tolist()])
+        items = list(zip(self.words, zip(*tree_paths)))
+
+        pairs = combinations(items, 2)
+        if start:
+            # jump to the start-th pair, then carry on as combinations would
+            row, col = MultiTreeBuilder.pair_position(len(items), start)
+            pairs = chain(((items[row], b) for b in items[col:]), combinations(items[row + 1:], 2))
+
+        for (a, a_bitstrs), (b, b_bitstrs) in pairs:
             edge_weight = 1  # lowest weight will be 1
             for i, strs in enumerate(zip(a_bitstrs, b_bitstrs)):
                 key = MultiTreeBuilder.make_bitstring_key(i, *strs)
                 edge_weight += bitstring_pair_scores[key]
             yield a, b, ceil(edge_weight)
 
+    def leaf_score_matrices(self):
+        """ Returns a list with one (leaf_index, score_matrix) pair per tree, where
+            leaf_index is { leaf bitstring -> row/column in score_matrix } and
+            score_matrix[x, y] holds the same value as
+            bitstring_pair_scores[make_bitstring_key(tree, leaf_x, leaf_y)]"""
+        with instruments.stage('memoize_leaf_pairs') as stage:
+            score_matrices = [self.score_tables.get(path) or MultiTreeBuilder.leaf_score_table(builder)
+                              for path, builder in self.tree_builders.items()]
+            stage.gauge('score_matrix_entries', sum(matrix.size for _, matrix in score_matrices))
+        return score_matrices
 
-if __name__ == "__main__":
+    @staticmethod
+    def leaf_score_table(builder: TreeBuilder):
+        """ The (leaf_index, score_matrix) pair of leaf_score_matrices for one tree"""
+        max_depth = builder.max_depth()
+        leaves, (bits, lengths) = builder.leaf_path_codes()
+        leaf_index = { leaf: i for i, leaf in enumerate(leaves) }
+        # distances between every pair of leaves at once. the diagonal is each
+        # leaf to itself, where ab_path is always 0
+        ab_paths = TreeBuilder.batch_distance(bits[:, None], lengths[:, None], bits[None, :], lengths[None, :])
+        matrix = (2 * max_depth) / (ab_paths + 1.0)
+        return leaf_index, matrix
+
+    def word_leaf_indices(self, score_matrices):
+        """ Returns an int32 array of shape (tree count, word count) where entry [i, w] is
+            the row of word w's leaf in the i-th score matrix, and words are ordered
+            as in self.words. A word gets -1 (PathIndex.MISSING) in the trees it isn't
+            in, which (like MISSING_PATH in pairwise_score) adds nothing."""
+        leaf_indices = self.leaf_ids
+        for i, ((leaf_index, _), paths) in enumerate(zip(score_matrices, self.path_index.paths)):
+            leaf_indices[i] = MultiTreeBuilder.matrix_rows(leaf_index, paths, leaf_indices[i])
+        return leaf_indices
+
+    @staticmethod
+    def matrix_rows(leaf_index, paths, tree_leaves):
+        """ One tree's row of leaf_ids (given its sorted paths) as rows of the score matrix
+            with leaf_index, like a row of word_leaf_indices"""
+        # the matrix rows are usually in sorted path order already, but needn't be
+        rows = np.fromiter(map(leaf_index.__getitem__, paths.tolist()), dtype=np.int32, count=len(paths))
+        if np.array_equal(rows, np.arange(len(paths))):
+            return tree_leaves
+        present = tree_leaves != PathIndex.MISSING
+        tree_leaves = tree_leaves.copy()
+        tree_leaves[present] = rows[tree_leaves[present]]
+        return tree_leaves
+
+    @staticmethod
+    def pair_position(word_count, index):
+        """ The (row, col) word indices of the index-th pair of combinations(range(word_count), 2)"""
+        rows, cols = condensed_pairs(word_count, index, index + 1)
+        return int(rows[0]), int(cols[0])
+
+    @staticmethod
+    def pair_blocks(word_count, block_size=1 << 20, start_row=0, end_row=None, start_col=None):
+        """ Splits combinations(range(word_count), 2) into consecutive blocks of
+            whole rows holding roughly block_size pairs each (at least one row).
+            Yields (rows, cols) index arrays in the same order as combinations.
+
+            start_row and end_row limit the blocks to the pairs whose first word
+            is in range(start_row, end_row). If start_col is given, the first row
+            starts at the pair (start_row, start_col), in a block of its own."""
+        if end_row is None:
+            end_row = word_count - 1
+        if start_col is not None and start_row < end_row:
+            if start_col < word_count:
+                yield np.full(word_count - start_col, start_row, dtype=np.int64), np.arange(start_col, word_count, dtype=np.int64)
+            start_row += 1
+        row_lengths = np.arange(word_count - 1, -1, -1, dtype=np.int64)
+        start = start_row
+        while start < end_row:
+            # take whole rows until the block is full
+            end = start + 1
+            taken = row_lengths[start]
+            while end < end_row and taken + row_lengths[end] <= block_size:
+                taken += row_lengths[end]
+                end += 1
+
+            lengths = row_lengths[start:end]
+            rows = np.repeat(np.arange(start, end, dtype=np.int64), lengths)
+            # offset of each pair within its own row
+            row_starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+            cols = np.arange(len(rows), dtype=np.int64) - row_starts + rows + 1
+            yield rows, cols
+            start = end
+
+    @staticmethod
+    def row_shards(word_count, shard_count, start_row=0):
+        """ Splits the rows of combinations(range(word_count), 2) from start_row on into at most
+            shard_count consecutive (start_row, end_row) ranges holding roughly the same number of pairs"""
+        row_lengths = np.arange(word_count - 1 - start_row, 0, -1, dtype=np.int64)
+        if not len(row_lengths):
+            return []
+        # pairs before each row, then cut where it crosses each multiple of the shard size
+        pairs_before = np.cumsum(row_lengths) - row_lengths
+        cuts = np.searchsorted(pairs_before, np.linspace(0, pairs_before[-1] + 1, shard_count + 1)[1:-1])
+        bounds = [0, *sorted(set(cuts.tolist()) - {0, len(row_lengths)}), len(row_lengths)]
+        return [(start_row + start, start_row + end) for start, end in zip(bounds, bounds[1:])]
+
+    @staticmethod
+    def score_pairs(score_matrices, leaf_indices, rows, cols):
+        """ Returns the int scores for the word pairs (rows[k], cols[k]), given the
+            leaf_score_matrices and word_leaf_indices arrays"""
+        return np.ceil(MultiTreeBuilder.pair_sums([matrix for _, matrix in score_matrices], leaf_indices, rows, cols)).astype(np.int64)
+
+    @staticmethod
+    def pair_sums(matrices, leaf_indices, rows, cols):
+        """ The float sums that score_pairs rounds up: 1 plus each tree's score of the pair"""
+        edge_weights = np.ones(len(rows))  # lowest weight will be 1
+        # trees are added in order so that the float sums match pairwise_score
+        for matrix, tree_leaves in zip(matrices, leaf_indices):
+            edge_weights += MultiTreeBuilder.tree_pair_scores(matrix, tree_leaves, rows, cols)
+        return edge_weights
+
+    @staticmethod
+    def tree_pair_scores(matrix, tree_leaves, rows, cols):
+        """ One tree's score of each word pair (rows[k], cols[k]), 0 where either word isn't in it"""
+        a_leaves, b_leaves = tree_leaves[rows], tree_leaves[cols]
+        present = (a_leaves >= 0) & (b_leaves >= 0)
+        return np.where(present, matrix[a_leaves, b_leaves], 0.0)
+
+    def score_blocks(self, score_matrices=None, block_size=1 << 20, start=0):
+        """ Yields (rows, cols, scores) int arrays covering every unique pair of words
+            from the start-th on, in the same order as pairwise_score, where rows and
+            cols index into self.words."""
+        if score_matrices is None:
+            score_matrices = self.leaf_score_matrices()
+        leaf_indices = self.word_leaf_indices(score_matrices)
+
+        start_row, start_col = MultiTreeBuilder.pair_position(len(self.words), start) if start else (0, None)
+        for rows, cols in MultiTreeBuilder.pair_blocks(len(self.words), block_size, start_row, start_col=start_col):
+            yield rows, cols, MultiTreeBuilder.score_pairs(score_matrices, leaf_indices, rows, cols)
+
+    def score_upper_bound(self):
+        """ The highest score any pair of words can get: 1 plus the score of a leaf
+            with itself (2 * max_depth) in every tree (of the pair_totals, if kept)"""
+        if self.pair_totals is not None:
+            return self.pair_totals.score_upper_bound()
+        return ceil(1 + sum(2 * builder.max_depth() for builder in self.tree_builders.values()))
+
+    def write_binary(self, output_path, block_size=1 << 20):
+        """ Writes every word pair's score to the '.npy' file at output_path as a condensed
+            upper triangle (see analysis.py), and the words to the '.vocab' file next to it.
+            The scores are unsigned ints of the smallest width that fits score_upper_bound.
+            When pair_totals are kept, the scores and words are theirs.
+
+            Yields (percent_completion, ScoreHistogram of the block) after each block."""
+        if self.pair_totals is not None:
+            words, blocks = self.pair_totals.words, self.pair_totals.score_blocks(block_size)
+        else:
+            score_matrices = self.leaf_score_matrices()
+            print(f'Memoized leaf score matrices in each tree! ({sum(m.size for _, m in score_matrices)} pairs)')
+            words, blocks = self.words, self.score_blocks(score_matrices, block_size)
+
+        write_vocab(output_path, words)
+
+        value_count = len(words) * (len(words) - 1) // 2
+        dtype = np.uint16 if self.score_upper_bound() <= np.iinfo(np.uint16).max else np.uint32
+        scores_out = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=(value_count,))
+
+        done = 0
+        blocks = instruments.timed('score', blocks, 'pairs', lambda block: len(block[2]))
+        for _, _, scores in blocks:
+            scores_out[done:done + len(scores)] = scores
+            done += len(scores)
+            block_histogram = ScoreHistogram()
+            block_histogram.add_many(scores)
+            yield done / value_count * 100, block_histogram
+        scores_out.flush()
+        del scores_out
+        if self.pair_totals is not None:
+            self.pair_totals.save(totals_path(output_path))
+
+    @staticmethod
+    def word_signatures(leaf_indices):
+        """ Groups the words that are on the same leaf in every tree, since they score the same
+            against everything. Returns (signatures, word_signature, members, member_starts):
+            signatures is a (tree count, signature count) array of leaf indices, sorted by the
+            leaf in tree 0 first, word_signature is each word's signature, and the words of
+            signature p are members[member_starts[p]:member_starts[p + 1]] (in word order)."""
+        signatures, word_signature = np.unique(leaf_indices.T, axis=0, return_inverse=True)
+        word_signature = word_signature.reshape(-1)
+        members = np.argsort(word_signature, kind='stable')
+        member_starts = np.concatenate(([0], np.cumsum(np.bincount(word_signature, minlength=len(signatures)))))
+        return signatures.T, word_signature, members, member_starts
+
+    @staticmethod
+    def expand_signature_pairs(members, member_starts, sig_a, sig_b):
+        """ Returns the (rows, cols) word pairs (rows < cols) made from the members of the
+            signature pairs (sig_a[n], sig_b[n]). A signature paired with itself gives the
+            pairs of its own words."""
+        sizes = np.diff(member_starts)
+        a_sizes, b_sizes = sizes[sig_a], sizes[sig_b]
+        counts = a_sizes * b_sizes
+        pair_of = np.repeat(np.arange(len(sig_a)), counts)
+        offsets = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        a = members[member_starts[sig_a][pair_of] + offsets // b_sizes[pair_of]]
+        b = members[member_starts[sig_b][pair_of] + offsets % b_sizes[pair_of]]
+        keep = a != b
+        # within a signature each pair shows up both ways round, so keep one of them
+        keep &= (sig_a[pair_of] != sig_b[pair_of]) | (a < b)
+        a, b = a[keep], b[keep]
+        return np.minimum(a, b), np.maximum(a, b), pair_of[keep]
+
+    def sparse_scores(self, threshold=None, top_k=None, score_matrices=None):
+        """ Returns (rows, cols, scores) arrays of only some of the word pairs, sorted in the
+            same order as pairwise_score (rows < cols index into self.words):
+            - with threshold, the pairs scoring at least threshold
+            - with top_k, each word's top_k highest scoring pairs (ties broken by the
+              leaves in tree 0), merged so a pair listed by both words shows up once
+
+            Words are scored per signature (see word_signatures), and each signature is only
+            compared with the signatures on its nearest leaves (see nearest_signatures), until
+            the rest can't reach threshold or its top_k-th score. So unless most pairs make
+            the cut, the time grows with the vocabulary rather than its square."""
+        if (threshold is None) == (top_k is None):
+            raise ValueError('sparse_scores needs exactly one of threshold or top_k')
+        if score_matrices is None:
+            score_matrices = self.leaf_score_matrices()
+        leaf_indices = self.word_leaf_indices(score_matrices)
+        signatures, word_signature, members, member_starts = MultiTreeBuilder.word_signatures(leaf_indices)
+
+        if threshold is not None:
+            sig_a, sig_b, sig_scores = MultiTreeBuilder.signature_pairs_above(score_matrices, signatures, threshold)
+            rows, cols, pair_of = MultiTreeBuilder.expand_signature_pairs(members, member_starts, sig_a, sig_b)
+            scores = sig_scores[pair_of]
+        else:
+            rows, cols, scores = MultiTreeBuilder.top_k_pairs(score_matrices, signatures, members, member_starts, top_k)
+
+        order = np.lexsort((cols, rows))
+        return rows[order], cols[order], scores[order]
+
+    @staticmethod
+    def leaf_neighbours(score_matrices, signatures):
+        """ Returns one (nearest, nearest_scores, ring_starts, by_leaf, leaf_starts) tuple per tree
+            for nearest_signatures: nearest[x] is every leaf ordered from the nearest to leaf x
+            (highest score) out, nearest_scores[x] their scores against x, ring_starts[x] where
+            each distance from x starts in them (and their end), and the signatures on leaf y
+            are by_leaf[leaf_starts[y]:leaf_starts[y + 1]]"""
+        neighbours = []
+        for (_, matrix), tree_leaves in zip(score_matrices, signatures):
+            nearest = np.argsort(-matrix, axis=1, kind='stable')
+            nearest_scores = np.take_along_axis(matrix, nearest, axis=1)
+            ring_starts = [np.flatnonzero(np.diff(row, prepend=np.inf)).tolist() + [len(row)] for row in nearest_scores]
+            by_leaf = np.argsort(tree_leaves, kind='stable')
+            # the signatures missing from the tree (-1) sort first, and are on no leaf
+            leaf_starts = np.searchsorted(tree_leaves[by_leaf], np.arange(len(matrix) + 1))
+            neighbours.append((nearest, nearest_scores.tolist(), ring_starts, by_leaf, leaf_starts))
+        return neighbours
+
+    @staticmethod
+    def nearest_signatures(score_matrices, signatures, neighbours, p, later_only=False):
+        """ Yields (sigs, scores, bound) for signature p, walking out from its leaf in every tree
+            at once: sigs are the signatures on the next nearest leaves that p wasn't compared
+            with yet, scores are their scores against p, and bound is the most 1 + total (the
+            score before ceil) any signature not yielded yet can have against p. Each step takes the leaves at
+            the next distance in the tree where they score highest, so a subtree is only
+            reached once every nearer one was, and the caller stops when bound is too low.
+
+            The signatures that share no tree with p (which score 1) come last, in one go.
+            With later_only, signatures before p are skipped. neighbours is leaf_neighbours."""
+        seen = np.zeros(signatures.shape[1], dtype=bool)
+        seen[:p] = later_only
+        # per tree p is in: its leaves from nearest out, their scores, and where each distance starts
+        walks = []
+        for (nearest, nearest_scores, ring_starts, by_leaf, leaf_starts), leaf in zip(neighbours, signatures[:, p].tolist()):
+            if leaf >= 0:
+                walks.append((nearest[leaf], nearest_scores[leaf], ring_starts[leaf], by_leaf, leaf_starts))
+        rings = [0] * len(walks)
+
+        def next_score(w):
+            _, leaf_scores, ring_starts, _, _ = walks[w]
+            return leaf_scores[ring_starts[rings[w]]] if rings[w] + 1 < len(ring_starts) else 0.0
+
+        uppers = [next_score(w) for w in range(len(walks))]
+        while any(uppers):
+            w = max(range(len(walks)), key=uppers.__getitem__)
+            leaves, _, ring_starts, by_leaf, leaf_starts = walks[w]
+            ring = leaves[ring_starts[rings[w]]:ring_starts[rings[w] + 1]]
+            rings[w] += 1
+            uppers[w] = next_score(w)
+
+            # the signatures on the leaves of the ring, in one gather
+            starts, lengths = leaf_starts[ring], leaf_starts[ring + 1] - leaf_starts[ring]
+            offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            sigs = by_leaf[np.repeat(starts, lengths) + offsets]
+            sigs = sigs[~seen[sigs]]
+            seen[sigs] = True
+            scores = MultiTreeBuilder.score_pairs(score_matrices, signatures, np.full(len(sigs), p), sigs)
+            yield sigs, scores, 1 + sum(uppers)
+
+        sigs = np.flatnonzero(~seen)
+        yield sigs, MultiTreeBuilder.score_pairs(score_matrices, signatures, np.full(len(sigs), p), sigs), -np.inf
+
+    @staticmethod
+    def reachable(bound, score):
+        """ Whether a pair whose 1 + total is at most bound can score score: ceil(1 + total) >= score
+            needs 1 + total > score - 1 (with some room for the float sums)"""
+        return bound > score - 1 - 1e-9
+
+    @staticmethod
+    def signature_pairs_above(score_matrices, signatures, threshold):
+        """ Returns (sig_a, sig_b, scores) for the signature pairs (sig_a <= sig_b) scoring at
+            least threshold, comparing each signature only with the later ones on its nearest
+            leaves (see nearest_signatures)"""
+        neighbours = MultiTreeBuilder.leaf_neighbours(score_matrices, signatures)
+        found = []
+        for p in range(signatures.shape[1]):
+            for sigs, scores, bound in MultiTreeBuilder.nearest_signatures(score_matrices, signatures, neighbours, p, later_only=True):
+                above = scores >= threshold
+                found.append((np.full(above.sum(), p), sigs[above], scores[above]))
+                if not MultiTreeBuilder.reachable(bound, threshold):
+                    break
+
+        if not found:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return tuple(np.concatenate(parts) for parts in zip(*found))
+
+    @staticmethod
+    def top_k_pairs(score_matrices, signatures, members, member_starts, top_k):
+        """ Returns (rows, cols, scores) for the union of every word's top_k pairs (rows < cols).
+            Each signature is compared with the signatures on its nearest leaves (see
+            nearest_signatures) until the rest can't reach the score of its top_k + 1-th word."""
+        sizes = np.diff(member_starts)
+        neighbours = MultiTreeBuilder.leaf_neighbours(score_matrices, signatures)
+        found = []
+        for p in range(signatures.shape[1]):
+            seen_sigs, seen_scores = [], []
+            word_total = 0
+            for sigs, scores, bound in MultiTreeBuilder.nearest_signatures(score_matrices, signatures, neighbours, p):
+                seen_sigs.append(sigs)
+                seen_scores.append(scores)
+                word_total += sizes[sigs].sum()
+                if word_total > top_k:
+                    # the score of the top_k + 1-th best word so far, one of which might be p's own
+                    all_scores = np.concatenate(seen_scores)
+                    ranked = np.argsort(-all_scores, kind='stable')
+                    cutoff = all_scores[ranked[np.searchsorted(np.cumsum(sizes[np.concatenate(seen_sigs)][ranked]), top_k + 1)]]
+                    if not MultiTreeBuilder.reachable(bound, cutoff):
+                        break
+
+            # in signature order, so ties rank by the leaves in tree 0 as if every signature was scored
+            seen_sigs, seen_scores = np.concatenate(seen_sigs), np.concatenate(seen_scores)
+            order = np.argsort(seen_sigs)
+            seen_sigs, row = seen_sigs[order], seen_scores[order]
+            # the best top_k + 1 words, one of which might be the word itself
+            ranked = np.argsort(-row, kind='stable')
+            last = np.searchsorted(np.cumsum(sizes[seen_sigs[ranked]]), top_k + 1)
+            ranked = ranked[:last + 1]
+            candidates = np.concatenate([members[member_starts[q]:member_starts[q + 1]] for q in seen_sigs[ranked]])[:top_k + 1]
+            candidate_scores = np.repeat(row[ranked], sizes[seen_sigs[ranked]])[:top_k + 1]
+
+            words = members[member_starts[p]:member_starts[p + 1]]
+            is_self = candidates[None, :] == words[:, None]
+            keep = ~is_self
+            # words that aren't among their own best top_k + 1 only get the first top_k
+            if len(candidates) > top_k:
+                keep[~is_self.any(axis=1), top_k] = False
+            word_at, candidate_at = np.nonzero(keep)
+            a, b = words[word_at], candidates[candidate_at]
+            found.append((np.minimum(a, b), np.maximum(a, b), candidate_scores[candidate_at]))
+
+        if not found:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows, cols, scores = (np.concatenate(parts) for parts in zip(*found))
+        word_count = len(members)
+        _, first = np.unique(rows * word_count + cols, return_index=True)
+        return rows[first], cols[first], scores[first]
+
+    def sparse_pairwise_score(self, threshold=None, top_k=None):
+        """Yields 3-tuples like pairwise_score, but only for the pairs kept by sparse_scores"""
+        words = self.words
+        with instruments.stage('score') as stage:
+            rows, cols, scores = self.sparse_scores(threshold, top_k)
+            stage.count('pairs', len(scores))
+        for a, b, score in zip(rows.tolist(), cols.tolist(), scores.tolist()):
+            yield words[a], words[b], score
+
+    def write_sparse(self, output_path, threshold=None, top_k=None):
+        """ Writes the pairs kept by sparse_scores to the '.npy' file at output_path as
+            EDGE_DTYPE records, and the words to the '.vocab' file next to it.
+            Returns the ScoreHistogram of the written scores"""
+        if self.score_upper_bound() > np.iinfo(EDGE_DTYPE['score']).max:
+            raise ValueError(f'Scores up to {self.score_upper_bound()} do not fit in the sparse score format')
+        write_vocab(output_path, self.words)
+        with instruments.stage('score') as stage:
+            rows, cols, scores = self.sparse_scores(threshold, top_k)
+            stage.count('pairs', len(scores))
+        edges = np.empty(len(rows), dtype=EDGE_DTYPE)
+        edges['i'], edges['j'], edges['score'] = rows, cols, scores
+        np.save(output_path, edges)
+        histogram = ScoreHistogram()
+        histogram.add_many(scores)
+        return histogram
+
+    def analyse_sharded(self, output_path, jobs, csv_kwargs, shards_per_job=4, inverted_path=None, invert_max=None, start=0):
+        """ Scores every word pair across jobs worker processes and appends the rows to the
+            csv at output_path, in the same order (and bytes) as writing analyse() serially.
+            If inverted_path is given, the rows are also appended there inverted with
+            invert_max (see ScoreCsvWriter), and output_path can be None to skip the raw csv.
+            The pairs before the start-th are skipped.
+
+            The upper triangle of word pairs is split into row-block shards, each worker writes
+            its shards to '<output_path>.shard<n>' files, and the shards are concatenated onto
+            output_path in order (then deleted). The leaf score tables go to each worker once,
+            when it starts.
+
+            Yields (percent_completion, ScoreHistogram of the shard) as each shard is added."""
+        score_matrices = self.leaf_score_matrices()
+        print(f'Memoized leaf score matrices in each tree! ({sum(m.size for _, m in score_matrices)} pairs)')
+        leaf_indices = self.word_leaf_indices(score_matrices)
+        words = self.words
+
+        start_row, start_col = MultiTreeBuilder.pair_position(len(words), start) if start else (0, None)
+        shards = MultiTreeBuilder.row_shards(len(words), jobs * shards_per_job, start_row)
+        value_count = len(words) * (len(words) - 1) / 2
+        init_args = (words, score_matrices, leaf_indices, csv_kwargs, invert_max)
+        output_paths = (output_path, inverted_path)
+
+        with ProcessPoolExecutor(jobs, initializer=_init_shard_worker, initargs=init_args) as pool:
+            futures = [pool.submit(_write_shard, [f'{path}.shard{n}' if path is not None else None for path in output_paths],
+                                   shard_start, shard_end, start_col if n == 0 else None)
+                       for n, (shard_start, shard_end) in enumerate(shards)]
+
+            done = start
+            outputs = [open(path, 'ab') if path is not None else None for path in output_paths]
+            try:
+                # waiting on each shard in order keeps the output ordered, while
+                # the later shards keep running in the background
+                for future in futures:
+                    with instruments.stage('wait_for_shards') as stage:
+                        shard_paths, shard_histogram = future.result()
+                        stage.count('pairs', shard_histogram.total)
+                    for shard_path, output in zip(shard_paths, outputs):
+                        if shard_path is None:
+                            continue
+                        with instruments.stage('concatenate_shards') as stage:
+                            with open(shard_path, 'rb') as shard:
+                                copyfileobj(shard, output, 1 << 20)
+                            stage.count('bytes', getsize(shard_path))
+                        remove(shard_path)
+                    for output in filter(None, outputs):
+                        output.flush()
+                    done += shard_histogram.total
+                    yield done / value_count * 100, shard_histogram
+            finally:
+                for output in filter(None, outputs):
+                    output.close()
+
+    def vectorized_pairwise_score(self, score_matrices=None, block_size=1 << 20, start=0):
+        """Yields the same 3-tuples as pairwise_score, but scores whole blocks of word
+           pairs at a time with numpy. Can use prebuilt score_matrices from
+           leaf_score_matrices if don't want to recreate them"""
+        words = self.words
+        for rows, cols, scores in self.score_blocks(score_matrices, block_size, start):
+            for a, b, score in zip(rows.tolist(), cols.tolist(), scores.tolist()):
+                yield words[a], words[b], score
+
+
+class PairTotals:
+    """ The sum behind every word pair's score (1 plus each tree's score of the pair; the
+        score is its ceil), along with each tree's part of it in compact form: the leaf
+        of each word (its row in the tree's score matrix) and the score matrix. Adding or
+        removing a tree is then one vectorized pass over the pairs for that tree alone.
+
+        The sums are kept in fixed point, SCALE units to 1 with each tree's score rounded
+        to a unit, in the narrowest unsigned int that fits the highest score. That is off
+        by at most half a unit per tree, so score_blocks adds up the trees again in order
+        (like score_pairs) for the sums that near a whole number, and the scores come out
+        the same as scoring the trees from scratch. That needs the trees in the same order
+        as a fresh run, which update_trees keeps with order_trees.
+
+        Words keep their ids once they are added, even when the trees they were in are
+        removed, so the totals cover every word ever added. words and score_blocks skip the
+        ones no tree has now."""
+
+    SCALE = 256
+
+    def __init__(self):
+        self.vocabulary = Vocabulary()
+        # the trees' names (their paths files), TreeCache.key and leaf and score matrix
+        self.tree_names, self.tree_keys, self.leaf_ids, self.matrices = [], [], [], []
+        # condensed, in combinations order over the word ids up to word_count
+        self.word_count = 0
+        self.totals = np.zeros(0, dtype=np.min_scalar_type(PairTotals.SCALE))
+
+    def present_words(self):
+        """A bool array of which word ids are in at least one tree"""
+        if not self.leaf_ids:
+            return np.zeros(self.word_count, dtype=bool)
+        return (np.stack(self.leaf_ids) != PathIndex.MISSING).any(axis=0)
+
+    @property
+    def words(self):
+        """The words in at least one tree, in id order"""
+        return [word for word, present in zip(self.vocabulary.words, self.present_words().tolist()) if present]
+
+    def score_upper_bound(self):
+        """ Like MultiTreeBuilder.score_upper_bound, the biggest entry of a score matrix
+            being a leaf with itself"""
+        return ceil(1 + sum(matrix.max(initial=0) for matrix in self.matrices))
+
+    @staticmethod
+    def fixed_point(matrix):
+        """ The score matrix in SCALE units, with a row and column of zeros at the end for
+            the words that aren't in the tree (leaf -1)"""
+        fixed = np.zeros((len(matrix) + 1, len(matrix) + 1), dtype=np.int64)
+        fixed[:-1, :-1] = np.round(matrix * PairTotals.SCALE)
+        return fixed
+
+    def fit_totals(self):
+        """Makes totals the narrowest unsigned int type that fits the highest total of the trees"""
+        highest = PairTotals.SCALE + sum(PairTotals.fixed_point(matrix).max() for matrix in self.matrices)
+        dtype = np.min_scalar_type(highest)
+        if dtype != self.totals.dtype:
+            self.totals = self.totals.astype(dtype)
+
+    def add_tree(self, name, words, word_leaves, matrix, key):
+        """ Adds the tree called name (with TreeCache.key key), where words[k] is on the row
+            word_leaves[k] of its score matrix (PathIndex.MISSING if it isn't in the tree).
+            New words get the next ids, in the order they come."""
+        if name in self.tree_names:
+            raise ValueError(f'{name} is already in the pair totals')
+        ids = self.vocabulary.intern_all(words)
+        self.grow(len(self.vocabulary))
+        leaves = np.full(len(self.vocabulary), PathIndex.MISSING, dtype=np.int32)
+        leaves[ids] = word_leaves
+
+        self.tree_names.append(name)
+        self.tree_keys.append(key)
+        self.leaf_ids.append(leaves)
+        self.matrices.append(matrix)
+        self.fit_totals()
+        self.update(leaves, matrix, np.add)
+
+    def remove_tree(self, name):
+        """Removes the tree called name"""
+        if name not in self.tree_names:
+            raise ValueError(f'{name} is not in the pair totals')
+        t = self.tree_names.index(name)
+        leaves, matrix = self.leaf_ids[t], self.matrices[t]
+        for tree_arrays in (self.tree_names, self.tree_keys, self.leaf_ids, self.matrices):
+            del tree_arrays[t]
+        self.update(leaves, matrix, np.subtract)
+        self.fit_totals()
+
+    def order_trees(self, names):
+        """ Puts the trees in the order of names, which score_blocks adds them up in. The
+            totals themselves don't depend on the order."""
+        order = sorted(range(len(self.tree_names)), key=lambda t: names.index(self.tree_names[t]))
+        for tree_arrays in (self.tree_names, self.tree_keys, self.leaf_ids, self.matrices):
+            tree_arrays[:] = [tree_arrays[t] for t in order]
+
+    def grow(self, word_count, block_size=1 << 20):
+        """Makes room for the pairs of word_count words. Nothing is added for the new words,
+        since the trees so far don't have them."""
+        if word_count == self.word_count:
+            return
+        totals = np.full(word_count * (word_count - 1) // 2, PairTotals.SCALE, dtype=self.totals.dtype)
+        # each old row goes at the start of its longer new row
+        done = 0
+        for rows, cols in MultiTreeBuilder.pair_blocks(self.word_count, block_size):
+            totals[rows * word_count - rows * (rows + 1) // 2 + cols - rows - 1] = self.totals[done:done + len(rows)]
+            done += len(rows)
+        self.totals = totals
+        self.leaf_ids = [np.concatenate([leaves, np.full(word_count - self.word_count, PathIndex.MISSING, dtype=np.int32)])
+                         for leaves in self.leaf_ids]
+        self.word_count = word_count
+
+    def update(self, leaves, matrix, op, block_size=1 << 20):
+        """ Adds (op np.add) or takes away (np.subtract) the scores of the tree with leaves and
+            matrix from every total, a block of pairs at a time"""
+        fixed = PairTotals.fixed_point(matrix).astype(self.totals.dtype)
+        with instruments.stage('update_totals') as stage:
+            done = 0
+            for rows, cols in MultiTreeBuilder.pair_blocks(self.word_count, block_size):
+                block = self.totals[done:done + len(rows)]
+                op(block, fixed[leaves[rows], leaves[cols]], out=block)
+                done += len(rows)
+            stage.count('pairs', done)
+
+    def score_blocks(self, block_size=1 << 20):
+        """ Yields (rows, cols, scores) int arrays like MultiTreeBuilder.score_blocks, where
+            rows and cols index into words"""
+        present = self.present_words()
+        # the index in words of each word id
+        word_numbers = np.cumsum(present) - 1
+        # a total this many units from a whole number might have the other ceil
+        near = len(self.tree_names) // 2 + 1
+        done = 0
+        for rows, cols in MultiTreeBuilder.pair_blocks(self.word_count, block_size):
+            block = self.totals[done:done + len(rows)].astype(np.int64)
+            done += len(rows)
+            if not present.all():
+                kept = present[rows] & present[cols]
+                rows, cols, block = rows[kept], cols[kept], block[kept]
+            scores = -(-block // PairTotals.SCALE)
+            units = block % PairTotals.SCALE
+            again = np.flatnonzero((units <= near) | (units >= PairTotals.SCALE - near))
+            scores[again] = np.ceil(MultiTreeBuilder.pair_sums(self.matrices, self.leaf_ids, rows[again], cols[again]))
+            yield word_numbers[rows], word_numbers[cols], scores
+
+    def save(self, path):
+        """Writes the totals to the '.npz' file at path (see analysis.totals_path)"""
+        arrays = {
+            'words': pack_strings(self.vocabulary.words),
+            'tree_names': pack_strings(self.tree_names),
+            'tree_keys': pack_strings(self.tree_keys),
+            'leaf_ids': np.stack(self.leaf_ids) if self.leaf_ids else np.empty((0, self.word_count), dtype=np.int32),
+            'totals': self.totals,
+        }
+        arrays.update((f'matrix_{t}', matrix) for t, matrix in enumerate(self.matrices))
+        with atomic_write(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def load(path):
+        """Reads the totals written by save"""
+        totals = PairTotals()
+        with np.load(path, allow_pickle=False) as data:
+            if data['totals'].dtype.kind != 'u':
+                raise ValueError(f'{path} holds float totals from an older multiTree.py, run once without --update to remake it')
+            totals.vocabulary = Vocabulary.from_words(unpack_strings(data['words']))
+            totals.tree_names = unpack_strings(data['tree_names'])
+            totals.tree_keys = unpack_strings(data['tree_keys'])
+            totals.leaf_ids = list(data['leaf_ids'])
+            totals.matrices = [data[f'matrix_{t}'] for t in range(len(totals.tree_names))]
+            totals.totals = data['totals']
+        totals.word_count = len(totals.vocabulary)
+        return totals
+
+
+def share_arrays(arrays):
+    """Copies { name -> array } into one new shared memory block, for another process to
+    attach_arrays. Returns (the block's name, layout), which are small enough to pickle."""
+    layout, size = [], 0
+    for name, array in arrays.items():
+        # keep every array 8 byte aligned
+        size = -(-size // 8) * 8
+        layout.append((name, array.dtype.str, array.shape, size))
+        size += array.nbytes
+    block = SharedMemory(create=True, size=max(size, 1))
+    for (name, dtype, shape, offset), array in zip(layout, arrays.values()):
+        np.ndarray(shape, dtype, buffer=block.buf, offset=offset)[...] = array
+    block.close()
+    return block.name, layout
+
+class SharedArray:
+    """One array in a SharedMemory block, for np.asarray to wrap without copying. Unlike
+    np.ndarray(buffer=block.buf), whose views lock block.buf so that the block can't be closed
+    while they live, the array (and every view of it) keeps this as its base, and this keeps
+    the block open: it is closed once the last array using it is gone."""
+
+    def __init__(self, block, offset, dtype, shape):
+        address = np.frombuffer(block.buf, dtype=np.uint8).ctypes.data
+        self.block = block
+        self.__array_interface__ = { 'data': (address + offset, False), 'typestr': dtype, 'shape': shape, 'version': 3 }
+
+def attach_arrays(name, layout):
+    """The arrays in the shared memory block made by share_arrays, as views of the block rather
+    than copies. The block is unlinked at once, so nothing is left behind if this process dies,
+    and its memory is freed along with the arrays."""
+    block = SharedMemory(name)
+    block.unlink()
+    return { array_name: np.asarray(SharedArray(block, offset, dtype, shape))
+             for array_name, dtype, shape, offset in layout }
+
+def free_shared_tree(future):
+    """Unlinks the shared memory block of a load_shared_tree future that won't be attached,
+    once it is done (unless it hasn't started, or failed)"""
+    if future.cancel():
+        return
+    try:
+        (name, _), _ = future.result()
+    except Exception:
+        return
+    block = SharedMemory(name)
+    block.close()
+    block.unlink()
+
+def load_shared_tree(path, cache=None):
+    """Loads the paths file at path into shared memory, for MultiTreeBuilder.build_all's worker
+    processes: the arrays of a TreeCache entry (from the cache if it is there) and the
+    PathIndex.tree_arrays, and the words' Vocabulary.packed_hashes for intern_packed. Returns
+    ((name, layout) for attach_arrays, whether it was cached)."""
+    arrays = cache.load_arrays(path) if cache else None
+    cached = arrays is not None
+    if not cached:
+        entries = TreeBuilder.read_entries(path)
+        # the leaf score table only needs the leaves, not the whole tree
+        builder = TreeBuilder(path)
+        builder.leaf_paths = set(entries[0])
+        arrays = TreeCache.entry_arrays(entries, MultiTreeBuilder.leaf_score_table(builder), CompactTree.from_entries(entries))
+        if cache:
+            cache.store_arrays(path, arrays, evict=False)
+    arrays.update(PathIndex.tree_arrays(arrays['word_leaves'], arrays['counts'], len(arrays['score_matrix'])))
+    # hashing the words here leaves the parent only the new words to decode and intern
+    arrays['word_hashes'] = Vocabulary.packed_hashes(arrays['words'])
+    arrays['word_hash_order'] = np.argsort(arrays['word_hashes'])
+    return share_arrays(arrays), cached
+
+
+# per process state for analyse_sharded's workers, set once by _init_shard_worker
+_shard_state = {}
+
+def _init_shard_worker(words, score_matrices, leaf_indices, csv_kwargs, invert_max):
+    _shard_state.update(words=words, score_matrices=score_matrices, leaf_indices=leaf_indices,
+                        csv_kwargs=csv_kwargs, invert_max=invert_max)
+
+def _write_shard(shard_paths, start_row, end_row, start_col=None):
+    """Writes the csv rows for the pairs whose first word is in range(start_row, end_row)
+    (from start_col on in the first row, if given) to the (raw, inverted) shard_paths,
+    skipping a None path. Returns (shard_paths, ScoreHistogram of the shard)"""
+    words = _shard_state['words']
+    histogram = ScoreHistogram()
+    with ScoreCsvWriter(*shard_paths, _shard_state['invert_max'], header=False, **_shard_state['csv_kwargs']) as csv_writer:
+        for rows, cols in MultiTreeBuilder.pair_blocks(len(words), start_row=start_row, end_row=end_row, start_col=start_col):
+            scores = MultiTreeBuilder.score_pairs(_shard_state['score_matrices'], _shard_state['leaf_indices'], rows, cols)
+            csv_writer.writerows((words[a], words[b], score)
+                                 for a, b, score in zip(rows.tolist(), cols.tolist(), scores.tolist()))
+            histogram.add_many(scores)
+    return shard_paths, histogram
+
+
+class Checkpointer:
+    """Keeps '<output_path>.checkpoint.json' up to date while every pair is written out as a
+    csv, so that a killed run can be resumed. A checkpoint records how many pairs (in
+    combinations order) are fully written, where each of csv_paths ends after them and
+    the histogram of their scores. Only a checkpoint with the same settings (a json-able
+    dict of whatever decides the bytes written, like the input_hash) is resumed."""
+
+    # bump when the checkpoint layout changes, so old checkpoints are never resumed
+    VERSION = 1
+
+    def __init__(self, output_path, csv_paths, settings, interval=60, clock=monotonic):
+        """csv_paths are the (raw, inverted) csvs, either of which can be None. A checkpoint
+        is due every interval seconds."""
+        self.path = output_path + '.checkpoint.json'
+        self.csv_paths = list(csv_paths)
+        self.settings = { 'version': Checkpointer.VERSION, 'csv_paths': self.csv_paths, **settings }
+        self.interval = interval
+        self.clock = clock
+        self.next_checkpoint = clock() + interval
+
+    def due(self):
+        return self.clock() >= self.next_checkpoint
+
+    def write(self, pairs_done, histogram):
+        """Records that pairs_done pairs are written. The csvs must be flushed first; they are
+        synced to disk here, so the checkpoint never gets ahead of them."""
+        offsets = []
+        for path in self.csv_paths:
+            if path is None:
+                offsets.append(None)
+                continue
+            with open(path, 'rb+') as f:
+                fsync(f.fileno())
+            offsets.append(getsize(path))
+        with atomic_write(self.path) as f:
+            dump({ 'settings': self.settings, 'pairs_done': pairs_done, 'offsets': offsets,
+                   'histogram': histogram.counts[:histogram.max_value + 1].tolist() }, f)
+        self.next_checkpoint = self.clock() + self.interval
+
+    def resume(self):
+        """Cuts the csvs back to the last checkpoint, returning (pairs_done, histogram) to carry on from"""
+        if not exists(self.path):
+            raise ValueError(f'There is no checkpoint to resume at {self.path}')
+        with open(self.path) as f:
+            checkpoint = load(f)
+        if checkpoint['settings'] != self.settings:
+            raise ValueError(f'The checkpoint at {self.path} is for different trees or flags, so it can\'t be resumed')
+        for path, offset in zip(self.csv_paths, checkpoint['offsets']):
+            if path is None:
+                continue
+            if not exists(path) or getsize(path) < offset:
+                raise ValueError(f'{path} is shorter than its checkpoint, so it can\'t be resumed')
+            with open(path, 'rb+') as f:
+                f.truncate(offset)
+        return checkpoint['pairs_done'], ScoreHistogram.from_counts(checkpoint['histogram'])
+
+    def remove(self):
+        """Drops the checkpoint, once the run it is for has finished (or is starting over)"""
+        if exists(self.path):
+            remove(self.path)
+
+
+def main(args, multi_builder=None):
+    """Runs the multiTree.py command line tool on args (see --help). If multi_builder is given,
+    it is used instead of building one from the --clusters and input name args, and must
+    already have been built (with build_all)."""
     cluster_flag = LiteralFlag('c', 'clusters', 'List of cluster sizes to compare')
     delimiter_flag = LiteralFlag('d', 'delimiter', 'The delimiter string to use\nfor the output file', default_value='\t')
     help_flag = Flag('h', 'help', 'Shows this prompt')
     output_flag = LiteralFlag('o', 'output', 'Where to write csv output', default_value='./multi-tree-output.csv')
+    format_flag = LiteralFlag('f', 'format', "'csv', or 'npy' to store the\nscores in binary (csv becomes\nan export)", default_value='csv')
+    vectorize_flag = Flag('v', 'vectorize', 'Scores word pairs in blocks\nwith numpy')
+    threshold_flag = LiteralFlag('t', 'threshold', 'Only output the pairs scoring\nat least this much')
+    neighbours_flag = LiteralFlag('k', 'neighbours', "Only output each word's\nk highest scoring pairs")
+    cache_flag = Flag('C', 'cache', 'Caches parsed trees in\n' + DEFAULT_CACHE_DIR + '\n(see treeCache.py)')
+    jobs_flag = LiteralFlag('j', 'jobs', 'Number of worker processes\nto load the trees and score\nwith (uses numpy)', default_value=1)
+    instrument_flag = LiteralFlag('I', 'instrument', 'Times each stage of the run,\nthen prints them and writes\nthem to this json file (it is\nalso a chrome://tracing trace)')
+    invert_flag = Flag('i', 'invert', 'Also writes the scores inverted\n(so low value is high correlation)\nto <output>-inverted.csv, in\nthe same pass')
+    inverted_only_flag = Flag('r', 'inverted-only', 'With --invert, skips the\nraw csv')
+    resume_flag = Flag('R', 'resume', 'Carries on from the last\ncheckpoint of a killed run\n(csv of every pair only)')
+    update_flag = Flag('u', 'update', 'Keeps the sums behind the\nscores next to npy output, and\nupdates it from them by adding\nand removing trees to match\nthe cluster sizes. The words\ncome out in the order they were\nfirst added, not in the order\nof a fresh run')
+    profile_flag = LiteralFlag('P', 'profile', "Profiles the scoring into this\nfile, with cProfile if it ends\nin '.prof', else by sampling\nstacks (folded format)")
 
     def print_help():
         print('--- Help ---------------------------------------------')
         print('\tThis tool must be provided with cluster sizes \n\tand the name of the file that was used as\n\tinput to the algorithm (without its extension)')
-        for flag in [cluster_flag, delimiter_flag, help_flag, output_flag]:
+        for flag in [cluster_flag, delimiter_flag, help_flag, output_flag, format_flag, threshold_flag, neighbours_flag, vectorize_flag, cache_flag, jobs_flag, invert_flag, inverted_only_flag, resume_flag, update_flag, instrument_flag, profile_flag]:
             print(flag.format_description(4, 18))
         print('------------------------------------------------------')
 
-    args = Flag.get_terminal_args()
-
     if help_flag.remove_from_args(args):
         print_help()
         exit()
@@ -144,14 +1210,64 @@ if __name__ == "__main__":
         print_help()
         raise ValueError('MultiTree delimiter flag must be followed by a python str literal')
 
+    format_flag.remove_from_args(args)
+    if format_flag.value not in ['csv', 'npy']:
+        print_help()
+        raise ValueError("MultiTree format flag must be 'csv' or 'npy'")
+    binary = format_flag.value == 'npy'
+
     if not output_flag.remove_from_args(args):
         print(f'Using default output location: {output_flag.value}')
     if not isinstance(output_flag.value, str):
         print_help()
         raise ValueError('MultiTree output flag must be a str-literal location of an output file')
+    if binary and not output_flag.value.endswith('.npy'):
+        output_flag.value = splitext(output_flag.value)[0] + '.npy'
     if not exists(output_flag.value):
         print(f'Creating new file for output: {output_flag.value}')
 
+    vectorized = vectorize_flag.remove_from_args(args)
+
+    threshold_flag.remove_from_args(args)
+    neighbours_flag.remove_from_args(args)
+    for flag in [threshold_flag, neighbours_flag]:
+        if flag.value is not None and not isinstance(flag.value, int):
+            print_help()
+            raise ValueError(f'MultiTree {flag.longForm} flag must be followed by an int literal')
+    if threshold_flag.value is not None and neighbours_flag.value is not None:
+        print_help()
+        raise ValueError('MultiTree can only use one of the threshold and neighbours flags')
+    sparse = threshold_flag.value is not None or neighbours_flag.value is not None
+
+    cache = TreeCache() if cache_flag.remove_from_args(args) else None
+
+    invert = invert_flag.remove_from_args(args)
+    raw = not inverted_only_flag.remove_from_args(args)
+    if not raw and (not invert or binary):
+        print_help()
+        raise ValueError('MultiTree inverted-only flag needs the invert flag, and a csv format')
+
+    resume = resume_flag.remove_from_args(args)
+    if resume and (binary or sparse):
+        print_help()
+        raise ValueError('MultiTree can only resume csv output of every pair')
+
+    update = update_flag.remove_from_args(args)
+    if update and (not binary or sparse):
+        print_help()
+        raise ValueError('MultiTree can only update npy output of every pair')
+
+    jobs_flag.remove_from_args(args)
+    if not isinstance(jobs_flag.value, int) or jobs_flag.value < 1:
+        print_help()
+        raise ValueError('MultiTree jobs flag must be followed by a positive int literal')
+
+    for flag in [instrument_flag, profile_flag]:
+        if flag.remove_from_args(args) and not isinstance(flag.value, str):
+            print_help()
+            raise ValueError(f'MultiTree {flag.longForm} flag must be followed by a str-literal file location')
+    instruments.enabled = instrument_flag.value is not None
+
     if not args:
         raise ValueError('MultiTree requires the name of the input file (without extension)')
 
@@ -167,42 +1283,115 @@ if __name__ == "__main__":
     # cluster_flag should have a list of cluster sizes as cluster_flag.value
     # input_name should be a string with the name of the input file for the original brown's algorithm
 
-    files = MultiTreeBuilder.create_file_locs(input_name, cluster_flag.value)
-    multi_builder = MultiTreeBuilder(files)
-    multi_builder.build_all()
+    totals_output = totals_path(output_flag.value)
+    if multi_builder is None:
+        files = MultiTreeBuilder.create_file_locs(input_name, cluster_flag.value)
+        if update and exists(totals_output):
+            # only the trees that aren't in the totals yet are read
+            multi_builder = MultiTreeBuilder([], cache)
+            multi_builder.pair_totals = PairTotals.load(totals_output)
+            removed, added = multi_builder.update_trees(files)
+            print(f'Updated the totals in {totals_output}: removed {len(removed)} trees, added {len(added)}')
+        else:
+            multi_builder = MultiTreeBuilder(files, cache)
+            multi_builder.build_all(jobs=jobs_flag.value)
+    if update and multi_builder.pair_totals is None:
+        multi_builder.make_pair_totals()
 
     csv_kwargs = {'delimiter': delimiter_flag.value}
+    # inverting with the highest possible score instead of the highest one written
+    # means it's known before scoring, so the inverted csv can be written alongside
+    invert_max = multi_builder.score_upper_bound() if invert else None
+    inverted_output = inverted_path(output_flag.value)
+    csv_outputs = (output_flag.value if raw else None, inverted_output if invert else None)
+    written_paths = [output_flag.value] if binary else list(filter(None, csv_outputs))
+
+    # a csv of every pair is checkpointed as it goes, so it can be resumed if the run is killed
+    checkpointer = None
+    start, histogram = 0, ScoreHistogram()
+    if not binary and not sparse:
+        checkpointer = Checkpointer(output_flag.value, csv_outputs,
+                                    { 'input_hash': multi_builder.input_hash(), 'delimiter': delimiter_flag.value, 'invert_max': invert_max })
+        if resume:
+            start, histogram = checkpointer.resume()
+            print(f'Resuming from pair {start:,} of {multi_builder.pair_count():,}')
+        else:
+            checkpointer.remove()
 
     # do algorithm now
-    with open(output_flag.value, 'w+') as f:
-        csv_writer = writer(f, **csv_kwargs)
-        csv_writer.writerow('source target weight'.split())
-        meter = ProgressMeter()
-        written = 0
-        max_value = 0
-        for pct_completion, result in multi_builder.analyse():
-            meter.update_meter(pct_completion)
-            max_value = max(max_value, result[2])
-            csv_writer.writerow(result)
-            written += 1
-
-    print()
-    print(f'done! wrote {written:,} lines to {output_flag.value} (max {max_value})')
-
-    inverted_output = output_flag.value.replace('.csv', "-inverted.csv")
-
-    if inverse := prompt_yn("Do you wish to invert the score so low value is high correlation?"):
-        with open(output_flag.value) as old_file, open(inverted_output, 'w+') as new_file:
-            meter = ProgressMeter()
-            r = reader(old_file, **csv_kwargs)
-            w = writer(new_file, **csv_kwargs)
-            w.writerow(next(r)) # write header
-            for i, (a, b, s) in enumerate(r):
-                meter.update_meter(100 * i / written)
-                w.writerow((a, b, max_value - int(s) + 1))
-        print()
+    # the scores are counted as they are written, so buckets don't need to reread the output
+    stage_seconds = { name: stage.seconds for name, stage in instruments.stages.items() }
+    with instruments.stage('analyse') as analyse_stage, profiled(profile_flag.value):
+        if sparse and binary:
+            histogram = multi_builder.write_sparse(output_flag.value, threshold_flag.value, neighbours_flag.value)
+        elif sparse:
+            with ScoreCsvWriter(*csv_outputs, invert_max, **csv_kwargs) as csv_writer:
+                results = multi_builder.sparse_pairwise_score(threshold_flag.value, neighbours_flag.value)
+                while batch := list(islice(results, 1 << 14)):
+                    csv_writer.writerows(batch)
+                    histogram.add_many(np.fromiter((score for _, _, score in batch), dtype=np.int64, count=len(batch)))
+        elif binary:
+            with progress_meter() as meter:
+                for pct_completion, block_histogram in multi_builder.write_binary(output_flag.value):
+                    meter.update_meter(pct_completion)
+                    histogram.merge(block_histogram)
+        else:
+            with ScoreCsvWriter(*csv_outputs, invert_max, append=resume, **csv_kwargs) as csv_writer, \
+                 progress_meter(multi_builder.pair_count() - start) as meter:
+                pairs_done = start
+                if jobs_flag.value > 1:
+                    csv_writer.flush()
+                    for _, shard_histogram in multi_builder.analyse_sharded(csv_outputs[0], jobs_flag.value, csv_kwargs, inverted_path=csv_outputs[1],
+                                                                            invert_max=invert_max, start=start):
+                        meter.advance(shard_histogram.total)
+                        histogram.merge(shard_histogram)
+                        pairs_done += shard_histogram.total
+                        if checkpointer.due():
+                            checkpointer.write(pairs_done, histogram)
+                else:
+                    results = multi_builder.analyse_results(vectorized, start)
+                    # work in batches of pairs, so the meter and histogram aren't updated per pair
+                    while batch := list(islice(results, 1 << 14)):
+                        csv_writer.writerows(batch)
+                        histogram.add_many(np.fromiter((score for _, _, score in batch), dtype=np.int64, count=len(batch)))
+                        meter.advance(len(batch))
+                        pairs_done += len(batch)
+                        if checkpointer.due():
+                            csv_writer.flush()
+                            checkpointer.write(pairs_done, histogram)
+            checkpointer.remove()
+        analyse_stage.count('pairs', histogram.total - start)
+        analyse_stage.count('bytes_written', sum(map(getsize, written_paths)))
+    if instruments.enabled:
+        # the time analyse took outside of the stages within it (making the scores), which is
+        # formatting and writing the scores, counting them...
+        within = sum(stage.seconds - stage_seconds.get(name, 0) for name, stage in instruments.stages.items() if name != 'analyse')
+        instruments.add_time('write', analyse_stage.seconds - within)
+    written, max_value = histogram.total, histogram.max_value
+
+    print(f'done! wrote {written:,} {"scores" if binary else "lines"} to {" and ".join(written_paths)} (max {max_value})')
+    if invert:
+        print(f'(inverted as {invert_max} - score + 1, {invert_max} being the highest possible score)')
+
+    if binary and prompt_yn("Do you wish to export the scores as a csv?"):
+        csv_output = output_flag.value.replace('.npy', '.csv')
+        export_csv(output_flag.value, csv_output, delimiter_flag.value)
+        print(f"done! wrote to {csv_output}")
+
+    if binary and invert:
+        # the binary file is the one written in the scoring pass, the csvs are exports of it
+        export_csv(output_flag.value, inverted_output, delimiter_flag.value, invert_max=invert_max)
         print(f"done! wrote to {inverted_output}")
-    
+
     if prompt_yn("Do you wish to run buckets?"):
-        make_buckets(inverted_output if inverse else output_flag.value)
+        make_buckets(histogram.inverted(invert_max) if invert else histogram)
         print('done!')
+
+    if instruments.enabled:
+        instruments.report()
+        instruments.dump(instrument_flag.value)
+        print(f'wrote stage timings to {instrument_flag.value}')
+
+
+if __name__ == "__main__":
+    main(Flag.get_terminal_args())
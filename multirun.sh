@@ -1,10 +1,10 @@
 #!/bin/bash
 # here we are going to do the cluster thing
-# ./wcluster --text "" --c ""
+# runs ./wcluster on cleaned-lolcat.txt for each cluster size given,
+# in parallel (see multiRun.py), then multiTree.py on the results
 list=''
 for cluster in "$@"
 do
-    ./wcluster --text cleaned-lolcat.txt --c $cluster
     list="${list},${cluster}"
 done
-python3 multiTree.py --clusters "[${list:1}]" cleaned-lolcat
+python3 multiRun.py --clusters "[${list:1}]" cleaned-lolcat.txt
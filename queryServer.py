@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+from asyncio import run, start_server, start_unix_server, IncompleteReadError, LimitOverrunError
+from collections import defaultdict, deque
+from json import dumps, loads
+from os import remove
+from os.path import exists
+from socket import socket, AF_INET, AF_UNIX, SOCK_STREAM
+from sys import exit
+from time import perf_counter
+
+import numpy as np
+
+from terminalHelpers import *
+from multiTree import MultiTreeBuilder
+
+class QueryError(KeyError):
+    """A query about a word or op that doesn't exist"""
+
+    def __str__(self):
+        return self.args[0]
+
+
+class WordIndex:
+    """The scores of a MultiTreeBuilder's words, answered a query at a time instead of for
+    every pair. Words on the same leaf in every tree (a signature) score the same against
+    everything, so queries score signatures and then spread the scores over their words."""
+
+    def __init__(self, multi_builder: MultiTreeBuilder):
+        self.words = list(multi_builder.words)
+        self.word_ids = { word: i for i, word in enumerate(self.words) }
+        self.tree_names = list(multi_builder.tree_builders)
+        self.score_matrices = multi_builder.leaf_score_matrices()
+        self.leaf_indices = multi_builder.word_leaf_indices(self.score_matrices)
+        self.signatures, self.word_signature, self.members, self.member_starts = MultiTreeBuilder.word_signatures(self.leaf_indices)
+        # for walking out from a word's leaves in neighbours queries
+        self.neighbour_leaves = MultiTreeBuilder.leaf_neighbours(self.score_matrices, self.signatures)
+        self.path_index = multi_builder.path_index
+
+        # the words on each leaf of each tree, for cluster queries
+        self.leaf_paths = [sorted(leaf_index, key=leaf_index.get) for leaf_index, _ in self.score_matrices]
+        self.leaf_members = []
+        for tree_leaves in self.leaf_indices:
+            members = np.argsort(tree_leaves, kind='stable')
+            starts = np.searchsorted(tree_leaves[members], np.arange(tree_leaves.max(initial=-1) + 2))
+            self.leaf_members.append((members, starts))
+
+    def word_id(self, word):
+        if word not in self.word_ids:
+            raise QueryError(f'unknown word: {word}')
+        return self.word_ids[word]
+
+    def score(self, word_a, word_b):
+        """The score of the pair, the same as in multiTree.py's output"""
+        return self.scores([(word_a, word_b)])[0]
+
+    def scores(self, pairs):
+        """The scores of a list of (word_a, word_b) pairs, all at once"""
+        ids = np.asarray([(self.word_id(a), self.word_id(b)) for a, b in pairs], dtype=np.int64).reshape(-1, 2)
+        sig_rows, sig_cols = self.word_signature[ids[:, 0]], self.word_signature[ids[:, 1]]
+        return MultiTreeBuilder.score_pairs(self.score_matrices, self.signatures, sig_rows, sig_cols).tolist()
+
+    def neighbours(self, word, k):
+        """The k words scoring highest with word, as [word, score] pairs from the highest down.
+        Ties go to the word that comes first in the paths files. Only the signatures on the
+        leaves nearest word are scored (see MultiTreeBuilder.nearest_signatures), until the
+        rest can't reach the k + 1-th best score so far."""
+        w = self.word_id(word)
+        k = min(k, len(self.words) - 1)
+        if k <= 0:
+            return []
+        sizes = np.diff(self.member_starts)
+        seen_sigs, seen_scores = [], []
+        word_total = 0
+        for sigs, scores, bound in MultiTreeBuilder.nearest_signatures(self.score_matrices, self.signatures, self.neighbour_leaves,
+                                                                       self.word_signature[w]):
+            seen_sigs.append(sigs)
+            seen_scores.append(scores)
+            word_total += sizes[sigs].sum()
+            if word_total > k:
+                # the score of the k + 1-th best word so far, counting word itself
+                all_scores = np.concatenate(seen_scores)
+                ranked = np.argsort(-all_scores, kind='stable')
+                cutoff = all_scores[ranked[np.searchsorted(np.cumsum(sizes[np.concatenate(seen_sigs)][ranked]), k + 1)]]
+                if not MultiTreeBuilder.reachable(bound, cutoff):
+                    break
+
+        # the words of the signatures scored, in one gather
+        sigs = np.concatenate(seen_sigs)
+        starts, lengths = self.member_starts[sigs], sizes[sigs]
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        candidates = self.members[np.repeat(starts, lengths) + offsets]
+        scores = np.repeat(np.concatenate(seen_scores), lengths)
+        others = candidates != w
+        candidates, scores = candidates[others], scores[others]
+        best = np.lexsort((candidates, -scores))[:k]
+        return [[self.words[i], int(score)] for i, score in zip(candidates[best].tolist(), scores[best].tolist())]
+
+    def cluster(self, word):
+        """The cluster (leaf) of word in each tree, and the words that share its leaf in every tree"""
+        w = self.word_id(word)
+        clusters = []
+        for tree_name, paths, tree_leaves, (members, starts) in zip(self.tree_names, self.leaf_paths, self.leaf_indices, self.leaf_members):
+            leaf = tree_leaves[w]
+            if leaf < 0:
+                clusters.append({ 'tree': tree_name, 'path': None, 'words': [] })
+                continue
+            clusters.append({ 'tree': tree_name, 'path': paths[leaf],
+                              'words': [self.words[i] for i in members[starts[leaf]:starts[leaf + 1]].tolist()] })
+        signature = self.word_signature[w]
+        shared = self.members[self.member_starts[signature]:self.member_starts[signature + 1]]
+        return { 'clusters': clusters, 'shared': [self.words[i] for i in shared.tolist()] }
+
+    def subtree(self, tree, prefix):
+        """The words under the path prefix in tree (a name or number), and their summed counts"""
+        return { 'words': self.path_index.words_under(tree, prefix),
+                 'weight': self.path_index.subtree_weight(tree, prefix) }
+
+
+class LatencyStats:
+    """Keeps the latest window latencies of each kind of query, for percentiles"""
+
+    def __init__(self, window=100000):
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.counts = defaultdict(int)
+
+    def add(self, op, seconds):
+        self.latencies[op].append(seconds)
+        self.counts[op] += 1
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        """{ op: { count, and each percentile and the max in ms } } over each op's window"""
+        summary = dict()
+        for op, latencies in self.latencies.items():
+            ms = np.asarray(latencies) * 1000
+            summary[op] = { 'count': self.counts[op],
+                            **{ f'p{p:g}_ms': float(v) for p, v in zip(percentiles, np.percentile(ms, percentiles)) },
+                            'max_ms': float(ms.max()) }
+        return summary
+
+
+class QueryServer:
+    """Answers queries about a WordIndex, one json object per line each way. A query is
+        { "op": "score", "a": word, "b": word }
+        { "op": "scores", "pairs": [[word, word], ...] }
+        { "op": "neighbours", "word": word, "k": 10 }
+        { "op": "cluster", "word": word }
+        { "op": "subtree", "tree": name or number, "prefix": "0110" }
+        { "op": "stats" }                    (latency percentiles of each op)
+        { "batch": [query, ...] }            (answered with a list)
+    and may have an "id", which is copied onto its answer. Answers are { "result": ... } or
+    { "error": message }. The latencies of queries that fail are all kept as 'error'."""
+
+    # the longest query line (a batch is one line)
+    LINE_LIMIT = 1 << 26
+
+    def __init__(self, index: WordIndex):
+        self.index = index
+        self.stats = LatencyStats()
+        self.ops = {
+            'score': lambda q: self.index.score(q['a'], q['b']),
+            'scores': lambda q: self.index.scores(q['pairs']),
+            'neighbours': lambda q: self.index.neighbours(q['word'], int(q.get('k', 10))),
+            'cluster': lambda q: self.index.cluster(q['word']),
+            'subtree': lambda q: self.index.subtree(q['tree'], str(q.get('prefix', ''))),
+            'stats': lambda q: self.stats.summary(),
+        }
+
+    def answer(self, query):
+        """The answer to one query (a dict, or a batch of them)"""
+        if not isinstance(query, dict):
+            return { 'error': 'a query must be a json object' }
+        if 'batch' in query:
+            if not isinstance(query['batch'], list):
+                return { 'error': 'a batch must be a list of queries' }
+            start = perf_counter()
+            answers = [self.answer(q) for q in query['batch']]
+            self.stats.add('batch', perf_counter() - start)
+            return answers
+
+        start = perf_counter()
+        op = query.get('op')
+        try:
+            if not isinstance(op, str) or op not in self.ops:
+                raise QueryError(f'unknown op: {op}')
+            answer = { 'result': self.ops[op](query) }
+        except QueryError as e:
+            answer = { 'error': str(e) }
+        except KeyError as e:
+            answer = { 'error': f'{op} queries need a {e.args[0]!r}' }
+        except (IndexError, TypeError, ValueError) as e:
+            answer = { 'error': f'bad {op} query: {e}' }
+        if 'id' in query:
+            answer['id'] = query['id']
+        # only the ops that exist get their own latencies, so bad queries can't add more
+        self.stats.add(op if 'result' in answer else 'error', perf_counter() - start)
+        return answer
+
+    @staticmethod
+    async def read_line(reader):
+        """ Returns the next line from reader (b'' at the end), or None if it is longer than
+            LINE_LIMIT, in which case the rest of it is skipped"""
+        try:
+            return await reader.readuntil(b'\n')
+        except IncompleteReadError as e:
+            return e.partial
+        except LimitOverrunError as e:
+            overrun = e
+        # drop what's buffered of the line, until its newline turns up
+        while True:
+            try:
+                await reader.readexactly(overrun.consumed)
+                await reader.readuntil(b'\n')
+                return None
+            except IncompleteReadError:
+                return None
+            except LimitOverrunError as e:
+                overrun = e
+
+    async def handle(self, reader, writer):
+        try:
+            while (line := await QueryServer.read_line(reader)) != b'':
+                if line is None:
+                    answer = { 'error': 'query line too long' }
+                else:
+                    try:
+                        query = loads(line)
+                    except ValueError as e:
+                        answer = { 'error': f'bad json: {e}' }
+                    else:
+                        try:
+                            answer = self.answer(query)
+                        except Exception as e:
+                            # one bad query mustn't close the connection
+                            answer = { 'error': f'query failed: {e!r}' }
+                writer.write(dumps(answer).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=None, host='127.0.0.1', port=None):
+        """Serves on the unix socket at socket_path, or on host:port, until cancelled"""
+        if socket_path is not None:
+            if exists(socket_path):
+                remove(socket_path)
+            server = await start_unix_server(self.handle, socket_path, limit=QueryServer.LINE_LIMIT)
+        else:
+            server = await start_server(self.handle, host, port, limit=QueryServer.LINE_LIMIT)
+        async with server:
+            await server.serve_forever()
+
+
+class QueryClient:
+    """A blocking client for QueryServer, eg
+
+        client = QueryClient(socket_path='./query.sock')
+        client.score('cat', 'kitteh')
+        client.batch([{ 'op': 'neighbours', 'word': w, 'k': 5 } for w in words])"""
+
+    def __init__(self, socket_path=None, host='127.0.0.1', port=None):
+        if socket_path is not None:
+            self.socket = socket(AF_UNIX, SOCK_STREAM)
+            self.socket.connect(socket_path)
+        else:
+            self.socket = socket(AF_INET, SOCK_STREAM)
+            self.socket.connect((host, port))
+        self.file = self.socket.makefile('rwb')
+
+    def query(self, query):
+        """Sends a query dict and returns the answer"""
+        self.file.write(dumps(query).encode() + b'\n')
+        self.file.flush()
+        return loads(self.file.readline())
+
+    def result(self, query):
+        answer = self.query(query)
+        if 'error' in answer:
+            raise QueryError(answer['error'])
+        return answer['result']
+
+    def score(self, word_a, word_b):
+        return self.result({ 'op': 'score', 'a': word_a, 'b': word_b })
+
+    def neighbours(self, word, k=10):
+        return self.result({ 'op': 'neighbours', 'word': word, 'k': k })
+
+    def cluster(self, word):
+        return self.result({ 'op': 'cluster', 'word': word })
+
+    def subtree(self, tree, prefix=''):
+        return self.result({ 'op': 'subtree', 'tree': tree, 'prefix': prefix })
+
+    def batch(self, queries):
+        """Sends many queries in one round trip, returning their answers in order"""
+        return self.query({ 'batch': queries })
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+if __name__ == "__main__":
+    cluster_flag = LiteralFlag('c', 'clusters', 'List of cluster sizes to load')
+    socket_flag = LiteralFlag('s', 'socket', 'Unix socket to serve on', default_value='./query.sock')
+    port_flag = LiteralFlag('p', 'port', 'Serve on this localhost port\ninstead of a unix socket')
+    help_flag = Flag('h', 'help', 'Shows this prompt')
+
+    def print_help():
+        print('--- Help ---------------------------------------------')
+        print('\tThis tool must be provided with cluster sizes \n\tand the name of the file that was used as\n\tinput to the algorithm (without its extension).\n\tIt answers score, neighbours, cluster and\n\tsubtree queries as json lines (see QueryServer)')
+        for flag in [cluster_flag, socket_flag, port_flag, help_flag]:
+            print(flag.format_description(4, 18))
+        print('------------------------------------------------------')
+
+    args = Flag.get_terminal_args()
+
+    if help_flag.remove_from_args(args):
+        print_help()
+        exit()
+
+    if not cluster_flag.remove_from_args(args) or not isinstance(cluster_flag.value, list):
+        print_help()
+        raise ValueError('QueryServer requires a list of cluster sizes (w/o spaces)')
+
+    socket_flag.remove_from_args(args)
+    if port_flag.remove_from_args(args) and not isinstance(port_flag.value, int):
+        print_help()
+        raise ValueError('QueryServer port flag must be followed by an int literal')
+
+    if len(args) != 1:
+        print_help()
+        raise ValueError('QueryServer requires the name of the input file (without extension)')
+
+    multi_builder = MultiTreeBuilder(MultiTreeBuilder.create_file_locs(args[0], cluster_flag.value))
+    multi_builder.build_all()
+    server = QueryServer(WordIndex(multi_builder))
+    where = f'127.0.0.1:{port_flag.value}' if port_flag.value is not None else socket_flag.value
+    print(f'Serving {len(server.index.words):,} words from {len(server.index.tree_names)} trees on {where}')
+    try:
+        run(server.serve(None if port_flag.value is not None else socket_flag.value, port=port_flag.value))
+    except KeyboardInterrupt:
+        pass
@@ -1,6 +1,7 @@
-from sys import argv
+from sys import argv, stdout
 from ast import literal_eval
 from math import ceil, floor
+from time import monotonic
 
 class Flag:
     """A class that represents a flag that could be entered at the command line"""
@@ -101,19 +102,74 @@ class LiteralFlag(Flag):
 
 
 class ProgressMeter():
-    """A class that creates a maintains a progress bar"""
-    def __init__(self, pct_per_char=5):
-        """pct_per_char is how many percent per '=' in the bar"""
+    """A class that creates a maintains a progress bar, with the rate and time left.
+
+    Progress is given either as a percent (update_meter) or, if the total is known, as a
+    count of items done (advance). Either way the bar is redrawn at most max_fps times a
+    second, so hot loops can report often (though advancing in batches is cheaper still).
+
+    Call finish when done, or use the meter as a context manager, so the last update is
+    drawn and the next output starts on its own line."""
+    def __init__(self, pct_per_char=5, total=None, max_fps=4, clock=monotonic):
+        """pct_per_char is how many percent per '=' in the bar, total is how many items
+        advance counts up to"""
         self.last = -1
         self.bar_size = ceil(100 / pct_per_char)
         self.pct_per_char = pct_per_char
-    
+        self.total = total
+        self.done = 0
+        self.min_interval = 1 / max_fps
+        self.clock = clock
+        self.start = clock()
+        self.next_render = self.start + self.min_interval
+
+    def advance(self, n=1):
+        """Counts n more items done out of total, redrawing if it is time to"""
+        self.done += n
+        now = self.clock()
+        if now >= self.next_render or (self.total and self.done >= self.total):
+            self.render(100 * self.done / self.total if self.total else 100, now)
+
     def update_meter(self, pct_complete, force=False):
-        """Updates the meter each time a percent passes, or if force is true"""
-        if force or pct_complete - self.last < 1:
-            return
+        """Updates the meter each time a percent passes (at most max_fps times a second),
+        or always if force is true"""
+        if not force:
+            if pct_complete - self.last < 1:
+                return
+            now = self.clock()
+            if now < self.next_render and pct_complete < 100:
+                return
+        else:
+            now = self.clock()
+        self.render(pct_complete, now)
+
+    def finish(self):
+        """Draws the meter at 100% and ends its line"""
+        if self.total:
+            self.done = self.total
+        self.render(100, self.clock())
+        print()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.finish()
+        else:
+            # leave the meter where it stopped, under whatever is printed about the error
+            print()
+
+    @staticmethod
+    def format_seconds(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f'{hours}:{minutes:02}:{seconds:02}'
+
+    def render(self, pct_complete, now):
         pct_complete = min(100, pct_complete)
         self.last = pct_complete
+        self.next_render = now + self.min_interval
         filled = floor(pct_complete / self.pct_per_char)
         if pct_complete >= 100 - self.pct_per_char / 2:
             bar = "[" + self.bar_size * "=" + ']'
@@ -121,7 +177,41 @@ class ProgressMeter():
             spaces = self.bar_size - 1 - filled
             bar = '[' + filled * '=' + '>' \
                         + spaces * ' ' + ']'
-        print(f'\rcompletion: {ceil(pct_complete)/100:>4.0%} {bar}', end='')
+
+        elapsed = now - self.start
+        stats = ''
+        if elapsed > 0 and self.done:
+            stats += f' {self.done / elapsed:,.0f}/s'
+        if 0 < pct_complete < 100:
+            stats += f' eta {ProgressMeter.format_seconds(elapsed * (100 - pct_complete) / pct_complete)}'
+        elif pct_complete >= 100:
+            stats += f' in {ProgressMeter.format_seconds(elapsed)}'
+        # pad so a shorter line covers the end of the last one
+        print(f'\rcompletion: {ceil(pct_complete)/100:>4.0%} {bar}{stats:<28}', end='', flush=True)
+
+
+class NullProgressMeter(ProgressMeter):
+    """A ProgressMeter that never draws, for output that isn't a terminal or for benchmarks"""
+
+    def advance(self, n=1):
+        pass
+
+    def update_meter(self, pct_complete, force=False):
+        pass
+
+    def finish(self):
+        pass
+
+    def __exit__(self, *_):
+        pass
+
+
+def progress_meter(total=None, show=None, **kwargs):
+    """Makes a ProgressMeter (see its arguments), or a NullProgressMeter if show is false.
+    By default the meter is only shown if stdout is a terminal."""
+    if show is None:
+        show = stdout.isatty()
+    return ProgressMeter(total=total, **kwargs) if show else NullProgressMeter(total=total, **kwargs)
 
 
 def prompt_yn(prompt: str):
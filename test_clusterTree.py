@@ -0,0 +1,19 @@
+from itertools import product
+
+from clusterTree import TreeBuilder
+
+LABELS = ['', '0', '1', '01', '10', '110', '1101', '110111', '1101000', '0110']
+
+def test_lca_label_is_lca_depth_long():
+    for label0, label1 in product(LABELS, repeat=2):
+        depth = TreeBuilder.lca_depth(label0, label1)
+        assert len(TreeBuilder.lca_label(label0, label1)) == depth
+        assert TreeBuilder.lca_depth_bits(TreeBuilder.encode_path(label0), TreeBuilder.encode_path(label1)) == depth
+
+def test_lca_examples():
+    assert TreeBuilder.lca_depth('110111', '1101000') == 5
+    assert TreeBuilder.lca_label('110111', '1101000') == '11011'
+    assert TreeBuilder.lca_depth('1101', '0110') == 1
+    assert TreeBuilder.lca_label('1101', '0110') == '1'
+    assert TreeBuilder.lca_depth('110', '1101') == 3
+    assert TreeBuilder.lca_label('110', '1101') == '110'
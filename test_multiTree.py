@@ -0,0 +1,47 @@
+from analysis import totals_path
+from multiTree import MultiTreeBuilder, PairTotals
+
+# three trees of the same two words, which score them 5/3, 4/3 and 6. 1 + 5/3 + 4/3 + 6
+# is exactly 10 and adds up to 10.0 in this order, but to just over 10 with the last two
+# trees swapped, so its ceil depends on the order the trees are summed in
+PATHS = {
+    'a': '00000\tx\t1\n10\ty\t1\n',
+    'b': '00\tx\t1\n10\ty\t1\n',
+    'c': '000\tx\t1\n001\ty\t1\n',
+}
+
+def write_paths(tmp_path):
+    paths = dict()
+    for name, text in PATHS.items():
+        paths[name] = str(tmp_path / f'{name}.paths')
+        with open(paths[name], 'w') as f:
+            f.write(text)
+    return paths
+
+def write_scores(multi_builder, output_path):
+    for _ in multi_builder.write_binary(output_path):
+        pass
+    multi_builder.pair_totals.save(totals_path(output_path))
+
+def test_update_adding_a_tree_mid_list_matches_a_fresh_run(tmp_path):
+    paths = write_paths(tmp_path)
+    files = [paths['a'], paths['b'], paths['c']]
+
+    fresh = MultiTreeBuilder(files)
+    fresh.build_all()
+    fresh.make_pair_totals()
+    write_scores(fresh, str(tmp_path / 'fresh.npy'))
+
+    # the first run has a and c, so the update adds b between them
+    first = MultiTreeBuilder([paths['a'], paths['c']])
+    first.build_all()
+    first.make_pair_totals()
+    write_scores(first, str(tmp_path / 'updated.npy'))
+    updated = MultiTreeBuilder([])
+    updated.pair_totals = PairTotals.load(totals_path(str(tmp_path / 'updated.npy')))
+    assert updated.update_trees(files) == ([], [paths['b']])
+    assert updated.pair_totals.tree_names == files
+    write_scores(updated, str(tmp_path / 'updated.npy'))
+
+    for suffix in ('.npy', '.vocab'):
+        assert (tmp_path / f'updated{suffix}').read_bytes() == (tmp_path / f'fresh{suffix}').read_bytes()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+from hashlib import sha1
+from os import listdir, makedirs, remove, stat, utime
+from os.path import exists, join
+from sys import exit
+
+import numpy as np
+
+from clusterTree import CompactTree, Vocabulary
+from fileHelpers import atomic_write
+from terminalHelpers import *
+
+DEFAULT_CACHE_DIR = './.tree-cache'
+DEFAULT_MAX_BYTES = 1 << 30
+
+def pack_strings(strings):
+    """Packs a list of strings without newlines into a uint8 array"""
+    return np.frombuffer('\n'.join(strings).encode('utf8'), dtype=np.uint8)
+
+def unpack_strings(packed):
+    """Inverse of pack_strings"""
+    return packed.tobytes().decode('utf8').split('\n') if packed.size else []
+
+
+class TreeCache:
+    """An on-disk cache of everything MultiTreeBuilder makes from a paths file: the words
+    with their paths and counts, the leaf score table and the tree (as CompactTree arrays).
+
+    Entries are '.npz' files named after the sha1 of the paths file's content, so an edited
+    file never gets a stale entry. Loading an entry marks it as used, and once the cache is
+    bigger than max_bytes the least recently used entries are deleted."""
+
+    # bump when the entry layout changes, so old entries are never read
+    VERSION = 1
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(path, chunk_size=1 << 20):
+        """The cache key of the paths file at path, from its content"""
+        digest = sha1(f'v{TreeCache.VERSION}:'.encode())
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return join(self.directory, key + '.npz')
+
+    def load(self, path):
+        """Returns (entries, score_table, tree) for the paths file at path, or None if it isn't cached.
+        entries is (paths, words, counts) like TreeBuilder.read_entries, score_table is
+        (leaf_index, matrix) like MultiTreeBuilder.leaf_score_table and tree is a CompactTree."""
+        arrays = self.load_arrays(path)
+        return TreeCache.from_entry_arrays(arrays) if arrays is not None else None
+
+    def load_arrays(self, path):
+        """Returns the arrays of the entry for the paths file at path (see entry_arrays), or None"""
+        entry_path = self.entry_path(TreeCache.key(path))
+        if not exists(entry_path):
+            return None
+        # mark it as the most recently used
+        utime(entry_path)
+
+        with np.load(entry_path, allow_pickle=False) as data:
+            return dict(data)
+
+    @staticmethod
+    def from_entry_arrays(arrays):
+        """Rebuilds (entries, score_table, tree) from the arrays of entry_arrays"""
+        words, leaves = unpack_strings(arrays['words']), unpack_strings(arrays['leaves'])
+        paths = [leaves[i] for i in arrays['word_leaves'].tolist()]
+        entries = paths, words, arrays['counts'].tolist()
+        score_table = { leaf: i for i, leaf in enumerate(leaves) }, arrays['score_matrix']
+
+        # a paths file has each word once, and the tree's word ids are in file order
+        vocabulary = Vocabulary.from_words(words)
+        tree = CompactTree.from_arrays({ name: arrays['tree_' + name] for name in CompactTree.ARRAY_NAMES }, vocabulary)
+        return entries, score_table, tree
+
+    def store(self, path, entries, score_table, tree):
+        """Caches what was made from the paths file at path (see load), then evicts old entries.
+        tree's word ids must be in the order the words first appear in entries."""
+        self.store_arrays(path, TreeCache.entry_arrays(entries, score_table, tree))
+
+    @staticmethod
+    def entry_arrays(entries, score_table, tree):
+        """The arrays a cache entry is made of: the words and the sorted leaves packed with
+        pack_strings, each word's leaf (its row in the score matrix) and count, the score
+        matrix and the tree's arrays (prefixed with 'tree_')"""
+        paths, words, counts = entries
+        leaf_index, matrix = score_table
+        leaves = sorted(leaf_index, key=leaf_index.get)
+
+        arrays = {
+            'words': pack_strings(words),
+            'leaves': pack_strings(leaves),
+            'word_leaves': np.fromiter(map(leaf_index.__getitem__, paths), dtype=np.int32, count=len(paths)),
+            'counts': np.asarray(counts, dtype=np.int64),
+            'score_matrix': matrix,
+        }
+        arrays.update(('tree_' + name, array) for name, array in tree.arrays().items())
+        return arrays
+
+    def store_arrays(self, path, arrays, evict=True):
+        """Caches the entry_arrays made from the paths file at path. Several processes can store
+        at once if only one of them evicts."""
+        entry_path = self.entry_path(TreeCache.key(path))
+        with atomic_write(entry_path, 'wb') as f:
+            np.savez(f, **arrays)
+        if evict:
+            self.evict()
+
+    def entries(self):
+        """Returns (entry_path, size, last_used) for every entry, least recently used first"""
+        found = []
+        for name in listdir(self.directory):
+            if name.endswith('.npz'):
+                info = stat(join(self.directory, name))
+                found.append((join(self.directory, name), info.st_size, info.st_mtime))
+        return sorted(found, key=lambda entry: entry[2])
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in max_bytes"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for entry_path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            remove(entry_path)
+            total -= size
+
+    def invalidate(self, paths=None):
+        """Deletes the entries for the current content of each paths file in paths, or every
+        entry if paths is None. Returns how many were deleted."""
+        if paths is None:
+            targets = [entry_path for entry_path, _, _ in self.entries()]
+        else:
+            targets = [self.entry_path(TreeCache.key(path)) for path in paths]
+        deleted = 0
+        for entry_path in targets:
+            if exists(entry_path):
+                remove(entry_path)
+                deleted += 1
+        return deleted
+
+
+if __name__ == "__main__":
+    dir_flag = LiteralFlag('d', 'dir', 'The cache directory', default_value=DEFAULT_CACHE_DIR)
+    invalidate_flag = Flag('i', 'invalidate', 'Deletes the entries of the paths\nfiles given (or all of them)')
+    list_flag = Flag('l', 'list', 'Lists the entries')
+    help_flag = Flag('h', 'help', 'Shows this prompt')
+
+    def print_help():
+        print('--- Help ---------------------------------------------')
+        print('\tManages the cache of parsed paths files\n\tused by multiTree.py --cache')
+        for flag in [dir_flag, invalidate_flag, list_flag, help_flag]:
+            print(flag.format_description(4, 18))
+        print('------------------------------------------------------')
+
+    args = Flag.get_terminal_args()
+
+    if help_flag.remove_from_args(args):
+        print_help()
+        exit()
+
+    dir_flag.remove_from_args(args)
+    cache = TreeCache(dir_flag.value)
+
+    if invalidate_flag.remove_from_args(args):
+        deleted = cache.invalidate(args or None)
+        print(f'deleted {deleted} cache entries from {cache.directory}')
+    elif list_flag.remove_from_args(args):
+        entries = cache.entries()
+        for entry_path, size, _ in entries:
+            print(f'{entry_path}\t{size:,} bytes')
+        print(f'{len(entries)} entries, {sum(size for _, size, _ in entries):,} bytes')
+    else:
+        print_help()